@@ -1,17 +1,30 @@
 from dataclasses import dataclass
-from typing import Union
+from typing import Union, AsyncIterator
+import asyncio
+import time
 
+import ujson
 import uvicorn
-from fastapi import FastAPI, Depends, status
+from fastapi import FastAPI, Depends, Request, status
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.exceptions import HTTPException
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
 
-from model.infer import ChatBot
+from model.async_chat import AsyncChatBot, QueueFullError, ClientDisconnectedError
+from model.admission import AdmissionController, AdmissionError, AdmissionTicket, load_api_keys
+from model.backends import create_chat_bot
+from utils.memory import get_memory_report
 from config import InferConfig
 
 CONFIG = InferConfig()
-chat_bot = ChatBot(infer_config=CONFIG)
+
+# 按CONFIG.backend创建推理后端，配置多个后端时每个worker选择其中一个
+chat_bot = create_chat_bot(infer_config=CONFIG)
+
+# 异步封装，推理不阻塞事件循环，并限制并发数、排队数和超时
+async_chat_bot = AsyncChatBot(chat_bot=chat_bot, infer_config=CONFIG)
 
 #==============================================================
 # api 配置
@@ -19,10 +32,21 @@ chat_bot = ChatBot(infer_config=CONFIG)
 # api根目录
 ROOT = '/api'
 
-# api key
-USE_AUTH = False if len(CONFIG.api_key) == 0 else True
+# api key，CONFIG.api_keys_file中的key和各自的配额
+API_KEYS = load_api_keys(CONFIG.api_keys_file)
+USE_AUTH = False if len(CONFIG.api_key) == 0 and len(API_KEYS) == 0 else True
 SECRET_KEY = CONFIG.api_key
 
+# 准入控制：限制已接受请求的总开销（prompt token数 + 最大生成token数）、排队数和每个api key的配额
+admission_controller = AdmissionController(
+    max_inflight_tokens=CONFIG.admission_max_tokens,
+    max_queue_size=CONFIG.admission_max_queue,
+    queue_timeout=CONFIG.admission_queue_timeout,
+    api_key_quotas=API_KEYS,
+    default_tokens_per_minute=CONFIG.api_key_tokens_per_minute,
+    default_max_concurrency=CONFIG.api_key_max_concurrency,
+)
+
 app = FastAPI()
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 
@@ -32,20 +56,46 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/token")
 post请求地址：http://127.0.0.1:8812/api/chat
 需要添加Authorization头，bodyjson格式，示例：
 {
-    "input_txt": "感冒了要怎么办"
+    "input_txt": "感冒了要怎么办",
+    "search_type": "greedy",
+    "max_new_tokens": 128,
+    "deadline": 1700000000.0
+}
+search_type可选，为生成方式的名称（greedy、beam、sampling、contrastive、early_exit或自定义的生成方式，见model.generation_profiles），
+不填时使用CONFIG.generation_profile，流式输出只支持greedy；
+max_new_tokens可选，最多生成的token数，不超过CONFIG.max_seq_len；
+deadline可选，截止时间（unix时间戳，秒），超过后停止生成并返回504，客户端断开时同样停止生成；
+流式输出的响应头已经发送，超时、服务器满载时以错误事件结束（SSE：event: error，JSON Lines：{"error": ..., "status_code": ...}），
+不会发送正常的结束标记
+
+准入控制：服务器满载（已接受请求的总开销超过CONFIG.admission_max_tokens且排队已满或超时）返回503，
+api key超出配额（CONFIG.api_keys_file）返回429，两者都带有Retry-After头（秒）
+
+流式输出请求地址（body格式同上）：
+SSE: http://127.0.0.1:8812/api/chat/stream
+JSON Lines: http://127.0.0.1:8812/api/chat/stream/jsonl
+
+批量请求地址：http://127.0.0.1:8812/api/chat/batch，一次最多CONFIG.batch_max_inputs条，按长度分桶后批量生成，示例：
+{
+    "input_txts": ["感冒了要怎么办", "请介绍一下北京"],
+    "search_type": "greedy",
+    "max_new_tokens": 128
 }
+返回：{"responses": [...], "stats": {"requests": 2, "generated_tokens": ..., "tokens_per_s": ...}}，回答按输入顺序，空回答不做替换；
+超时为CONFIG.batch_request_timeout，大量数据请使用离线批量生成：python batch_infer.py --input_file=... --output_file=...
 """
 
-async def api_key_auth(token: str = Depends(oauth2_scheme)) -> Union[None, bool]:
+async def api_key_auth(token: str = Depends(oauth2_scheme)) -> Union[None, str]:
   """
-  验证post请求的key是否和服务器的key一致
+  验证post请求的key是否和服务器的key（或api_keys_file中的key）一致
   需要在请求头加上 Authorization: Bearer SECRET_KEY
+  返回通过认证的key，用于按key统计配额
   """
   if not USE_AUTH:
     return None  # return None if not auth
 
-  if token == SECRET_KEY:
-    return None # return None if auth success
+  if (len(SECRET_KEY) > 0 and token == SECRET_KEY) or token in API_KEYS:
+    return token # return key if auth success
 
   # 验证出错
   raise HTTPException(
@@ -57,12 +107,76 @@ async def api_key_auth(token: str = Depends(oauth2_scheme)) -> Union[None, bool]
 # pos请求json
 class ChatInput(BaseModel):
   input_txt: str
+  search_type: Union[str, None] = None
+  max_new_tokens: Union[int, None] = Field(default=None, ge=1)
+  deadline: Union[float, None] = None
+
+class BatchChatInput(BaseModel):
+  input_txts: list[str] = Field(min_length=1)
+  search_type: Union[str, None] = None
+  max_new_tokens: Union[int, None] = Field(default=None, ge=1)
+  deadline: Union[float, None] = None
+
+
+def check_search_type(search_type: Union[str, None], stream: bool=False) -> None:
+    """
+    生成方式不存在（或当前后端不支持）时返回400，流式输出只支持和greedy结果相同的生成方式，不填时为greedy
+    """
+    try:
+        if stream and search_type is None:
+            return
+        profile = chat_bot.get_profile(search_type)
+    except (KeyError, ValueError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e.args[0]))
+
+    if stream and not profile.is_greedy:
+        raise HTTPException(
+                            status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="stream output only supports greedy search, got search_type: {}.".format(search_type),
+                        )
+
+
+async def admit_request(input_txts: list[str], max_new_tokens: Union[int, None], api_key: Union[None, str]) -> AdmissionTicket:
+    """
+    按 prompt token数 + 最大生成token数 估计请求的开销并申请预算，批量请求为所有prompt的开销之和，
+    api key超出配额返回429，服务器满载（排队数达到上限或排队超时）返回503，都带有Retry-After
+    """
+    max_new_tokens = CONFIG.max_seq_len if max_new_tokens is None else min(max_new_tokens, CONFIG.max_seq_len)
+    cost = sum(admission_controller.estimate_cost(len(chat_bot.encode(f"{txt}[EOS]").input_ids), max_new_tokens) for txt in input_txts)
+    try:
+        return await admission_controller.admit(cost, api_key=api_key)
+    except AdmissionError as e:
+        raise HTTPException(
+                            status_code=e.status_code,
+                            detail=str(e),
+                            headers=None if e.retry_after is None else {"Retry-After": str(e.retry_after)},
+                        )
+
+
+def timeout_detail(deadline: Union[float, None], request_timeout: float, start_time: float) -> str:
+    '''
+    超时的原因：请求的截止时间早于 开始时间 + request_timeout 时是截止时间，否则是服务器的超时时间
+    '''
+    if deadline is not None and deadline <= start_time + request_timeout:
+        return "deadline {} exceeded.".format(deadline)
+    return "generate timeout after {} seconds.".format(request_timeout)
+
+
+def server_busy_exception() -> HTTPException:
+    '''
+    排队请求数达到上限时返回503，提示客户端稍后重试
+    '''
+    return HTTPException(
+                        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        detail="server is busy, please retry later.",
+                        headers={"Retry-After": "1"},
+                    )
 
 
 @app.post(ROOT + "/chat")
-async def chat(post_data: ChatInput, authority: str = Depends(api_key_auth)) -> dict:
+async def chat(request: Request, post_data: ChatInput, authority: str = Depends(api_key_auth)) -> dict:
     """
-    post 输入: {'input_txt': '输入的文本'}
+    post 输入: {'input_txt': '输入的文本', 'search_type': '生成方式（可选）', 'max_new_tokens': 最多生成的token数（可选）, 'deadline': 截止时间（可选）}
     response: {'response': 'chatbot文本'}
     """
     input_txt = post_data.input_txt
@@ -73,13 +187,213 @@ async def chat(post_data: ChatInput, authority: str = Depends(api_key_auth)) ->
                             headers={"WWW-Authenticate": "Bearer"},
                         )
     
-    outs = chat_bot.chat(input_txt)
+    check_search_type(post_data.search_type)
+    ticket = await admit_request([post_data.input_txt], post_data.max_new_tokens, authority)
+
+    start_time = time.time()
+    try:
+        outs = await async_chat_bot.chat(
+                                        input_txt,
+                                        search_type=post_data.search_type,
+                                        max_new_tokens=post_data.max_new_tokens,
+                                        deadline=post_data.deadline,
+                                        is_disconnected=request.is_disconnected,
+                                    )
+    except QueueFullError:
+        raise server_busy_exception()
+    except asyncio.TimeoutError:
+        raise HTTPException(
+                            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                            detail=timeout_detail(post_data.deadline, CONFIG.request_timeout, start_time),
+                        )
+    except ClientDisconnectedError:
+        # 客户端已经断开，响应不会被读取
+        raise HTTPException(status_code=499, detail="client closed request.")
+    finally:
+        ticket.release()
 
     if len(outs) == 0:
        outs = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
 
     return {'response': outs}
 
+
+@app.post(ROOT + "/chat/batch")
+async def chat_batch(request: Request, post_data: BatchChatInput, authority: str = Depends(api_key_auth)) -> dict:
+    """
+    post 输入: {'input_txts': ['输入的文本', ...], 'search_type': '生成方式（可选）', 'max_new_tokens': 最多生成的token数（可选）, 'deadline': 截止时间（可选）}
+    response: {'responses': ['chatbot文本', ...], 'stats': {吞吐量统计}}
+    """
+    input_txts = post_data.input_txts
+    if len(input_txts) > CONFIG.batch_max_inputs:
+        raise HTTPException(
+                            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                            detail="too many input_txts: {}, limit: {}.".format(len(input_txts), CONFIG.batch_max_inputs),
+                        )
+    if any(len(txt) == 0 for txt in input_txts):
+        raise HTTPException(
+                            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                            detail="input_txt length = 0 is not allow!",
+                        )
+
+    check_search_type(post_data.search_type)
+    ticket = await admit_request(input_txts, post_data.max_new_tokens, authority)
+
+    start_time = time.time()
+    try:
+        outs, stats = await async_chat_bot.generate_batch(
+                                        input_txts,
+                                        search_type=post_data.search_type,
+                                        max_new_tokens=post_data.max_new_tokens,
+                                        deadline=post_data.deadline,
+                                        is_disconnected=request.is_disconnected,
+                                    )
+    except QueueFullError:
+        raise server_busy_exception()
+    except asyncio.TimeoutError:
+        raise HTTPException(
+                            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                            detail=timeout_detail(post_data.deadline, CONFIG.batch_request_timeout, start_time),
+                        )
+    except ClientDisconnectedError:
+        raise HTTPException(status_code=499, detail="client closed request.")
+    finally:
+        ticket.release()
+
+    return {'responses': outs, 'stats': stats}
+
+
+async def stream_chat_deltas(request: Request, post_data: ChatInput, ticket: AdmissionTicket) -> AsyncIterator[dict]:
+    '''
+    逐段返回生成的文本：{'delta': 文本}，客户端断开、超时（包括超过请求的截止时间）或响应被取消时，引擎在下一个解码步停止该请求的生成，
+    结束后归还准入预算。响应头已经发送，超时、服务器满载时最后返回{'error': 原因, 'status_code': 504或503}，已经输出的是不完整的回答
+    '''
+    start_time = time.time()
+    try:
+        async for text in async_chat_bot.stream_chat(
+                                        post_data.input_txt,
+                                        is_disconnected=request.is_disconnected,
+                                        max_new_tokens=post_data.max_new_tokens,
+                                        deadline=post_data.deadline,
+                                    ):
+            yield {'delta': text}
+    except QueueFullError:
+        yield {'error': 'server is busy, please retry later.', 'status_code': status.HTTP_503_SERVICE_UNAVAILABLE}
+    except asyncio.TimeoutError:
+        yield {'error': timeout_detail(post_data.deadline, CONFIG.request_timeout, start_time), 'status_code': status.HTTP_504_GATEWAY_TIMEOUT}
+    finally:
+        ticket.release()
+
+
+@app.post(ROOT + "/chat/stream")
+async def chat_stream_sse(request: Request, post_data: ChatInput, authority: str = Depends(api_key_auth)) -> StreamingResponse:
+    """
+    post 输入: 同/api/chat，search_type只支持greedy
+    response: server-sent events，每个事件：data: {"delta": "新生成的文本"}，结束时：data: [DONE]，
+    超时或服务器满载时以错误事件结束：event: error，data: {"error": "原因", "status_code": 504}，不发送[DONE]
+    """
+    input_txt = post_data.input_txt
+    if len(input_txt) == 0:
+        raise HTTPException(
+                            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                            detail="input_txt length = 0 is not allow!",
+                            headers={"WWW-Authenticate": "Bearer"},
+                        )
+
+    check_search_type(post_data.search_type, stream=True)
+    ticket = await admit_request([post_data.input_txt], post_data.max_new_tokens, authority)
+
+    try:
+        async_chat_bot.check_queue()
+    except QueueFullError:
+        ticket.release()
+        raise server_busy_exception()
+
+    async def event_stream() -> AsyncIterator[str]:
+        async for event in stream_chat_deltas(request, post_data, ticket):
+            if 'error' in event:
+                yield 'event: error\ndata: {}\n\n'.format(ujson.dumps(event, ensure_ascii=False))
+                return
+            yield 'data: {}\n\n'.format(ujson.dumps(event, ensure_ascii=False))
+        yield 'data: [DONE]\n\n'
+
+    # 客户端在输出开始前断开时生成器不会执行，由background归还预算（重复调用只归还一次）
+    return StreamingResponse(
+        event_stream(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        background=BackgroundTask(ticket.release),
+    )
+
+
+@app.post(ROOT + "/chat/stream/jsonl")
+async def chat_stream_jsonl(request: Request, post_data: ChatInput, authority: str = Depends(api_key_auth)) -> StreamingResponse:
+    """
+    post 输入: 同/api/chat，search_type只支持greedy
+    response: chunked json lines，每行：{"delta": "新生成的文本"}，最后一行：{"done": true, "response": "完整的回答"}，
+    超时或服务器满载时最后一行为：{"error": "原因", "status_code": 504, "response": "已经生成的不完整的回答"}
+    """
+    input_txt = post_data.input_txt
+    if len(input_txt) == 0:
+        raise HTTPException(
+                            status_code=status.HTTP_406_NOT_ACCEPTABLE,
+                            detail="input_txt length = 0 is not allow!",
+                            headers={"WWW-Authenticate": "Bearer"},
+                        )
+
+    check_search_type(post_data.search_type, stream=True)
+    ticket = await admit_request([post_data.input_txt], post_data.max_new_tokens, authority)
+
+    try:
+        async_chat_bot.check_queue()
+    except QueueFullError:
+        ticket.release()
+        raise server_busy_exception()
+
+    async def jsonl_stream() -> AsyncIterator[str]:
+        response = []
+        async for event in stream_chat_deltas(request, post_data, ticket):
+            if 'error' in event:
+                yield ujson.dumps({**event, 'response': ''.join(response)}, ensure_ascii=False) + '\n'
+                return
+            response.append(event['delta'])
+            yield ujson.dumps(event, ensure_ascii=False) + '\n'
+
+        response = ''.join(response)
+        if len(response) == 0:
+            response = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
+        yield ujson.dumps({'done': True, 'response': response}, ensure_ascii=False) + '\n'
+
+    return StreamingResponse(jsonl_stream(), media_type='application/x-ndjson', background=BackgroundTask(ticket.release))
+
+
+@app.on_event("startup")
+async def report_worker_memory() -> None:
+    """
+    每个worker启动后打印内存占用，使用共享权重文件时，每个worker独占的内存（uss）不包含模型权重
+    """
+    print('worker started, memory: {}'.format(get_memory_report()))
+
+
+# 内存占用需要解析/proc的smaps，在线程池中计算，并缓存MEMORY_REPORT_TTL秒，频繁的健康检查不会阻塞事件循环
+MEMORY_REPORT_TTL = 5.0
+memory_report_cache = {'time': 0.0, 'report': None}
+
+async def get_cached_memory_report() -> dict:
+    if memory_report_cache['report'] is None or time.monotonic() - memory_report_cache['time'] > MEMORY_REPORT_TTL:
+        memory_report_cache['report'] = await asyncio.get_running_loop().run_in_executor(None, get_memory_report)
+        memory_report_cache['time'] = time.monotonic()
+
+    return memory_report_cache['report']
+
+
+@app.get(ROOT + "/health")
+async def health() -> dict:
+    """
+    健康检查，返回当前排队、运行的请求数和当前worker的内存占用（最多缓存MEMORY_REPORT_TTL秒），推理在后台进行，不会被长时间的生成阻塞
+    """
+    return {'status': 'ok', **async_chat_bot.status(), 'admission': admission_controller.status(), 'memory': await get_cached_memory_report()}
+
 if __name__ == '__main__':
   
   # 加上reload参数（reload=True）时，多进程设置无效
@@ -0,0 +1,51 @@
+from dataclasses import replace
+
+import fire
+
+from model.backends import create_chat_bot
+from model.batch_inference import BatchGenerator
+from config import InferConfig
+
+
+def batch_infer(
+        input_file: str,
+        output_file: str,
+        prompt_key: str='prompt',
+        output_key: str='response',
+        expected_length_key: str=None,
+        search_type: str=None,
+        max_new_tokens: int=None,
+        max_batch_size: int=None,
+        chunk_size: int=None,
+        resume: bool=True,
+        backend: str=None,
+    ) -> None:
+    '''
+    离线批量生成：读取input_file（.jsonl、.json、.parquet）每条记录的prompt_key字段，按长度分桶批量生成，
+    原记录加上output_key字段写入output_file（.jsonl），每chunk_size条保存一次进度，中断后重新运行从断点继续
+    （输入文件或生成参数和上次不一致时报错，需要删除输出文件或设置--resume=False）。
+    未指定的参数使用InferConfig中的配置，结束后打印吞吐量（tokens/s）
+    '''
+    infer_config = InferConfig()
+    if backend is not None:
+        infer_config = replace(infer_config, backend=backend)
+
+    chat_bot = create_chat_bot(infer_config=infer_config)
+    generator = BatchGenerator(chat_bot, search_type=search_type, max_new_tokens=max_new_tokens, max_batch_size=max_batch_size)
+
+    stats = generator.run_file(
+                input_file,
+                output_file,
+                prompt_key=prompt_key,
+                output_key=output_key,
+                expected_length_key=expected_length_key,
+                chunk_size=infer_config.batch_chunk_size if chunk_size is None else chunk_size,
+                resume=resume,
+            )
+    print('saved to: {}, stats: {}'.format(output_file, stats))
+
+
+if __name__ == '__main__':
+    # 解析命令行参数，执行批量生成
+    # e.g: python batch_infer.py --input_file=./data/my_valid_dataset.parquet --output_file=./data/valid_outputs.jsonl
+    fire.Fire(component=batch_infer)
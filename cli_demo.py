@@ -6,11 +6,11 @@ from threading import Thread
 from rich.text import Text
 from rich.live import Live
 
-from model.infer import ChatBot
+from model.backends import create_chat_bot
 from config import InferConfig
 
 infer_config = InferConfig()
-chat_bot = ChatBot(infer_config=infer_config)
+chat_bot = create_chat_bot(infer_config=infer_config)
 
 clear_cmd = 'cls' if platform.system().lower() == 'windows' else 'clear'
 
@@ -44,6 +44,9 @@ def chat(stream: bool=True) -> None:
     history = []
     turn_count = 0
 
+    # 多轮对话，历史问答拼接到模型的输入
+    session = chat_bot.create_session()
+
     while True:
         print('\r\033[0;33;40m用户：\033[0m', end='', flush=True)
         input_txt = input()
@@ -60,6 +63,7 @@ def chat(stream: bool=True) -> None:
         if input_txt.lower() == 'cls':
             history = []
             turn_count = 0
+            session.clear()
             os.system(clear_cmd)
             print(welcome_txt)
             continue
@@ -69,7 +73,7 @@ def chat(stream: bool=True) -> None:
             thread = Thread(target=circle_print)
             thread.start()
 
-            outs = chat_bot.chat(input_txt)
+            outs = session.chat(input_txt)
 
             STOP_CIRCLE = True
             thread.join()
@@ -80,7 +84,7 @@ def chat(stream: bool=True) -> None:
 
         history.append([input_txt, ''])
         stream_txt = []
-        streamer = chat_bot.stream_chat(input_txt)
+        streamer = session.stream_chat(input_txt)
         rich_text = Text()
 
         print("\r\033[0;32;40mChatBot：\033[0m\n", end='')
@@ -91,6 +95,7 @@ def chat(stream: bool=True) -> None:
                 stream_txt.append(word)
 
         stream_txt = ''.join(stream_txt)
+        session.add_turn(input_txt, stream_txt)
 
         if len(stream_txt) == 0:
             stream_txt = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
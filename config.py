@@ -9,7 +9,64 @@ PROJECT_ROOT: str = '/'.join(abspath(dirname(__file__)).split('\\')) if '\\' in
 @dataclass
 class InferConfig:
     max_seq_len: int = 320                          # 回答的最大长度
-    mixed_precision: str = "fp16"                   # 混合精度 ''no','fp16','bf16' or 'fp8'
+    mixed_precision: str = "fp16"                   # 加载模型的精度 'no','fp16','bf16'，CPU上fp16使用fp32，bf16需要明确配置
+    # CPU量化推理，'no': 不量化，'dynamic_int8': 线性层动态int8量化
+    quantization: str = 'no'
+    quantize_embedding_bits: int = 0                # 共享embedding仅权重量化的位数，0: 不量化，8: int8，4: int4
+    quantized_model_file: str = PROJECT_ROOT + '/model_save/chat_small_t5.quantized.bin'    # 量化后的模型文件，量化参数和上面一致时直接加载，通过python model/quantize.py生成
+    # 多个worker共享内存的权重文件（单个safetensors文件，内存映射加载），存在时优先加载，通过python model/shared_weights.py生成
+    shared_weights_file: str = PROJECT_ROOT + '/model_save/chat_small_t5.shared.safetensors'
+    warmup: bool = True                             # 加载模型后先做一次很短的生成预热
+    draft_model_file: str = ''                      # 投机解码的草稿模型（DraftT5ModelConfig），如：PROJECT_ROOT + '/model_save/draft_t5.best.bin'，为空不使用投机解码
+    num_draft_tokens: int = 4                       # 投机解码每轮草稿模型生成的token数
+    # 推理后端（见model.backends），'torch': PyTorch eager，'compiled': torch.compile编译单步解码，'quantized': CPU动态int8量化，
+    # 'torchscript': 导出的TorchScript模型，不依赖transformers；逗号分隔多个时每个worker按进程id选择一个，如：'torch,torchscript'
+    backend: str = 'torch'
+    torchscript_dir: str = PROJECT_ROOT + '/model_save/torchscript'     # 导出的TorchScript模型文件夹，通过python model/export_torchscript.py生成
+    # torch.compile编译decoder单步解码（model.compiled_decode），用于非流式的批量生成，backend='compiled'时开启，
+    # 开启后api的非流式greedy请求按batch_mode='micro'处理（连续批处理引擎不使用编译的解码），流式输出不受影响
+    compile_decode: bool = False
+    compile_bucket_size: int = 64                   # 编译的形状分桶：KV cache长度、encoder输入长度向上取整到该值的整数倍
+    compile_mode: str = 'default'                   # torch.compile的mode：'default'、'reduce-overhead'、'max-autotune'
+    # 非流式生成（ChatBot.chat、generate_batch）中和greedy结果相同的生成方式使用预分配的静态KV cache（model.kv_cache.KVCachePool），
+    # 每步不再拼接past_key_values；连续批处理引擎（流式输出）的对应设置为kv_cache_mode='paged'，
+    # early_exit生成方式逐层调用T5Block，KV cache仍按transformers的方式拼接
+    static_kv_cache: bool = True
+    kv_cache_pool_mb: float = 512.0                 # 静态KV cache缓冲池中空闲缓冲的最大内存（MB）
+
+    generation_profile: str = 'greedy'              # 默认的生成方式（见model.generation_profiles），api请求可以用search_type指定其他生成方式
+    # 自定义生成方式的json文件，如：PROJECT_ROOT + '/data/generation_profiles.json'，为空不加载，格式见model.generation_profiles.load_profiles
+    generation_profiles_file: str = ''
+
+    max_batch_size: int = 16                        # 批量生成、连续批处理引擎同时解码的最大请求数
+    max_batch_tokens: int = 4096                    # 批量生成（长度分桶、动态批处理）一个batch填充后的最大token数
+    encoder_cache_mb: float = 0.0                   # encoder输出缓存的最大内存（MB），0表示不使用缓存（默认），重复prompt较多时可设为如256
+    encoder_cache_ttl: float = 3600.0               # encoder输出缓存的过期时间（秒），<=0表示不过期
+    response_cache_mb: float = 0.0                  # greedy回答缓存的最大内存（MB），0表示不使用缓存（默认，response_cache_file也不生效），如64
+    response_cache_file: str = ''                   # 回答缓存的sqlite文件，如：PROJECT_ROOT + '/data/response_cache.db'，为空不使用磁盘缓存
+    response_cache_file_mb: float = 1024.0          # 磁盘回答缓存的最大大小（MB）
+    # 连续批处理引擎的KV cache，'dynamic': 每步拼接（transformers的past_key_values），'paged': 分页KV cache（model.paged_engine），按块分配，没有填充
+    kv_cache_mode: str = 'dynamic'
+    kv_cache_paged_mb: float = 1024.0               # 分页KV cache的总内存上限（MB），块的存储按需扩容
+    kv_block_size: int = 16                         # 分页KV cache每块的位置数
+    stream_buffer_size: int = 64                    # 流式输出每个请求最多缓存的token块数
+    stream_stall_timeout: float = 10.0              # 流式输出缓存持续满超过该秒数，认为客户端已断开并取消生成
+
+    # 多轮对话配置
+    session_max_history_tokens: int = 256           # 历史对话和本轮问题拼接后encoder输入的最大token数，超出时丢弃最早的轮次
+    session_encode_mode: str = 'full'               # 'full': 拼接后完整过encoder；'segment': 每轮单独过encoder并缓存，新一轮只计算新增的token（近似）
+
+    # 异步推理配置
+    batch_mode: str = 'engine'                      # 'engine': 连续批处理引擎，'micro': 动态批处理后调用ChatBot.chat，'none': 线程池中逐个调用ChatBot.chat
+    micro_batch_wait_ms: float = 10.0               # 动态批处理收集请求的时间窗口（毫秒）
+    max_concurrency: int = 32                       # 同时推理的最大请求数
+    max_queue_size: int = 256                       # 排队等待的最大请求数，超出返回503
+    request_timeout: float = 60.0                   # 单个请求的超时时间（秒，包含排队时间）
+
+    # 批量生成配置（/api/chat/batch、batch_infer.py）
+    batch_max_inputs: int = 64                      # /api/chat/batch一次请求最多的prompt数，总开销还受admission_max_tokens限制
+    batch_request_timeout: float = 600.0            # 批量请求的超时时间（秒，包含排队时间）
+    batch_chunk_size: int = 1024                    # 离线批量生成每次读取、分桶生成并保存进度的记录数
 
     # 全量DPO模型文件
     model_dir: str = PROJECT_ROOT + '/model_save/'
@@ -19,6 +76,15 @@ class InferConfig:
     
     # this confing for api demo:
     api_key: str = ""
+    # 多个api key和各自的配额的json文件，如：PROJECT_ROOT + '/data/api_keys.json'，
+    # 格式：{"key": {"tokens_per_minute": 20000, "max_concurrency": 4}}，为空只使用api_key
+    api_keys_file: str = ''
+    api_key_tokens_per_minute: int = 0              # api key每分钟可以使用的token数（按请求开销估计），keys文件中没有配置时使用，0: 不限制
+    api_key_max_concurrency: int = 0                # api key同时处理的最大请求数，keys文件中没有配置时使用，0: 不限制
+    # 准入控制：每个请求的开销按 prompt token数 + 最大生成token数 估计
+    admission_max_tokens: int = 32768               # 已接受（排队和生成中）的请求的总开销上限，超出后新的请求排队等待，0: 不限制
+    admission_max_queue: int = 64                   # 超出开销上限后排队等待的最大请求数，超出返回503
+    admission_queue_timeout: float = 10.0           # 超出开销上限后排队等待的最长时间（秒），超时返回503
     host: str = '127.0.0.1'
     port: int = 8812
     reload: bool = True
@@ -136,4 +202,13 @@ class T5ModelConfig:
     d_kv: int = 64                          # d_model // num_heads， 默认：64, 大：64
 
     num_decoder_layers: int = 10            # Transformer decoder 隐藏层层数， 默认：6, 大：10
-    num_layers: int = 10                    # Transformer encoder 隐藏层层数，默认：6, 大：10
\ No newline at end of file
+    num_layers: int = 10                    # Transformer encoder 隐藏层层数，默认：6, 大：10
+
+
+@dataclass
+class DraftT5ModelConfig(T5ModelConfig):
+    '''
+    投机解码的草稿模型，和主模型共用tokenizer，层数更少，训练：python train.py train --draft
+    '''
+    num_decoder_layers: int = 2             # 每个token都要经过decoder，草稿模型的decoder尽量浅
+    num_layers: int = 4                     # encoder每个请求只计算一次
\ No newline at end of file
@@ -0,0 +1,242 @@
+import os
+import math
+import time
+import asyncio
+from collections import deque
+
+import ujson
+
+
+class AdmissionError(Exception):
+    def __init__(self, message: str, status_code: int, retry_after: float=None) -> None:
+        '''
+        请求未被接受，status_code: 429（api key超出配额）、503（服务器满载）、413（请求开销超过总预算，重试也不会被接受），
+        retry_after: 建议客户端重试的等待秒数，None表示不需要重试
+        '''
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, tokens_per_minute: int) -> None:
+        '''
+        每分钟tokens_per_minute个token的令牌桶，桶的容量为一分钟的配额，空闲时最多积累一分钟
+        '''
+        self.capacity = float(tokens_per_minute)
+        self.rate = tokens_per_minute / 60.0
+        self.tokens = self.capacity
+        self.last_time = time.monotonic()
+
+    def consume(self, cost: int) -> float:
+        '''
+        扣除cost个token，成功返回0，不够时不扣除，返回需要等待的秒数
+        '''
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0.0
+
+        return (cost - self.tokens) / self.rate
+
+    def refund(self, cost: int) -> None:
+        self.tokens = min(self.capacity, self.tokens + cost)
+
+
+class AdmissionTicket:
+    def __init__(self, controller: 'AdmissionController', cost: int, api_key: str) -> None:
+        '''
+        已接受的请求，处理结束（完成、失败、客户端断开）后调用release归还预算，多次调用只归还一次
+        '''
+        self.controller = controller
+        self.cost = cost
+        self.api_key = api_key
+        self.start_time = time.monotonic()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.controller.release(self)
+
+
+def load_api_keys(api_keys_file: str) -> dict[str, dict]:
+    '''
+    读取api key和各自的配额，json格式：{"key": {"tokens_per_minute": 20000, "max_concurrency": 4}}，
+    配额项可以省略，省略时使用AdmissionController的默认配额，文件为空或不存在返回{}
+    '''
+    if len(api_keys_file) == 0 or not os.path.exists(api_keys_file):
+        return {}
+
+    with open(api_keys_file, 'r', encoding='utf-8') as f:
+        return ujson.load(f)
+
+
+class AdmissionController:
+    def __init__(self,
+                max_inflight_tokens: int=32768,
+                max_queue_size: int=64,
+                queue_timeout: float=10.0,
+                api_key_quotas: dict[str, dict]=None,
+                default_tokens_per_minute: int=0,
+                default_max_concurrency: int=0,
+            ) -> None:
+        '''
+        api的准入控制，每个请求的开销按 prompt token数 + 最大生成token数 估计：
+        max_inflight_tokens: 已接受（排队和生成中）的请求的总开销上限，超出后新的请求按到达顺序排队，0表示不限制；
+        max_queue_size: 排队请求数上限，队列满时直接返回503；
+        queue_timeout: 排队的最长时间（秒），超时返回503；
+        api_key_quotas: 每个api key的配额，{key: {'tokens_per_minute': int, 'max_concurrency': int}}，
+            tokens_per_minute按估计的开销扣除，超出配额返回429，没有配置的项使用default_*，0表示不限制。
+        只在事件循环中调用，不需要加锁。
+        '''
+        self.max_inflight_tokens = max_inflight_tokens
+        self.max_queue_size = max_queue_size
+        self.queue_timeout = queue_timeout
+        self.api_key_quotas = api_key_quotas or {}
+        self.default_tokens_per_minute = default_tokens_per_minute
+        self.default_max_concurrency = default_max_concurrency
+
+        self.inflight_tokens = 0
+        self.inflight_requests = 0
+        self._waiting: deque[tuple[int, asyncio.Future]] = deque()
+        self._buckets: dict[str, TokenBucket] = {}
+        self._key_inflight: dict[str, int] = {}
+
+        # 最近请求的平均处理时间（指数移动平均），用于估计Retry-After
+        self.avg_latency = 1.0
+
+        self.stats = {'admitted': 0, 'queued': 0, 'rejected_quota': 0, 'rejected_queue': 0, 'rejected_timeout': 0, 'rejected_too_large': 0}
+
+    @staticmethod
+    def estimate_cost(prompt_tokens: int, max_new_tokens: int) -> int:
+        return prompt_tokens + max_new_tokens
+
+    def _quota(self, api_key: str, name: str) -> int:
+        default = self.default_tokens_per_minute if name == 'tokens_per_minute' else self.default_max_concurrency
+        return int(self.api_key_quotas.get(api_key, {}).get(name, default))
+
+    def _retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_latency))
+
+    def _check_quota(self, api_key: str, cost: int) -> None:
+        '''
+        检查并扣除api key的配额，超出时抛出429
+        '''
+        max_concurrency = self._quota(api_key, 'max_concurrency')
+        if max_concurrency > 0 and self._key_inflight.get(api_key, 0) >= max_concurrency:
+            self.stats['rejected_quota'] += 1
+            raise AdmissionError('too many concurrent requests for this api key, limit: {}.'.format(max_concurrency), 429, self._retry_after())
+
+        tokens_per_minute = self._quota(api_key, 'tokens_per_minute')
+        if tokens_per_minute > 0:
+            if cost > tokens_per_minute:
+                self.stats['rejected_quota'] += 1
+                raise AdmissionError('request cost {} tokens, exceeds the quota of {} tokens per minute.'.format(cost, tokens_per_minute), 429)
+
+            if api_key not in self._buckets:
+                self._buckets[api_key] = TokenBucket(tokens_per_minute)
+
+            wait = self._buckets[api_key].consume(cost)
+            if wait > 0:
+                self.stats['rejected_quota'] += 1
+                raise AdmissionError('token quota exceeded for this api key: {} tokens per minute.'.format(tokens_per_minute), 429, max(1, math.ceil(wait)))
+
+        self._key_inflight[api_key] = self._key_inflight.get(api_key, 0) + 1
+
+    def _undo_quota(self, api_key: str, cost: int) -> None:
+        self._key_inflight[api_key] -= 1
+        if api_key in self._buckets:
+            self._buckets[api_key].refund(cost)
+
+    def _fits(self, cost: int) -> bool:
+        return self.max_inflight_tokens <= 0 or self.inflight_tokens + cost <= self.max_inflight_tokens
+
+    def _wake(self) -> None:
+        '''
+        按到达顺序接受排队的请求，队首放不下时后面的请求也继续等待，长请求不会一直被短请求插队
+        '''
+        while len(self._waiting) > 0:
+            cost, future = self._waiting[0]
+            if future.done():
+                self._waiting.popleft()
+                continue
+            if not self._fits(cost):
+                break
+
+            self._waiting.popleft()
+            self.inflight_tokens += cost
+            future.set_result(None)
+
+    async def admit(self, cost: int, api_key: str=None) -> AdmissionTicket:
+        '''
+        接受一个开销为cost的请求，预算不够时排队等待，返回AdmissionTicket，不接受时抛出AdmissionError。
+        api_key为None（没有开启认证）时不检查配额
+        '''
+        if self.max_inflight_tokens > 0 and cost > self.max_inflight_tokens:
+            self.stats['rejected_too_large'] += 1
+            raise AdmissionError('request cost {} tokens, exceeds the server budget of {} tokens.'.format(cost, self.max_inflight_tokens), 413)
+
+        if api_key is not None:
+            self._check_quota(api_key, cost)
+
+        if len(self._waiting) == 0 and self._fits(cost):
+            self.inflight_tokens += cost
+        else:
+            if len(self._waiting) >= self.max_queue_size:
+                if api_key is not None:
+                    self._undo_quota(api_key, cost)
+                self.stats['rejected_queue'] += 1
+                raise AdmissionError('server is busy, {} requests waiting, please retry later.'.format(len(self._waiting)), 503, self._retry_after())
+
+            future = asyncio.get_running_loop().create_future()
+            self._waiting.append((cost, future))
+            self.stats['queued'] += 1
+
+            try:
+                await asyncio.wait_for(future, timeout=self.queue_timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+                # 超时和被接受同时发生时，已经占用的预算需要归还
+                if future.done() and not future.cancelled():
+                    self.inflight_tokens -= cost
+                elif (cost, future) in self._waiting:
+                    self._waiting.remove((cost, future))
+                if api_key is not None:
+                    self._undo_quota(api_key, cost)
+                self._wake()
+
+                if isinstance(e, asyncio.CancelledError):
+                    raise
+                self.stats['rejected_timeout'] += 1
+                raise AdmissionError('server is busy, waited {} seconds, please retry later.'.format(self.queue_timeout), 503, self._retry_after())
+
+        self.inflight_requests += 1
+        self.stats['admitted'] += 1
+
+        return AdmissionTicket(self, cost, api_key)
+
+    def release(self, ticket: AdmissionTicket) -> None:
+        '''
+        归还请求的预算，并接受排队的请求。由AdmissionTicket.release调用
+        '''
+        self.inflight_tokens -= ticket.cost
+        self.inflight_requests -= 1
+        if ticket.api_key is not None:
+            self._key_inflight[ticket.api_key] -= 1
+
+        self.avg_latency = 0.9 * self.avg_latency + 0.1 * (time.monotonic() - ticket.start_time)
+        self._wake()
+
+    def status(self) -> dict:
+        return {
+            'inflight_tokens': self.inflight_tokens,
+            'inflight_requests': self.inflight_requests,
+            'waiting': len(self._waiting),
+            'max_inflight_tokens': self.max_inflight_tokens,
+            'max_queue_size': self.max_queue_size,
+            'avg_latency': round(self.avg_latency, 3),
+            **self.stats,
+        }
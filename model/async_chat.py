@@ -0,0 +1,363 @@
+import time
+import asyncio
+from queue import Empty
+from functools import partial
+from typing import AsyncIterator, Awaitable, Callable, TYPE_CHECKING
+from concurrent.futures import ThreadPoolExecutor
+
+from model.micro_batcher import MicroBatcher
+from model.stopping import DeadlineStoppingCriteria
+from model.batch_inference import BatchGenerator
+from config import InferConfig
+
+# 只用于类型标注，导出模型的运行时（backend='torchscript'）不import transformers
+if TYPE_CHECKING:
+    from model.infer import ChatBot
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class ClientDisconnectedError(Exception):
+    pass
+
+
+class AsyncChatBot:
+    def __init__(self, chat_bot: 'ChatBot', infer_config: InferConfig) -> None:
+        '''
+        ChatBot（或TorchScriptChatBot）的异步封装，推理不会阻塞事件循环。
+        max_concurrency: 同时在推理的请求数，超出的请求排队等待；
+        max_queue_size: 排队请求数上限，队列满时直接抛出QueueFullError，由调用方返回503；
+        request_timeout: 单个请求（含排队时间）的超时秒数，超时抛出asyncio.TimeoutError并取消生成。
+        batch_mode: 'engine'请求提交到连续批处理引擎，'micro'通过MicroBatcher合并请求后批量生成，
+        'none'放到线程池中逐个调用chat_bot.chat；连续批处理引擎使用eager解码，chat_bot开启了编译的单步解码（backend='compiled'）时，
+        'engine'模式下非流式的greedy请求改为'micro'，经过generate_batch使用编译的解码，流式输出仍然使用引擎；
+        引擎和MicroBatcher只做greedy search，其他生成方式（search_type）的请求都放到线程池中调用chat_bot.chat，
+        线程池中的生成通过DeadlineStoppingCriteria在超时、超过截止时间或客户端断开后的下一个解码步停止
+        '''
+        if infer_config.batch_mode not in ('engine', 'micro', 'none'):
+            raise ValueError("batch_mode must be one of 'engine', 'micro', 'none', got: {}".format(infer_config.batch_mode))
+
+        self.chat_bot = chat_bot
+        self.batch_mode = infer_config.batch_mode
+        if self.batch_mode == 'engine' and getattr(chat_bot, 'compiled_generator', None) is not None:
+            self.batch_mode = 'micro'
+        self.max_concurrency = infer_config.max_concurrency
+        self.max_queue_size = infer_config.max_queue_size
+        self.request_timeout = infer_config.request_timeout
+        self.batch_request_timeout = infer_config.batch_request_timeout
+
+        # asyncio.Semaphore在第一次使用时绑定事件循环，uvicorn每个进程只有一个事件循环
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='chat-bot')
+        self.micro_batcher = None
+        if self.batch_mode == 'micro':
+            self.micro_batcher = MicroBatcher(
+                chat_bot=chat_bot,
+                max_wait_ms=infer_config.micro_batch_wait_ms,
+                max_batch_size=infer_config.max_batch_size,
+                max_batch_tokens=infer_config.max_batch_tokens,
+            )
+
+        self.num_waiting = 0
+        self.num_running = 0
+        self.stats = {'finished': 0, 'rejected': 0, 'timeout': 0, 'failed': 0, 'disconnected': 0}
+
+    def check_queue(self) -> None:
+        '''
+        排队请求数达到上限时抛出QueueFullError
+        '''
+        if self.num_waiting >= self.max_queue_size:
+            self.stats['rejected'] += 1
+            raise QueueFullError('too many requests waiting, queue size: {}'.format(self.num_waiting))
+
+    def get_timeout(self, deadline: float=None, request_timeout: float=None) -> float:
+        '''
+        请求剩余的时间（秒）：request_timeout（None时为InferConfig.request_timeout）和截止时间（unix时间戳）中较早的一个
+        '''
+        request_timeout = self.request_timeout if request_timeout is None else request_timeout
+        if deadline is None:
+            return request_timeout
+        return min(request_timeout, deadline - time.time())
+
+    async def chat(self,
+                input_txt: str,
+                search_type: str=None,
+                max_new_tokens: int=None,
+                deadline: float=None,
+                is_disconnected: Callable[[], Awaitable[bool]]=None,
+            ) -> str:
+        '''
+        异步非流式对话，search_type: 生成方式的名称，None时使用InferConfig.generation_profile；
+        max_new_tokens: 最多生成的token数，None时为InferConfig.max_seq_len；
+        deadline: 截止时间（unix时间戳），和request_timeout一起决定超时，已经过了截止时间时直接抛出asyncio.TimeoutError；
+        is_disconnected: 检查客户端是否已断开的协程函数，断开时取消生成并抛出ClientDisconnectedError
+        '''
+        self.check_queue()
+        profile = self.chat_bot.get_profile(search_type)
+        timeout = self.get_timeout(deadline)
+
+        try:
+            if timeout <= 0:
+                raise asyncio.TimeoutError('deadline exceeded before the request started.')
+            return await asyncio.wait_for(self._chat(input_txt, profile.name, profile.is_greedy, max_new_tokens, time.time() + timeout, is_disconnected), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeout'] += 1
+            raise
+        except (asyncio.CancelledError, ClientDisconnectedError):
+            raise
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+
+    async def _chat(self,
+                input_txt: str,
+                search_type: str,
+                is_greedy: bool,
+                max_new_tokens: int,
+                deadline: float,
+                is_disconnected: Callable[[], Awaitable[bool]],
+            ) -> str:
+        self.num_waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.num_waiting -= 1
+
+        self.num_running += 1
+        stopping_criteria = None
+        try:
+            if self.batch_mode == 'engine' and is_greedy:
+                # asyncio的future被取消（超时、客户端断开）时，会同时取消引擎中的请求
+                future = asyncio.wrap_future(self.chat_bot.submit(input_txt, max_new_tokens=max_new_tokens))
+            elif self.batch_mode == 'micro' and is_greedy and max_new_tokens is None:
+                future = asyncio.wrap_future(self.micro_batcher.submit(input_txt))
+            else:
+                # 线程中的生成不能通过取消future停止，由停止条件在下一个解码步停止
+                stopping_criteria = DeadlineStoppingCriteria(deadline=deadline)
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(
+                    self._executor,
+                    partial(self.chat_bot.chat, input_txt, search_type=search_type, max_new_tokens=max_new_tokens, stopping_criteria=[stopping_criteria]),
+                )
+
+            outs = await self._wait(future, is_disconnected)
+        except BaseException:
+            if stopping_criteria is not None:
+                stopping_criteria.cancel()
+            raise
+        finally:
+            self.num_running -= 1
+            self._semaphore.release()
+
+        self.stats['finished'] += 1
+        return outs
+
+    async def generate_batch(self,
+                input_txts: list[str],
+                search_type: str=None,
+                max_new_tokens: int=None,
+                deadline: float=None,
+                is_disconnected: Callable[[], Awaitable[bool]]=None,
+            ) -> tuple[list[str], dict]:
+        '''
+        异步批量生成，整个batch占用一个并发数，在线程池中按长度分桶后批量生成（model.batch_inference.BatchGenerator），
+        超时使用InferConfig.batch_request_timeout，超时、超过截止时间或客户端断开后在下一个解码步停止。
+        返回按输入顺序的回答（空回答不做替换）和吞吐量统计
+        '''
+        self.check_queue()
+        profile = self.chat_bot.get_profile(search_type)
+        timeout = self.get_timeout(deadline, self.batch_request_timeout)
+
+        try:
+            if timeout <= 0:
+                raise asyncio.TimeoutError('deadline exceeded before the request started.')
+            return await asyncio.wait_for(self._generate_batch(input_txts, profile.name, max_new_tokens, time.time() + timeout, is_disconnected), timeout=timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeout'] += 1
+            raise
+        except (asyncio.CancelledError, ClientDisconnectedError):
+            raise
+        except Exception:
+            self.stats['failed'] += 1
+            raise
+
+    async def _generate_batch(self,
+                input_txts: list[str],
+                search_type: str,
+                max_new_tokens: int,
+                deadline: float,
+                is_disconnected: Callable[[], Awaitable[bool]],
+            ) -> tuple[list[str], dict]:
+        self.num_waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.num_waiting -= 1
+
+        self.num_running += 1
+        generator = BatchGenerator(self.chat_bot, search_type=search_type, max_new_tokens=max_new_tokens)
+        stopping_criteria = DeadlineStoppingCriteria(deadline=deadline)
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self._executor, partial(generator.generate, input_txts, stopping_criteria=[stopping_criteria]))
+            outputs = await self._wait(future, is_disconnected)
+        except BaseException:
+            stopping_criteria.cancel()
+            raise
+        finally:
+            self.num_running -= 1
+            self._semaphore.release()
+
+        self.stats['finished'] += 1
+        return outputs, generator.get_stats()
+
+    async def _wait(self, future: asyncio.Future, is_disconnected: Callable[[], Awaitable[bool]]) -> str:
+        '''
+        等待生成结果，每0.5秒检查一次客户端是否断开，断开或等待被取消（超时）时取消future
+        '''
+        try:
+            while True:
+                done, _ = await asyncio.wait({future}, timeout=0.5)
+                if len(done) > 0:
+                    return future.result()
+
+                if is_disconnected is not None and await is_disconnected():
+                    self.stats['disconnected'] += 1
+                    raise ClientDisconnectedError('client disconnected.')
+        finally:
+            if not future.done():
+                future.cancel()
+
+    async def stream_chat(self,
+                input_txt: str,
+                is_disconnected: Callable[[], Awaitable[bool]]=None,
+                max_new_tokens: int=None,
+                deadline: float=None,
+            ) -> AsyncIterator[str]:
+        '''
+        异步流式对话，逐段返回生成的文本。streamer有新的输出时通过call_soon_threadsafe唤醒事件循环，
+        读取streamer不阻塞，不占用线程池的线程，同时流式输出的请求数只受max_concurrency限制。
+        is_disconnected: 检查客户端是否已断开的协程函数，断开、超时（request_timeout或截止时间deadline）或迭代器被关闭时取消生成。
+        超时（包括排队超时）抛出asyncio.TimeoutError，已经输出的文本是不完整的回答
+        '''
+        self.check_queue()
+
+        loop = asyncio.get_running_loop()
+        timeout = self.get_timeout(deadline)
+        deadline = loop.time() + timeout
+
+        self.num_waiting += 1
+        try:
+            await self._acquire(timeout)
+        except asyncio.TimeoutError:
+            self.stats['timeout'] += 1
+            raise
+        finally:
+            self.num_waiting -= 1
+
+        streamer = None
+        new_output = asyncio.Event()
+
+        def notify() -> None:
+            try:
+                loop.call_soon_threadsafe(new_output.set)
+            except RuntimeError:
+                # 事件循环已经关闭
+                pass
+
+        self.num_running += 1
+        try:
+            streamer = self.chat_bot.stream_chat(input_txt, max_new_tokens=max_new_tokens)
+            streamer.set_notify(notify)
+
+            while True:
+                if loop.time() > deadline:
+                    self.stats['timeout'] += 1
+                    raise asyncio.TimeoutError('stream generate timeout.')
+
+                # 先清除再读取，读取之后到达的输出会重新set，不会漏掉
+                new_output.clear()
+                try:
+                    text = streamer.next_text(timeout=0.0)
+                except Empty:
+                    try:
+                        await asyncio.wait_for(new_output.wait(), timeout=max(0.0, min(0.5, deadline - loop.time())))
+                    except asyncio.TimeoutError:
+                        if is_disconnected is not None and await is_disconnected():
+                            break
+                    continue
+
+                if text is None:
+                    self.stats['finished'] += 1
+                    break
+
+                yield text
+        finally:
+            if streamer is not None:
+                streamer.cancel()
+            self.num_running -= 1
+            self._semaphore.release()
+
+    async def _acquire(self, timeout: float) -> None:
+        '''
+        在timeout秒内获取一个并发数，超时抛出asyncio.TimeoutError。
+        不使用asyncio.wait_for：Python 3.12之前，获取成功和超时同时发生时wait_for会抛出超时，已经获取的并发数不会被归还。
+        这里超时或被取消时先取消获取的任务（Semaphore.acquire被取消时不会占用并发数），任务已经获取成功时归还
+        '''
+        acquire = asyncio.ensure_future(self._semaphore.acquire())
+        try:
+            await asyncio.wait([acquire], timeout=max(timeout, 0.0))
+        except BaseException:
+            if acquire.done() and not acquire.cancelled():
+                self._semaphore.release()
+            else:
+                acquire.cancel()
+            raise
+
+        if not acquire.done():
+            acquire.cancel()
+            raise asyncio.TimeoutError('wait for concurrency timeout.')
+
+    def status(self) -> dict:
+        '''
+        当前排队、运行的请求数和统计信息
+        '''
+        status = {
+            'backend': getattr(self.chat_bot, 'backend_name', None),
+            'waiting': self.num_waiting,
+            'running': self.num_running,
+            'max_concurrency': self.max_concurrency,
+            'max_queue_size': self.max_queue_size,
+            **self.stats,
+        }
+
+        engine = self.chat_bot.engine
+        if engine is not None:
+            status['engine'] = {'running': engine.num_running, 'waiting': engine.num_waiting, **engine.stats}
+            if hasattr(engine, 'get_kv_stats'):
+                status['engine']['kv_cache'] = engine.get_kv_stats()
+
+        if self.chat_bot.encoder_cache is not None:
+            status['encoder_cache'] = self.chat_bot.encoder_cache.stats()
+
+        if self.chat_bot.response_cache is not None:
+            status['response_cache'] = self.chat_bot.response_cache.stats()
+
+        if self.micro_batcher is not None:
+            status['micro_batcher'] = dict(self.micro_batcher.stats)
+
+        if self.chat_bot.speculative_decoder is not None:
+            status['speculative'] = self.chat_bot.speculative_decoder.get_stats()
+
+        if self.chat_bot.compiled_generator is not None:
+            status['compiled'] = self.chat_bot.compiled_generator.get_stats()
+
+        static_generator = self.chat_bot.static_generator
+        if static_generator is not None and static_generator is not self.chat_bot.compiled_generator:
+            status['static_kv_cache'] = static_generator.get_stats()
+
+        status['profiles'] = self.chat_bot.profile_metrics.get_stats()
+
+        return status
@@ -0,0 +1,99 @@
+import os
+from dataclasses import replace
+from typing import Callable
+
+from config import InferConfig
+
+# 推理后端注册表：名称 -> 创建对象的函数(infer_config)。
+# 所有后端创建的对象接口相同（和ChatBot一致），api_demo、cli_demo、AsyncChatBot、ChatSession不需要区分后端：
+#   tokenizer, encode(text).input_ids, batch_decode(ids_list, ...)  编码、解码
+#   chat(str | list[str], search_type, max_new_tokens, stopping_criteria),
+#   generate_batch(list[str], max_batch_size, max_batch_tokens, expected_output_lens, search_type, max_new_tokens, stopping_criteria, profile_metrics)
+#                                                                     非流式生成（按长度分桶批量生成），search_type为生成方式的名称
+#   get_profile(search_type) -> GenerationProfile, profile_metrics    生成方式和按生成方式统计的延迟、吞吐量
+#   stream_chat(str, max_new_tokens) -> TokenStreamer, submit(str, max_new_tokens) -> Future  流式生成、异步提交
+#   get_engine().submit(input_ids, max_new_tokens, streamer, encoder_hidden_states)
+#   create_session(), infer_config, engine, encoder_cache, response_cache, speculative_decoder, compiled_generator, static_generator
+# 各后端的模块在创建时才import，如torchscript后端不会import transformers。
+BACKENDS: dict[str, Callable[[InferConfig], object]] = {}
+
+
+def register_backend(name: str) -> Callable:
+    '''
+    注册推理后端的装饰器，e.g:
+    @register_backend('my_backend')
+    def create_my_backend(infer_config: InferConfig) -> MyChatBot: ...
+    '''
+    def decorator(create_fn: Callable[[InferConfig], object]) -> Callable[[InferConfig], object]:
+        if name in BACKENDS:
+            raise ValueError('backend {} is already registered.'.format(name))
+        BACKENDS[name] = create_fn
+        return create_fn
+
+    return decorator
+
+
+@register_backend('torch')
+def create_torch_backend(infer_config: InferConfig):
+    '''
+    PyTorch eager推理，精度、量化等按InferConfig的配置
+    '''
+    from model.infer import ChatBot
+    return ChatBot(infer_config=infer_config)
+
+
+@register_backend('compiled')
+def create_compiled_backend(infer_config: InferConfig):
+    '''
+    PyTorch推理，非流式生成使用torch.compile编译的decoder单步解码，启动时预热编译。
+    连续批处理引擎不使用编译的解码：AsyncChatBot在batch_mode='engine'时把非流式的greedy请求改为动态批处理（'micro'），
+    流式输出仍然由引擎eager解码，只做流式输出的服务使用该后端没有加速，只增加启动时的编译时间
+    '''
+    from model.infer import ChatBot
+    return ChatBot(infer_config=replace(infer_config, compile_decode=True))
+
+
+@register_backend('quantized')
+def create_quantized_backend(infer_config: InferConfig):
+    '''
+    CPU动态int8量化推理，InferConfig.quantization为'no'时使用'dynamic_int8'
+    '''
+    from model.infer import ChatBot
+    if infer_config.quantization == 'no':
+        infer_config = replace(infer_config, quantization='dynamic_int8')
+    return ChatBot(infer_config=infer_config)
+
+
+@register_backend('torchscript')
+def create_torchscript_backend(infer_config: InferConfig):
+    '''
+    导出的TorchScript模型（python model/export_torchscript.py），不依赖transformers
+    '''
+    from model.torchscript_runtime import TorchScriptChatBot
+    return TorchScriptChatBot(infer_config=infer_config)
+
+
+def select_backend(backend: str) -> str:
+    '''
+    InferConfig.backend可以是逗号分隔的多个后端（如'torch,torchscript'），用于多个worker对比吞吐量（A/B测试），
+    每个worker按进程id选择其中一个，同一个进程多次调用结果相同
+    '''
+    names = [name.strip() for name in backend.split(',') if len(name.strip()) > 0]
+    if len(names) == 0:
+        raise ValueError('InferConfig.backend is empty.')
+
+    return names[os.getpid() % len(names)]
+
+
+def create_chat_bot(infer_config: InferConfig):
+    '''
+    按InferConfig.backend创建推理后端，创建的对象记录后端名称：chat_bot.backend_name
+    '''
+    name = select_backend(infer_config.backend)
+    if name not in BACKENDS:
+        raise ValueError('unknown backend: {}, available backends: {}'.format(name, list(BACKENDS.keys())))
+
+    chat_bot = BACKENDS[name](infer_config)
+    chat_bot.backend_name = name
+
+    return chat_bot
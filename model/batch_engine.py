@@ -0,0 +1,435 @@
+import time
+import itertools
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from concurrent.futures import Future, InvalidStateError
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+from transformers.modeling_outputs import BaseModelOutput
+
+from model.chat_model import TextToTextModel
+from model.streamer import TokenStreamer
+from model.bucketing import pad_batch, pad_hidden_states
+from model.cache import EncoderCache
+
+
+class GenerationRequest:
+    def __init__(self, request_id: int, input_ids: list[int], max_new_tokens: int, streamer: TokenStreamer=None, encoder_hidden_states: Tensor=None) -> None:
+        '''
+        引擎内部的单个生成请求，future的结果为生成的token id列表（不含decoder_start_token）
+        streamer不为None时，每生成一个token都会写入streamer；
+        encoder_hidden_states不为None时（未填充的(seq_len, d_model)），不再计算input_ids的encoder输出
+        '''
+        self.request_id = request_id
+        self.input_ids = input_ids
+        self.max_new_tokens = max_new_tokens
+        self.streamer = streamer
+        self.encoder_hidden_states = encoder_hidden_states
+        self.future = Future()
+        self.output_ids = []
+        self.submit_time = time.time()
+
+    def is_finished(self, eos_token_id: int) -> bool:
+        if len(self.output_ids) == 0:
+            return False
+        return self.output_ids[-1] == eos_token_id or len(self.output_ids) >= self.max_new_tokens
+
+    def is_cancelled(self) -> bool:
+        return self.future.cancelled() or (self.streamer is not None and self.streamer.cancelled)
+
+    def finish(self) -> None:
+        # future一直保持pending状态直到生成结束，调用方可以随时future.cancel()取消请求
+        try:
+            if not self.future.done():
+                self.future.set_result(self.output_ids)
+        except InvalidStateError:
+            pass
+
+        if self.streamer is not None:
+            self.streamer.end()
+
+    def fail(self, exception: Exception) -> None:
+        try:
+            if not self.future.done():
+                self.future.set_exception(exception)
+        except InvalidStateError:
+            pass
+
+        if self.streamer is not None:
+            self.streamer.end(exception)
+
+
+class ContinuousBatchingEngine:
+    def __init__(self,
+                model: TextToTextModel,
+                max_batch_size: int=16,
+                max_new_tokens: int=320,
+                eos_token_id: int=1,
+                pad_token_id: int=0,
+                encoder_cache: EncoderCache=None,
+            ) -> None:
+        '''
+        连续批处理（iteration-level batching）推理引擎，仅支持greedy search。
+        后台线程每个解码步都会把新请求加入正在运行的decoder batch（新请求的encoder一起批量计算），
+        生成[EOS]或达到max_new_tokens的序列立即退出batch，future返回结果。
+
+        decoder的self-attention KV cache左填充对齐，T5的相对位置编码只与相对距离有关，左填充不影响结果；
+        encoder输出和cross-attention KV cache右填充对齐，通过attention_mask屏蔽。
+        encoder_cache不为None时，新请求的encoder输出优先从缓存中取。
+        '''
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_new_tokens = max_new_tokens
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.encoder_cache = encoder_cache
+        self.decoder_start_token_id = model.config.decoder_start_token_id
+
+        self._waiting = Queue()
+        self._request_counter = itertools.count()
+        self._stop_event = Event()
+        self._lock = Lock()
+        self._thread = None
+
+        # 运行中的batch状态
+        self._requests: list[GenerationRequest] = []
+        self._encoder_hidden_states: Tensor = None  # (batch, enc_len, d_model)
+        self._encoder_attention_mask: Tensor = None # (batch, enc_len)
+        self._decoder_attention_mask: Tensor = None # (batch, dec_len)
+        self._past_key_values: tuple = None         # 每层: (self_k, self_v, cross_k, cross_v)
+        self._last_tokens: Tensor = None            # (batch, 1)
+
+        self.stats = {'steps': 0, 'finished': 0, 'cancelled': 0, 'admitted': 0, 'generated_tokens': 0, 'max_running': 0, 'peak_kv_mb': 0.0}
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    @property
+    def num_running(self) -> int:
+        return len(self._requests)
+
+    @property
+    def num_waiting(self) -> int:
+        return self._waiting.qsize()
+
+    def start(self) -> None:
+        '''
+        启动后台调度线程，重复调用无副作用
+        '''
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = Thread(target=self._loop, name='continuous-batching-engine', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float=None) -> None:
+        '''
+        停止后台线程，未完成的请求会收到RuntimeError
+        '''
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+        self._fail_all(RuntimeError('continuous batching engine stopped.'))
+
+    def submit(self, input_ids: list[int], max_new_tokens: int=None, streamer: TokenStreamer=None, encoder_hidden_states: Tensor=None) -> Future:
+        '''
+        提交一个请求，input_ids需已包含[EOS]，返回concurrent.futures.Future，
+        结果为生成的token id列表，可在asyncio中通过asyncio.wrap_future等待。
+        调用future.cancel()或streamer.cancel()后，请求会在下一个解码步退出batch。
+        encoder_hidden_states: 调用方已经计算好的encoder输出（如多轮对话按轮缓存的encoder输出），形状(seq_len, d_model)
+        '''
+        if len(input_ids) == 0:
+            raise ValueError('input_ids must not be empty.')
+
+        max_new_tokens = self.max_new_tokens if max_new_tokens is None else min(max_new_tokens, self.max_new_tokens)
+        request = GenerationRequest(next(self._request_counter), list(input_ids), max_new_tokens, streamer, encoder_hidden_states)
+        self._waiting.put(request)
+        self.start()
+
+        return request.future
+
+    def _loop(self) -> None:
+        while not self._stop_event.is_set():
+            try:
+                new_requests = self._take_waiting()
+                if len(new_requests) > 0:
+                    self._admit(new_requests)
+
+                if len(self._requests) > 0:
+                    self._step()
+            except Exception as e:
+                self._fail_all(e)
+
+    def _take_waiting(self) -> list[GenerationRequest]:
+        '''
+        取出等待队列中的请求，batch为空时阻塞等待，避免空转
+        '''
+        new_requests = []
+        capacity = self.max_batch_size - len(self._requests)
+
+        if len(self._requests) == 0:
+            try:
+                new_requests.append(self._waiting.get(timeout=0.1))
+            except Empty:
+                return new_requests
+
+        while len(new_requests) < capacity:
+            try:
+                new_requests.append(self._waiting.get_nowait())
+            except Empty:
+                break
+
+        running_requests = []
+        for req in new_requests:
+            # 排队期间已经被取消
+            if req.is_cancelled():
+                req.finish()
+                self.stats['cancelled'] += 1
+                continue
+
+            running_requests.append(req)
+
+        return running_requests
+
+    @torch.no_grad()
+    def _admit(self, new_requests: list[GenerationRequest]) -> None:
+        '''
+        新请求批量过encoder并解码第一个token，然后合并到运行中的batch
+        '''
+        encoder_hidden_states, attention_mask = self._encode(new_requests)
+        decoder_input_ids = torch.full((len(new_requests), 1), self.decoder_start_token_id, dtype=torch.long, device=self.device)
+
+        outputs = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        next_tokens = outputs.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+        decoder_attention_mask = torch.ones_like(decoder_input_ids)
+
+        self.stats['admitted'] += len(new_requests)
+
+        if len(self._requests) == 0:
+            self._requests = new_requests
+            self._encoder_hidden_states = encoder_hidden_states
+            self._encoder_attention_mask = attention_mask
+            self._decoder_attention_mask = decoder_attention_mask
+            self._past_key_values = outputs.past_key_values
+            self._last_tokens = next_tokens
+        else:
+            self._merge(new_requests, encoder_hidden_states, attention_mask, decoder_attention_mask, outputs.past_key_values, next_tokens)
+
+        self._update_and_retire(next_tokens, offset=len(self._requests) - len(new_requests))
+
+    def _encode(self, new_requests: list[GenerationRequest]) -> tuple[Tensor, Tensor]:
+        '''
+        计算新请求的encoder输出（右填充），已经带有encoder_hidden_states的请求直接使用
+        '''
+        miss_index = [i for i, req in enumerate(new_requests) if req.encoder_hidden_states is None]
+        if len(miss_index) == 0:
+            return pad_hidden_states([req.encoder_hidden_states.to(self.device) for req in new_requests])
+
+        batch_input_ids = [new_requests[i].input_ids for i in miss_index]
+        if self.encoder_cache is not None:
+            encoder_hidden_states, attention_mask = self.encoder_cache.encode(self.model, batch_input_ids, pad_token_id=self.pad_token_id)
+        else:
+            input_ids, attention_mask = pad_batch(batch_input_ids, pad_token_id=self.pad_token_id)
+            input_ids = input_ids.to(self.device)
+            attention_mask = attention_mask.to(self.device)
+
+            encoder_hidden_states = self.model.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+        if len(miss_index) == len(new_requests):
+            return encoder_hidden_states, attention_mask
+
+        hidden_list = [req.encoder_hidden_states for req in new_requests]
+        for j, i in enumerate(miss_index):
+            hidden_list[i] = encoder_hidden_states[j, : len(new_requests[i].input_ids)]
+
+        return pad_hidden_states([hidden.to(self.device) for hidden in hidden_list])
+
+    def _merge(self,
+                new_requests: list[GenerationRequest],
+                encoder_hidden_states: Tensor,
+                encoder_attention_mask: Tensor,
+                decoder_attention_mask: Tensor,
+                past_key_values: tuple,
+                next_tokens: Tensor,
+            ) -> None:
+        '''
+        合并新请求到运行中的batch：self-attention KV左填充，encoder输出、cross-attention KV右填充
+        '''
+        enc_len = max(self._encoder_hidden_states.shape[1], encoder_hidden_states.shape[1])
+        dec_len = max(self._decoder_attention_mask.shape[1], decoder_attention_mask.shape[1])
+
+        def pad_to(x: Tensor, length: int, dim_pad: tuple) -> Tensor:
+            diff = length - x.shape[dim_pad[0]]
+            return x if diff == 0 else F.pad(x, dim_pad[1](diff))
+
+        # (batch, seq_len, d_model) / (batch, seq_len) / (batch, n_heads, seq_len, d_kv)
+        hidden_pad = (1, lambda d: (0, 0, 0, d))
+        mask_right_pad = (1, lambda d: (0, d))
+        mask_left_pad = (1, lambda d: (d, 0))
+        kv_right_pad = (2, lambda d: (0, 0, 0, d))
+        kv_left_pad = (2, lambda d: (0, 0, d, 0))
+
+        self._encoder_hidden_states = torch.cat([
+            pad_to(self._encoder_hidden_states, enc_len, hidden_pad),
+            pad_to(encoder_hidden_states, enc_len, hidden_pad),
+        ], dim=0)
+        self._encoder_attention_mask = torch.cat([
+            pad_to(self._encoder_attention_mask, enc_len, mask_right_pad),
+            pad_to(encoder_attention_mask, enc_len, mask_right_pad),
+        ], dim=0)
+        self._decoder_attention_mask = torch.cat([
+            pad_to(self._decoder_attention_mask, dec_len, mask_left_pad),
+            pad_to(decoder_attention_mask, dec_len, mask_left_pad),
+        ], dim=0)
+
+        merged_past = []
+        for old_layer, new_layer in zip(self._past_key_values, past_key_values):
+            layer = []
+            for i, (old, new) in enumerate(zip(old_layer, new_layer)):
+                length, pad = (dec_len, kv_left_pad) if i < 2 else (enc_len, kv_right_pad)
+                layer.append(torch.cat([pad_to(old, length, pad), pad_to(new, length, pad)], dim=0))
+            merged_past.append(tuple(layer))
+
+        self._past_key_values = tuple(merged_past)
+        self._last_tokens = torch.cat([self._last_tokens, next_tokens], dim=0)
+        self._requests = self._requests + new_requests
+
+    @torch.no_grad()
+    def _step(self) -> None:
+        '''
+        运行中的batch解码一步
+        '''
+        batch_size = len(self._requests)
+        self._decoder_attention_mask = torch.cat([
+                self._decoder_attention_mask,
+                self._decoder_attention_mask.new_ones((batch_size, 1)),
+            ], dim=1)
+
+        outputs = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=self._encoder_hidden_states),
+            attention_mask=self._encoder_attention_mask,
+            decoder_input_ids=self._last_tokens,
+            decoder_attention_mask=self._decoder_attention_mask,
+            past_key_values=self._past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+
+        self._past_key_values = outputs.past_key_values
+        self._last_tokens = outputs.logits[:, -1, :].argmax(dim=-1, keepdim=True)
+        self.stats['peak_kv_mb'] = max(self.stats['peak_kv_mb'], self._kv_mb())
+
+        self.stats['steps'] += 1
+        self.stats['max_running'] = max(self.stats['max_running'], batch_size)
+
+        self._update_and_retire(self._last_tokens, offset=0)
+
+    def _kv_mb(self) -> float:
+        past_key_values = self._past_key_values
+        if past_key_values is None:
+            return 0.0
+        return round(sum(kv.numel() * kv.element_size() for layer in past_key_values for kv in layer) / 1024 / 1024, 2)
+
+    def get_kv_stats(self) -> dict:
+        '''
+        运行中的batch按最长序列填充的KV cache（所有层的self-attention和cross-attention）占用的内存和最大值
+        '''
+        return {'kv_mb': self._kv_mb(), 'peak_kv_mb': self.stats['peak_kv_mb']}
+
+    def _update_and_retire(self, next_tokens: Tensor, offset: int) -> None:
+        '''
+        记录新生成的token，结束的序列从batch中移除并返回结果
+        '''
+        tokens = next_tokens.view(-1).tolist()
+        for i, token in enumerate(tokens):
+            req = self._requests[offset + i]
+            req.output_ids.append(token)
+            if req.streamer is not None:
+                req.streamer.put([token])
+        self.stats['generated_tokens'] += len(tokens)
+
+        keep = []
+        for i, req in enumerate(self._requests):
+            if req.is_finished(self.eos_token_id):
+                req.finish()
+                self.stats['finished'] += 1
+            elif req.is_cancelled():
+                req.finish()
+                self.stats['cancelled'] += 1
+            else:
+                keep.append(i)
+
+        if len(keep) == len(self._requests):
+            return
+
+        if len(keep) == 0:
+            self._reset_batch()
+            return
+
+        self._select(keep)
+
+    def _select(self, keep: list[int]) -> None:
+        '''
+        只保留batch中keep的行，并裁剪掉所有行都是填充的列
+        '''
+        index = torch.LongTensor(keep).to(self.device)
+        self._requests = [self._requests[i] for i in keep]
+        self._last_tokens = self._last_tokens.index_select(0, index)
+
+        decoder_attention_mask = self._decoder_attention_mask.index_select(0, index)
+        encoder_attention_mask = self._encoder_attention_mask.index_select(0, index)
+
+        # self-attention左填充，去掉左边全为0的列；encoder右填充，去掉右边全为0的列
+        dec_start = int(decoder_attention_mask.sum(dim=0).nonzero()[0])
+        enc_end = int(encoder_attention_mask.sum(dim=0).nonzero()[-1]) + 1
+
+        self._decoder_attention_mask = decoder_attention_mask[:, dec_start: ]
+        self._encoder_attention_mask = encoder_attention_mask[:, : enc_end]
+        self._encoder_hidden_states = self._encoder_hidden_states.index_select(0, index)[:, : enc_end, :]
+
+        past_key_values = []
+        for layer in self._past_key_values:
+            self_k, self_v, cross_k, cross_v = (x.index_select(0, index) for x in layer)
+            past_key_values.append((
+                self_k[:, :, dec_start:, :],
+                self_v[:, :, dec_start:, :],
+                cross_k[:, :, : enc_end, :],
+                cross_v[:, :, : enc_end, :],
+            ))
+        self._past_key_values = tuple(past_key_values)
+
+    def _reset_batch(self) -> None:
+        self._requests = []
+        self._encoder_hidden_states = None
+        self._encoder_attention_mask = None
+        self._decoder_attention_mask = None
+        self._past_key_values = None
+        self._last_tokens = None
+
+    def _fail_all(self, exception: Exception) -> None:
+        '''
+        出错时所有运行中和等待中的请求返回异常
+        '''
+        requests = self._requests
+        self._reset_batch()
+
+        while True:
+            try:
+                requests.append(self._waiting.get_nowait())
+            except Empty:
+                break
+
+        for req in requests:
+            req.fail(exception)
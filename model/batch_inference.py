@@ -0,0 +1,257 @@
+import sys
+sys.path.extend(['.','..'])
+import os
+import time
+from typing import Iterator, TYPE_CHECKING
+
+import ujson
+
+from model.generation_profiles import ProfileMetrics
+
+# 只用于类型标注，torchscript后端不import transformers
+if TYPE_CHECKING:
+    from model.infer import ChatBot
+
+
+def iter_records(input_file: str, chunk_size: int, skip: int=0) -> Iterator[list[dict]]:
+    '''
+    按chunk_size条一组读取输入文件，跳过前skip条，支持：
+    .jsonl（每行一个json对象，逐行读取）、.parquet（按row group流式读取）、.json（一个json列表，整体读入）
+    '''
+    ext = os.path.splitext(input_file)[1].lower()
+
+    if ext == '.parquet':
+        import pyarrow.parquet as pq
+
+        chunk = []
+        for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunk_size):
+            rows = batch.to_pylist()
+            if skip >= len(rows):
+                skip -= len(rows)
+                continue
+            chunk.extend(rows[skip: ])
+            skip = 0
+            while len(chunk) >= chunk_size:
+                yield chunk[0: chunk_size]
+                chunk = chunk[chunk_size: ]
+        if len(chunk) > 0:
+            yield chunk
+
+    elif ext == '.jsonl':
+        chunk = []
+        with open(input_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if len(line.strip()) == 0:
+                    continue
+                if skip > 0:
+                    skip -= 1
+                    continue
+                chunk.append(ujson.loads(line))
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if len(chunk) > 0:
+            yield chunk
+
+    elif ext == '.json':
+        with open(input_file, 'r', encoding='utf-8') as f:
+            data = ujson.load(f)
+        for start in range(skip, len(data), chunk_size):
+            yield data[start: start + chunk_size]
+
+    else:
+        raise ValueError('unsupported input file: {}, expect .jsonl, .json or .parquet'.format(input_file))
+
+
+def count_finished(output_file: str) -> int:
+    '''
+    断点续跑：返回输出文件中完整的记录数，写入中断留下的不完整的最后一行会被截掉。文件不存在返回0
+    '''
+    if not os.path.exists(output_file):
+        return 0
+
+    finished, valid_size = 0, 0
+    with open(output_file, 'rb') as f:
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            if len(line.strip()) > 0:
+                try:
+                    ujson.loads(line)
+                except ValueError:
+                    break
+                finished += 1
+            valid_size += len(line)
+
+    if valid_size < os.path.getsize(output_file):
+        with open(output_file, 'rb+') as f:
+            f.truncate(valid_size)
+
+    return finished
+
+
+def run_meta_file(output_file: str) -> str:
+    '''
+    断点续跑的元数据文件：记录输出文件对应的输入文件和生成参数
+    '''
+    return output_file + '.meta.json'
+
+
+def check_resume(output_file: str, meta: dict) -> None:
+    '''
+    输出文件中已有记录时，检查元数据文件和这次运行的meta一致，元数据文件不存在或不一致时抛出ValueError，不修改输出文件
+    '''
+    meta_file = run_meta_file(output_file)
+    saved = None
+    if os.path.exists(meta_file):
+        with open(meta_file, 'r', encoding='utf-8') as f:
+            saved = ujson.load(f)
+
+    if saved is None:
+        raise ValueError('can not resume from {}: {} not found, delete the output file or set resume=False.'.format(output_file, meta_file))
+
+    diff = sorted(key for key in meta.keys() if saved.get(key) != meta[key])
+    if len(diff) > 0:
+        raise ValueError('can not resume from {}: {} of this run does not match {}, delete the output file or set resume=False.'.format(
+            output_file, ', '.join(diff), meta_file))
+
+
+class BatchGenerator:
+    def __init__(self,
+                chat_bot: 'ChatBot',
+                search_type: str=None,
+                max_new_tokens: int=None,
+                max_batch_size: int=None,
+                max_batch_tokens: int=None,
+            ) -> None:
+        '''
+        离线批量生成（评估、DPO拒绝回答生成）和/api/chat/batch共用的批量生成：
+        调用chat_bot.generate_batch（按token长度分桶后批量生成，支持所有后端），每个桶的耗时和生成的token数
+        同时计入chat_bot.profile_metrics和本次任务单独的统计self.profile_metrics。
+        search_type、max_new_tokens、max_batch_size、max_batch_tokens为None时使用InferConfig中的配置，
+        生成方式不存在（或后端不支持）时在创建时抛出KeyError（ValueError）
+        '''
+        self.chat_bot = chat_bot
+        self.profile_name = chat_bot.get_profile(search_type).name
+        self.max_new_tokens = max_new_tokens
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+        self.profile_metrics = ProfileMetrics()
+        self.seconds = 0.0
+
+    def generate(self, prompts: list[str], expected_output_lens: list[int]=None, stopping_criteria: list=None) -> list[str]:
+        '''
+        批量生成，结果按输入顺序返回，空回答不做替换。
+        expected_output_lens: 预计的输出长度，prompt长度相同时按输出长度分桶；
+        stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria）
+        '''
+        if len(prompts) == 0:
+            return []
+
+        start = time.perf_counter()
+        outputs = self.chat_bot.generate_batch(
+                            prompts,
+                            max_batch_size=self.max_batch_size,
+                            max_batch_tokens=self.max_batch_tokens,
+                            expected_output_lens=expected_output_lens,
+                            search_type=self.profile_name,
+                            max_new_tokens=self.max_new_tokens,
+                            stopping_criteria=stopping_criteria,
+                            profile_metrics=self.profile_metrics,
+                        )
+        self.seconds += time.perf_counter() - start
+
+        return outputs
+
+    def get_stats(self) -> dict:
+        '''
+        吞吐量统计：tokens_per_s按生成耗时计算，latency为每个桶的生成耗时，seconds、prompts_per_s包含编码、解码的时间
+        '''
+        stats = self.profile_metrics.get_stats().get(self.profile_name, {'requests': 0, 'generated_tokens': 0, 'tokens_per_s': 0.0})
+        return {
+            'search_type': self.profile_name,
+            **stats,
+            'seconds': round(self.seconds, 3),
+            'prompts_per_s': round(stats['requests'] / self.seconds, 2) if self.seconds > 0 else 0.0,
+        }
+
+    def run_file(self,
+                input_file: str,
+                output_file: str,
+                prompt_key: str='prompt',
+                output_key: str='response',
+                expected_length_key: str=None,
+                chunk_size: int=1024,
+                resume: bool=True,
+            ) -> dict:
+        '''
+        读取input_file（.jsonl、.json、.parquet）中每条记录的prompt_key字段生成回答，
+        原记录加上output_key字段按输入顺序写入output_file（.jsonl）。
+        每次读取chunk_size条，chunk内按长度分桶批量生成，写完一个chunk保存一次（flush + fsync），
+        resume=True时跳过output_file中已完成的记录继续生成，否则覆盖output_file。
+        输入文件（路径、大小、修改时间）和生成参数记录在output_file + '.meta.json'中，
+        和这次运行不一致时不会续跑，抛出ValueError。
+        expected_length_key: 参考回答的字段（如DPO数据的chosen），按其字符数作为预计的输出长度。
+        返回吞吐量统计
+        '''
+        input_stat = os.stat(input_file)
+        meta = {
+            'input_file': os.path.abspath(input_file),
+            'input_size': input_stat.st_size,
+            'input_mtime_ns': input_stat.st_mtime_ns,
+            'search_type': self.profile_name,
+            'max_new_tokens': self.chat_bot.infer_config.max_seq_len if self.max_new_tokens is None else self.max_new_tokens,
+            'prompt_key': prompt_key,
+            'output_key': output_key,
+        }
+
+        resume = resume and os.path.exists(output_file) and os.path.getsize(output_file) > 0
+        if resume:
+            check_resume(output_file, meta)
+        else:
+            with open(run_meta_file(output_file), 'w', encoding='utf-8') as f:
+                ujson.dump(meta, f, indent=4, ensure_ascii=False)
+
+        finished = count_finished(output_file) if resume else 0
+        if finished > 0:
+            print('resume from {}, {} records finished.'.format(output_file, finished))
+
+        with open(output_file, 'a' if resume else 'w', encoding='utf-8') as f:
+            for chunk in iter_records(input_file, chunk_size, skip=finished):
+                expected_output_lens = None
+                if expected_length_key is not None:
+                    expected_output_lens = [len(item[expected_length_key]) for item in chunk]
+
+                outputs = self.generate([item[prompt_key] for item in chunk], expected_output_lens=expected_output_lens)
+
+                for item, output in zip(chunk, outputs):
+                    item[output_key] = output
+                    f.write(ujson.dumps(item, ensure_ascii=False) + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+
+                finished += len(chunk)
+                print('finished {} records, {}'.format(finished, self.get_stats()))
+
+        return self.get_stats()
+
+
+if __name__ == '__main__':
+    import pyarrow.parquet as pq
+    from model.backends import create_chat_bot
+    from config import InferConfig, TrainConfig
+
+    infer_config = InferConfig()
+    train_config = TrainConfig()
+    chat_bot = create_chat_bot(infer_config)
+
+    prompts = ['你好', '感冒了要怎么办？', '请介绍一下北京。'] * 32
+    if os.path.exists(train_config.validation_file):
+        prompts = pq.read_table(train_config.validation_file)['prompt'].to_pylist()[0: 256]
+
+    # 对比逐条生成（和循环调用/api/chat相同）与按长度分桶的批量生成的吞吐量
+    for name, max_batch_size in [('one by one', 1), ('bucketed batch', infer_config.max_batch_size)]:
+        generator = BatchGenerator(chat_bot, max_batch_size=max_batch_size)
+        generator.generate(prompts)
+        print('{}: {}'.format(name, generator.get_stats()))
@@ -0,0 +1,95 @@
+from threading import Lock
+
+import torch
+from torch import Tensor, LongTensor
+
+
+class PaddingStats:
+    def __init__(self) -> None:
+        '''
+        统计批量生成时encoder输入的填充浪费：填充token数 / 填充后的总token数
+        '''
+        self._lock = Lock()
+        self.batches = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def update(self, lengths: list[int]) -> None:
+        with self._lock:
+            self.batches += 1
+            self.real_tokens += sum(lengths)
+            self.padded_tokens += max(lengths) * len(lengths)
+
+    @property
+    def waste_ratio(self) -> float:
+        if self.padded_tokens == 0:
+            return 0.0
+        return 1.0 - self.real_tokens / self.padded_tokens
+
+    def to_dict(self) -> dict:
+        return {
+            'batches': self.batches,
+            'real_tokens': self.real_tokens,
+            'padded_tokens': self.padded_tokens,
+            'waste_ratio': round(self.waste_ratio, 4),
+        }
+
+
+def bucket_by_length(lengths: list[int], max_batch_size: int, max_batch_tokens: int=None, output_lengths: list[int]=None) -> list[list[int]]:
+    '''
+    按token长度（长度相同时按预计输出长度）排序后分组，返回每个batch在原列表中的索引。
+    每个batch最多max_batch_size条，填充后的token数（batch大小 * batch内最长长度）不超过max_batch_tokens，
+    长度相近的prompt分到同一个batch，减少填充浪费的计算。
+    >>> bucket_by_length([3, 50, 4, 48], max_batch_size=2)
+    [[0, 2], [3, 1]]
+    '''
+    if output_lengths is None:
+        output_lengths = [0] * len(lengths)
+
+    order = sorted(range(len(lengths)), key=lambda i: (lengths[i], output_lengths[i]))
+
+    buckets, bucket = [], []
+    for i in order:
+        # 已经排序，加入的都是batch内最长的
+        if len(bucket) > 0 and (
+                len(bucket) >= max_batch_size
+                or (max_batch_tokens is not None and lengths[i] * (len(bucket) + 1) > max_batch_tokens)
+            ):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(i)
+
+    if len(bucket) > 0:
+        buckets.append(bucket)
+
+    return buckets
+
+
+def pad_batch(input_ids: list[list[int]], pad_token_id: int=0) -> tuple[LongTensor, LongTensor]:
+    '''
+    右填充到batch内最长长度，返回input_ids, attention_mask
+    '''
+    max_len = max(len(ids) for ids in input_ids)
+    padded = torch.full((len(input_ids), max_len), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(input_ids), max_len), dtype=torch.long)
+
+    for i, ids in enumerate(input_ids):
+        padded[i, : len(ids)] = torch.LongTensor(ids)
+        attention_mask[i, : len(ids)] = 1
+
+    return padded, attention_mask
+
+
+def pad_hidden_states(hidden_list: list[Tensor]) -> tuple[Tensor, LongTensor]:
+    '''
+    多个未填充的encoder输出(seq_len, d_model)右填充为一个batch，返回encoder_hidden_states, attention_mask
+    '''
+    max_len = max(hidden.shape[0] for hidden in hidden_list)
+    encoder_hidden_states = hidden_list[0].new_zeros((len(hidden_list), max_len, hidden_list[0].shape[-1]))
+    attention_mask = torch.zeros((len(hidden_list), max_len), dtype=torch.long, device=hidden_list[0].device)
+
+    for i, hidden in enumerate(hidden_list):
+        encoder_hidden_states[i, : hidden.shape[0]] = hidden
+        attention_mask[i, : hidden.shape[0]] = 1
+
+    return encoder_hidden_states, attention_mask
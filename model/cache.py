@@ -0,0 +1,320 @@
+import os
+import time
+import hashlib
+import sqlite3
+from collections import OrderedDict
+from threading import Lock
+
+import ujson
+import torch
+from torch import Tensor, LongTensor
+
+from model.chat_model import TextToTextModel
+from model.bucketing import pad_batch, pad_hidden_states
+
+# 磁盘缓存的访问时间批量写入：积累的条数或距上次写入的时间（秒）超过以下值时写入一次
+ACCESS_FLUSH_SIZE = 256
+ACCESS_FLUSH_INTERVAL = 10.0
+
+# from_pretrained的模型文件夹中计入模型指纹的文件：config.json和from_pretrained加载的权重（包括分片的权重和索引文件），
+# 同一文件夹中量化、共享权重等其他格式的模型文件不计入
+WEIGHTS_FILE_PREFIXES = ('model.', 'model-', 'pytorch_model.', 'pytorch_model-')
+
+
+class EncoderCache:
+    def __init__(self, max_memory_mb: float=256.0, ttl: float=3600.0) -> None:
+        '''
+        encoder输出的LRU缓存，key为prompt的token id序列（不含填充），value为该prompt的encoder hidden states，
+        重复的prompt（如FAQ类问题）直接跳过encoder。
+        max_memory_mb: 缓存的hidden states占用的最大内存（MB），超出时淘汰最久未使用的；
+        ttl: 缓存过期时间（秒），<=0表示不过期。
+        attention mask不单独缓存，未填充的prompt的mask全为1，取出后按batch重新填充得到。
+        '''
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.ttl = ttl
+
+        self._cache = OrderedDict()     # key: tuple(token ids), value: (hidden_states, create_time)
+        self._lock = Lock()
+        self.memory = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _size_of(hidden_states: Tensor) -> int:
+        return hidden_states.numel() * hidden_states.element_size()
+
+    def get(self, input_ids: list[int]) -> Tensor:
+        '''
+        取出缓存的hidden states (seq_len, d_model)，未命中或已过期返回None
+        '''
+        key = tuple(input_ids)
+        with self._lock:
+            item = self._cache.get(key, None)
+
+            if item is not None and self.ttl > 0 and time.time() - item[1] > self.ttl:
+                self._cache.pop(key)
+                self.memory -= self._size_of(item[0])
+                item = None
+
+            if item is None:
+                self.misses += 1
+                return None
+
+            self._cache.move_to_end(key)
+            self.hits += 1
+
+            return item[0]
+
+    def put(self, input_ids: list[int], hidden_states: Tensor) -> None:
+        size = self._size_of(hidden_states)
+        if size > self.max_memory:
+            return
+
+        key = tuple(input_ids)
+        with self._lock:
+            old = self._cache.pop(key, None)
+            if old is not None:
+                self.memory -= self._size_of(old[0])
+
+            while self.memory + size > self.max_memory and len(self._cache) > 0:
+                _, (evicted, _) = self._cache.popitem(last=False)
+                self.memory -= self._size_of(evicted)
+                self.evictions += 1
+
+            self._cache[key] = (hidden_states, time.time())
+            self.memory += size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+            self.memory = 0
+
+    @torch.no_grad()
+    def encode(self, model: TextToTextModel, batch_input_ids: list[list[int]], pad_token_id: int=0) -> tuple[Tensor, LongTensor]:
+        '''
+        计算一个batch的encoder输出，命中缓存的prompt不再过encoder，未命中的合并为一个batch计算后写入缓存。
+        返回右填充后的encoder_hidden_states (batch, max_len, d_model)和attention_mask (batch, max_len)
+        '''
+        device = model.device
+        hidden_list = [self.get(ids) for ids in batch_input_ids]
+
+        # 同一个batch内重复的prompt只计算一次
+        miss_index = {}
+        for i, hidden in enumerate(hidden_list):
+            if hidden is None:
+                miss_index.setdefault(tuple(batch_input_ids[i]), []).append(i)
+
+        if len(miss_index) > 0:
+            miss_input_ids = [list(key) for key in miss_index.keys()]
+            input_ids, attention_mask = pad_batch(miss_input_ids, pad_token_id=pad_token_id)
+            miss_hidden = model.encoder(
+                input_ids=input_ids.to(device),
+                attention_mask=attention_mask.to(device),
+                return_dict=True,
+            ).last_hidden_state
+
+            for j, (key, index) in enumerate(miss_index.items()):
+                # clone，避免缓存中引用整个batch的tensor
+                hidden = miss_hidden[j, : len(key)].clone()
+                self.put(key, hidden)
+                for i in index:
+                    hidden_list[i] = hidden
+
+        return pad_hidden_states(hidden_list)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'size': len(self._cache),
+            'memory_mb': round(self.memory / 1024 / 1024, 2),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total > 0 else 0.0,
+        }
+
+
+def checkpoint_hash(model_path: str) -> str:
+    '''
+    模型权重的指纹：文件名、大小、修改时间的sha256，model_path为加载的权重文件，或from_pretrained的模型文件夹
+    （只取文件夹第一层from_pretrained加载的权重和config文件，导出的模型、训练状态、tokenizer等其他文件不影响指纹）。
+    不读取模型文件内容，启动时不需要额外的IO，重启后不变，重新训练保存后会变化
+    '''
+    files = []
+    if os.path.isdir(model_path):
+        for name in os.listdir(model_path):
+            file = os.path.join(model_path, name)
+            if os.path.isfile(file) and (name == 'config.json' or name.startswith(WEIGHTS_FILE_PREFIXES)):
+                files.append(file)
+    elif os.path.exists(model_path):
+        files.append(model_path)
+
+    sha = hashlib.sha256()
+    for file in sorted(files):
+        stat = os.stat(file)
+        sha.update('{}|{}|{}'.format(os.path.basename(file), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+
+    return sha.hexdigest()[0: 16]
+
+
+class ResponseCache:
+    def __init__(self, model_hash: str, max_memory_mb: float=64.0, sqlite_file: str=None, sqlite_max_mb: float=1024.0) -> None:
+        '''
+        确定性生成（greedy search）的回答缓存，key为规范化后的prompt、模型指纹、生成参数的sha256。
+        内存中为LRU缓存，按回答文本占用的字节数淘汰；sqlite_file不为None时增加一层磁盘缓存，重启后仍然有效，
+        磁盘缓存超过sqlite_max_mb时按最近访问时间淘汰。内存、磁盘命中的访问时间先记在内存中，批量写入磁盘；
+        磁盘缓存的大小在淘汰时按表中的SUM(size)重新计算，多个worker共用一个sqlite文件时上限同样有效。
+        '''
+        self.model_hash = model_hash
+        self.max_memory = int(max_memory_mb * 1024 * 1024)
+        self.sqlite_max_size = int(sqlite_max_mb * 1024 * 1024)
+
+        self._cache = OrderedDict()     # key: sha256, value: response
+        self._lock = Lock()
+        self.memory = 0
+        self.stats_counter = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'evictions': 0, 'disk_evictions': 0}
+
+        self._db = None
+        self._db_size = 0
+        self._access_times = {}         # key: sha256, value: 最近的访问时间，未写入磁盘
+        self._last_flush_time = time.time()
+        if sqlite_file:
+            self._db = sqlite3.connect(sqlite_file, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS response_cache (key TEXT PRIMARY KEY, response TEXT, size INTEGER, access_time REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS idx_access_time ON response_cache (access_time)')
+            self._db.commit()
+            self._db_size = self._disk_size()
+
+    @staticmethod
+    def normalize(prompt: str) -> str:
+        '''
+        去掉首尾空白，连续的空白合并为一个空格
+        '''
+        return ' '.join(prompt.split())
+
+    def make_key(self, prompt: str, generation_config: dict) -> str:
+        key = ujson.dumps({
+            'prompt': self.normalize(prompt),
+            'model': self.model_hash,
+            'generation_config': generation_config,
+        }, ensure_ascii=False, sort_keys=True)
+
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _size_of(response: str) -> int:
+        return len(response.encode('utf-8'))
+
+    def get(self, prompt: str, generation_config: dict) -> str:
+        '''
+        先查内存缓存，再查磁盘缓存（命中后放回内存），未命中返回None
+        '''
+        key = self.make_key(prompt, generation_config)
+
+        with self._lock:
+            response = self._cache.get(key, None)
+            if response is not None:
+                self._cache.move_to_end(key)
+                self.stats_counter['memory_hits'] += 1
+                self._touch(key)
+                return response
+
+            if self._db is not None:
+                row = self._db.execute('SELECT response FROM response_cache WHERE key = ?', (key, )).fetchone()
+                if row is not None:
+                    self.stats_counter['disk_hits'] += 1
+                    self._put_memory(key, row[0])
+                    self._touch(key)
+                    return row[0]
+
+            self.stats_counter['misses'] += 1
+            return None
+
+    def put(self, prompt: str, generation_config: dict, response: str) -> None:
+        key = self.make_key(prompt, generation_config)
+
+        with self._lock:
+            self._put_memory(key, response)
+
+            if self._db is not None:
+                self._put_disk(key, response)
+
+    def _put_memory(self, key: str, response: str) -> None:
+        size = self._size_of(response)
+        if size > self.max_memory:
+            return
+
+        old = self._cache.pop(key, None)
+        if old is not None:
+            self.memory -= self._size_of(old)
+
+        while self.memory + size > self.max_memory and len(self._cache) > 0:
+            _, evicted = self._cache.popitem(last=False)
+            self.memory -= self._size_of(evicted)
+            self.stats_counter['evictions'] += 1
+
+        self._cache[key] = response
+        self.memory += size
+
+    def _disk_size(self) -> int:
+        return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+
+    def _touch(self, key: str) -> None:
+        '''
+        记录命中的访问时间，积累到ACCESS_FLUSH_SIZE条或超过ACCESS_FLUSH_INTERVAL秒时批量写入磁盘
+        '''
+        if self._db is None:
+            return
+
+        now = time.time()
+        self._access_times[key] = now
+        if len(self._access_times) >= ACCESS_FLUSH_SIZE or now - self._last_flush_time >= ACCESS_FLUSH_INTERVAL:
+            self._flush_access_times()
+            self._db.commit()
+
+    def _flush_access_times(self) -> None:
+        '''
+        未写入的访问时间写入磁盘（不commit），已被其他worker淘汰的key不受影响
+        '''
+        if len(self._access_times) > 0:
+            self._db.executemany(
+                'UPDATE response_cache SET access_time = MAX(access_time, ?) WHERE key = ?',
+                [(access_time, key) for key, access_time in self._access_times.items()],
+            )
+            self._access_times = {}
+        self._last_flush_time = time.time()
+
+    def _put_disk(self, key: str, response: str) -> None:
+        size = self._size_of(response)
+
+        # 先写入访问时间，淘汰时不会删掉最近命中的回答
+        self._flush_access_times()
+        self._db.execute('INSERT OR REPLACE INTO response_cache (key, response, size, access_time) VALUES (?, ?, ?, ?)', (key, response, size, time.time()))
+
+        # 超出磁盘缓存上限，按最近访问时间淘汰，大小按表中的数据重新计算（可能有其他worker写入）
+        self._db_size = self._disk_size()
+        while self._db_size > self.sqlite_max_size:
+            rows = self._db.execute('SELECT key, size FROM response_cache ORDER BY access_time ASC LIMIT 64').fetchall()
+            if len(rows) == 0:
+                break
+            for evict_key, evict_size in rows:
+                self._db.execute('DELETE FROM response_cache WHERE key = ?', (evict_key, ))
+                self._db_size -= evict_size
+                self.stats_counter['disk_evictions'] += 1
+                if self._db_size <= self.sqlite_max_size:
+                    break
+            self._db_size = self._disk_size()
+
+        self._db.commit()
+
+    def stats(self) -> dict:
+        hits = self.stats_counter['memory_hits'] + self.stats_counter['disk_hits']
+        total = hits + self.stats_counter['misses']
+        return {
+            'size': len(self._cache),
+            'memory_mb': round(self.memory / 1024 / 1024, 2),
+            'disk_mb': round(self._db_size / 1024 / 1024, 2),
+            **self.stats_counter,
+            'hit_rate': round(hits / total, 4) if total > 0 else 0.0,
+        }
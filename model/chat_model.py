@@ -1,8 +1,12 @@
 import torch
 from torch import Tensor, LongTensor
 from transformers import T5ForConditionalGeneration, T5Config
-from transformers import TextIteratorStreamer
-from transformers.generation.configuration_utils import GenerationConfig
+from transformers import TextIteratorStreamer, StoppingCriteriaList
+from transformers.modeling_outputs import BaseModelOutput
+
+from model.early_exit import early_exit_generate
+from model.compiled_decode import CompiledGenerator
+from model.generation_profiles import get_profile
 
 class TextToTextModel(T5ForConditionalGeneration):
     def __init__(self, config: T5Config) -> None:
@@ -18,10 +22,23 @@ class TextToTextModel(T5ForConditionalGeneration):
                 max_seq_len: int=256,
                 search_type: str='beam',
                 streamer: TextIteratorStreamer=None,
+                encoder_outputs: BaseModelOutput=None,
+                early_exit_threshold: float=None,
+                early_exit_min_layers: int=None,
+                early_exit_stats: dict=None,
+                stopping_criteria: list=None,
+                static_generator: CompiledGenerator=None,
             ) -> Tensor:
         '''
         自定义gennerate方法方便调用、测试
-        search_type: ['greedy', 'beam', 'sampling', 'contrastive', ]
+        search_type: ['greedy', 'beam', 'sampling', 'contrastive', 'early_exit', ]，或其他注册的生成方式（见model.generation_profiles），
+            GenerationConfig和logits processor在每种生成方式第一次使用时创建并缓存
+        encoder_outputs: 已经计算好的encoder输出（如从缓存中取出），不为None时跳过encoder
+        early_exit_*: 生成方式的early_exit_threshold不为None（如'early_exit'）时decoder提前退出，见model.early_exit.early_exit_generate，
+            threshold、min_layers不为None时覆盖生成方式中的参数；threshold=0时为固定min_layers层的浅层decoder
+        stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria），任一条件满足时停止整个batch的生成
+        static_generator: 不为None时，和greedy结果相同的生成方式（GenerationProfile.is_greedy）用它的静态KV cache解码
+            （model.compiled_decode.CompiledGenerator，KV cache预先分配、请求之间复用，每步不再拼接），streamer需要支持put(list[int])
 
         - *greedy decoding* by calling [`~generation.GenerationMixin.greedy_search`] if `num_beams=1` and
             `do_sample=False`
@@ -34,41 +51,46 @@ class TextToTextModel(T5ForConditionalGeneration):
         - *beam-search multinomial sampling* by calling [`~generation.GenerationMixin.beam_sample`] if
             `num_beams>1` and `do_sample=True`
         '''
-        generation_config = GenerationConfig()
-        generation_config.remove_invalid_values = True
-        generation_config.eos_token_id = 1
-        generation_config.pad_token_id = 0
-        generation_config.decoder_start_token_id = self.config.decoder_start_token_id
-        generation_config.max_new_tokens = max_seq_len
-        # generation_config.repetition_penalty = 1.1 # 重复词惩罚
+        profile = get_profile(search_type)
+
+        if profile.early_exit_threshold is not None:
+            return early_exit_generate(
+                self,
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_new_tokens=max_seq_len,
+                threshold=profile.early_exit_threshold if early_exit_threshold is None else early_exit_threshold,
+                min_layers=profile.early_exit_min_layers if early_exit_min_layers is None else early_exit_min_layers,
+                streamer=streamer,
+                stats=early_exit_stats,
+                encoder_outputs=encoder_outputs,
+                stopping_criteria=stopping_criteria,
+            )
+
+        if static_generator is not None and profile.is_greedy:
+            return static_generator.generate(
+                input_ids,
+                attention_mask,
+                max_new_tokens=max_seq_len,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+                encoder_hidden_states=None if encoder_outputs is None else encoder_outputs.last_hidden_state,
+            )
 
-        if search_type == 'greedy':
-            generation_config.num_beams = 1
-            generation_config.do_sample = False
-        elif search_type == 'beam':
-            generation_config.top_k = 50
-            generation_config.num_beams = 5
-            generation_config.do_sample = True
-            generation_config.top_p = 0.95
-            generation_config.no_repeat_ngram_size = 4
-            generation_config.length_penalty = -2.0
-            generation_config.early_stopping = True
-        elif search_type == 'sampling':
-            generation_config.num_beams = 1
-            generation_config.do_sample = True
-            generation_config.top_k = 50
-            generation_config.temperature = 0.98   # 越低，贫富差距越大，越高(>1)，越趋向于均匀分布
-            generation_config.top_p = 0.80
-            generation_config.no_repeat_ngram_size = 4
-        elif search_type == 'contrastive':
-            generation_config.penalty_alpha = 0.5
-            generation_config.top_k = 50
+        generate_kwargs = {}
+        if encoder_outputs is not None:
+            generate_kwargs['encoder_outputs'] = encoder_outputs
+        if stopping_criteria is not None:
+            generate_kwargs['stopping_criteria'] = StoppingCriteriaList(stopping_criteria)
 
         result = self.generate(
             inputs=input_ids,
             attention_mask=attention_mask,
-            generation_config=generation_config,
+            generation_config=profile.generation_config(self.config.decoder_start_token_id),
+            logits_processor=profile.logits_processor(),
+            max_new_tokens=max_seq_len,
             streamer=streamer,
+            **generate_kwargs,
             )
 
         return result
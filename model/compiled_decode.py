@@ -0,0 +1,367 @@
+import os
+import sys
+sys.path.extend(['.','..'])
+
+import time
+import warnings
+from threading import Lock
+
+import torch
+from torch import nn, Tensor, LongTensor
+from transformers import T5ForConditionalGeneration
+
+from model.early_exit import _split_heads, _lm_logits
+from model.kv_cache import KVCachePool, StaticKVCache
+
+
+def bucket_length(length: int, bucket_size: int) -> int:
+    '''
+    向上取整到bucket_size的整数倍
+    '''
+    return max(1, (length + bucket_size - 1) // bucket_size) * bucket_size
+
+
+def bucket_batch_size(batch_size: int) -> int:
+    '''
+    向上取整到2的幂
+    '''
+    return 1 << (batch_size - 1).bit_length()
+
+
+class StaticDecoderStep(nn.Module):
+    def __init__(self, model: T5ForConditionalGeneration) -> None:
+        '''
+        decoder的单步解码，所有张量的形状固定，可以被torch.compile捕获为静态图：
+        input_ids: (batch, 1)，position: 0维LongTensor，当前token在decoder输入中的位置
+        self_kv: (num_layers, 2, batch, n_heads, cache_len, d_kv)，当前位置的k、v原地写入，cache_len为分桶后的长度，
+            注意力只看position及之前的位置，
+        cross_kv: (num_layers, 2, batch, n_heads, enc_len, d_kv)，encoder_mask_bias: (batch, 1, 1, enc_len)
+        计算过程和T5Block相同（dropout在推理时不起作用），返回下一个token的logits: (batch, vocab_size)
+        '''
+        super().__init__()
+        self.model = model
+        self.decoder = model.decoder
+        self.blocks = model.decoder.block
+
+        relative_attention = self.blocks[0].layer[0].SelfAttention
+        self.relative_attention_bias = relative_attention.relative_attention_bias
+        self.num_buckets = relative_attention.relative_attention_num_buckets
+        self.max_distance = relative_attention.relative_attention_max_distance
+        self.relative_position_bucket = relative_attention._relative_position_bucket
+
+    @staticmethod
+    def clamp_fp16(hidden_states: Tensor) -> Tensor:
+        # 同T5Block，float16时把inf截断为最大值
+        if hidden_states.dtype != torch.float16:
+            return hidden_states
+        clamp_value = torch.where(
+            torch.isinf(hidden_states).any(),
+            torch.finfo(hidden_states.dtype).max - 1000,
+            torch.finfo(hidden_states.dtype).max,
+        )
+        return torch.clamp(hidden_states, min=-clamp_value, max=clamp_value)
+
+    @staticmethod
+    def attention(query: Tensor, key: Tensor, value: Tensor, bias: Tensor) -> Tensor:
+        # T5的注意力不除以sqrt(d_kv)，softmax用float32计算
+        scores = torch.matmul(query, key.transpose(3, 2)) + bias
+        weights = nn.functional.softmax(scores.float(), dim=-1).type_as(scores)
+        output = torch.matmul(weights, value)
+        return output.transpose(1, 2).reshape(output.shape[0], -1, output.shape[1] * output.shape[3])
+
+    def forward(self, input_ids: LongTensor, position: LongTensor, self_kv: Tensor, cross_kv: Tensor, encoder_mask_bias: Tensor) -> Tensor:
+        hidden_states = self.decoder.embed_tokens(input_ids)
+        cache_len = self_kv.shape[4]
+
+        # 当前位置对所有缓存位置的相对位置偏置，之后的位置用mask屏蔽
+        memory_position = torch.arange(cache_len, dtype=torch.long, device=input_ids.device)
+        relative_position_bucket = self.relative_position_bucket(
+            memory_position - position,
+            bidirectional=False,
+            num_buckets=self.num_buckets,
+            max_distance=self.max_distance,
+        )
+        position_bias = self.relative_attention_bias(relative_position_bucket).transpose(0, 1)[None, :, None, :]
+        causal_mask = torch.where(memory_position > position, torch.finfo(hidden_states.dtype).min, 0.0).to(hidden_states.dtype)
+        self_bias = position_bias + causal_mask
+        index = position.view(1)
+
+        for i, block in enumerate(self.blocks):
+            self_attention_layer, cross_attention_layer, ff_layer = block.layer[0], block.layer[1], block.layer[-1]
+
+            # self-attention，当前位置的k、v写入缓存
+            attention = self_attention_layer.SelfAttention
+            normed_hidden_states = self_attention_layer.layer_norm(hidden_states)
+            query = _split_heads(attention.q(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)
+            self_kv[i, 0].index_copy_(2, index, _split_heads(attention.k(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim))
+            self_kv[i, 1].index_copy_(2, index, _split_heads(attention.v(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim))
+            hidden_states = hidden_states + attention.o(self.attention(query, self_kv[i, 0], self_kv[i, 1], self_bias))
+            hidden_states = self.clamp_fp16(hidden_states)
+
+            # cross-attention，没有相对位置偏置
+            attention = cross_attention_layer.EncDecAttention
+            normed_hidden_states = cross_attention_layer.layer_norm(hidden_states)
+            query = _split_heads(attention.q(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)
+            hidden_states = hidden_states + attention.o(self.attention(query, cross_kv[i, 0], cross_kv[i, 1], encoder_mask_bias))
+            hidden_states = self.clamp_fp16(hidden_states)
+
+            hidden_states = self.clamp_fp16(ff_layer(hidden_states))
+
+        return _lm_logits(self.model, hidden_states)[:, -1, :]
+
+
+class CompiledGenerator:
+    def __init__(self,
+                model: T5ForConditionalGeneration,
+                max_seq_len: int=320,
+                bucket_size: int=64,
+                compile: bool=True,
+                compile_mode: str='default',
+                eos_token_id: int=1,
+                pad_token_id: int=0,
+                kv_cache_pool_mb: float=512.0,
+            ) -> None:
+        '''
+        decoder单步用torch.compile编译的greedy search，减少HF generate每个token的Python开销。
+        为了让编译后的图可以被不同的请求复用，所有形状都做分桶：
+        batch向上取整到2的幂（多出来的行一开始就标记为结束），encoder输入长度和self-attention KV cache长度
+        向上取整到bucket_size的整数倍。KV cache从KVCachePool中取出（按max_seq_len预先分配，请求结束后归还复用，
+        生成过程中不再分配、拼接），注意力只在cache前面已经用到的桶上计算，短回答只在短的cache上计算注意力。
+        每种形状第一次出现时编译一次，启动时warmup()预先编译常用的形状。
+        编译失败（没有C++编译器、torch版本不支持等）时打印警告，退回到未编译的同一个单步函数，结果相同。
+        eos_token_id、pad_token_id和my_generate保持一致，返回值格式和my_generate相同。
+        '''
+        self.model = model
+        self.max_seq_len = max_seq_len
+        self.bucket_size = bucket_size
+        self.eos_token_id = eos_token_id
+        self.pad_token_id = pad_token_id
+        self.decoder_start_token_id = model.config.decoder_start_token_id
+
+        attention = model.decoder.block[0].layer[0].SelfAttention
+        self.kv_cache_pool = KVCachePool(
+            num_layers=len(model.decoder.block),
+            n_heads=attention.n_heads,
+            d_kv=attention.key_value_proj_dim,
+            max_seq_len=bucket_length(max_seq_len, bucket_size),
+            dtype=model.dtype,
+            device=model.device,
+            max_memory_mb=kv_cache_pool_mb,
+        )
+
+        self.eager_step = StaticDecoderStep(model).eval()
+        self.step_fn = self.eager_step
+        self.compiled = False
+        self.fallback_reason = None
+
+        if compile:
+            if hasattr(torch, 'compile'):
+                # 每种形状（batch、encoder长度、cache长度的组合）编译一次，默认的重新编译次数上限（8）不够用
+                torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+                self.step_fn = torch.compile(self.eager_step, mode=compile_mode, dynamic=False)
+                self.compiled = True
+            else:
+                self.fallback_reason = 'torch.compile is not available in torch {}'.format(torch.__version__)
+
+        self._lock = Lock()
+        self._step_lock = Lock()     # 串行执行编译后的单步：dynamo的编译和guard检查不是线程安全的，退回eager也只能切换一次
+        self.stats = {'requests': 0, 'generated_tokens': 0, 'time': 0.0, 'compile_time': 0.0}
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    def step(self, *args) -> Tensor:
+        '''
+        调用编译后的单步函数，编译或运行出错时退回eager。
+        多个线程同时生成时，编译后的单步（包括每种形状第一次的编译）持锁串行执行，出错后的切换也在锁内完成；
+        eager和编译后的单步计算过程相同，其他线程在生成中途切换到eager不影响结果，eager的单步不需要持锁
+        '''
+        if self.compiled:
+            with self._step_lock:
+                if self.compiled:
+                    try:
+                        return self.step_fn(*args)
+                    except Exception as e:
+                        warnings.warn('torch.compile decode step failed, fall back to eager: {}'.format(e))
+                        self.fallback_reason = str(e)
+                        self.compiled = False
+                        self.step_fn = self.eager_step
+
+        return self.eager_step(*args)
+
+    @torch.no_grad()
+    def prepare(self, input_ids: LongTensor, attention_mask: LongTensor, encoder_hidden_states: Tensor=None) -> tuple[int, StaticKVCache, Tensor]:
+        '''
+        batch、encoder长度分桶后计算encoder输出，从缓冲池取出KV cache并写入cross-attention KV，
+        返回：真实的batch大小、KV cache（用完后需要归还kv_cache_pool）、encoder mask偏置。
+        encoder_hidden_states: 已经计算好的encoder输出(batch, enc_len, d_model)（如从缓存中取出），和attention_mask对应，
+            不为None时跳过encoder，只填充到分桶后的形状
+        '''
+        batch_size, enc_len = attention_mask.shape
+        padded_batch_size, padded_enc_len = bucket_batch_size(batch_size), bucket_length(enc_len, self.bucket_size)
+
+        padded_attention_mask = attention_mask.new_zeros((padded_batch_size, padded_enc_len))
+        padded_attention_mask[: batch_size, : enc_len] = attention_mask
+        padded_attention_mask[batch_size: , 0] = 1      # 填充的行至少有一个有效位置，防止softmax全为-inf
+
+        if encoder_hidden_states is None:
+            padded_input_ids = input_ids.new_full((padded_batch_size, padded_enc_len), self.pad_token_id)
+            padded_input_ids[: batch_size, : enc_len] = input_ids
+            encoder_hidden_states = self.model.encoder(input_ids=padded_input_ids, attention_mask=padded_attention_mask, return_dict=True).last_hidden_state
+        else:
+            padded_hidden_states = encoder_hidden_states.new_zeros((padded_batch_size, padded_enc_len, encoder_hidden_states.shape[-1]))
+            padded_hidden_states[: batch_size, : enc_len] = encoder_hidden_states
+            encoder_hidden_states = padded_hidden_states
+
+        cache = self.kv_cache_pool.acquire(padded_batch_size, padded_enc_len)
+        for i, block in enumerate(self.model.decoder.block):
+            attention = block.layer[1].EncDecAttention
+            cache.cross_kv[i, 0].copy_(_split_heads(attention.k(encoder_hidden_states), attention.n_heads, attention.key_value_proj_dim))
+            cache.cross_kv[i, 1].copy_(_split_heads(attention.v(encoder_hidden_states), attention.n_heads, attention.key_value_proj_dim))
+
+        encoder_mask_bias = self.model.decoder.invert_attention_mask(padded_attention_mask)
+
+        return batch_size, cache, encoder_mask_bias
+
+    @torch.no_grad()
+    def generate(self,
+                input_ids: LongTensor,
+                attention_mask: LongTensor,
+                max_new_tokens: int=None,
+                streamer=None,
+                stopping_criteria: list=None,
+                encoder_hidden_states: Tensor=None,
+            ) -> LongTensor:
+        '''
+        greedy search，返回(batch, 1 + 生成长度)，第一个为decoder_start_token_id，结束的序列用pad_token_id填充。
+        streamer: 只有一个prompt时使用，如model.streamer.TokenStreamer，streamer被取消后停止生成；
+        stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria），每个解码步之后检查，任一条件满足时停止整个batch的生成；
+        encoder_hidden_states: 已经计算好的encoder输出（如从缓存中取出），不为None时跳过encoder，见prepare
+        '''
+        start_time = time.perf_counter()
+        max_new_tokens = self.max_seq_len if max_new_tokens is None else min(max_new_tokens, self.max_seq_len)
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+        if encoder_hidden_states is not None:
+            encoder_hidden_states = encoder_hidden_states.to(self.device)
+
+        batch_size, cache, encoder_mask_bias = self.prepare(input_ids, attention_mask, encoder_hidden_states)
+        try:
+            sequences = self._decode(batch_size, cache, encoder_mask_bias, max_new_tokens, streamer, stopping_criteria)
+        finally:
+            self.kv_cache_pool.release(cache)
+
+        with self._lock:
+            self.stats['requests'] += batch_size
+            self.stats['generated_tokens'] += int((sequences[:, 1: ] != self.pad_token_id).sum())
+            self.stats['time'] += time.perf_counter() - start_time
+
+        return sequences
+
+    def _decode(self, batch_size: int, cache: StaticKVCache, encoder_mask_bias: Tensor, max_new_tokens: int, streamer, stopping_criteria: list=None) -> LongTensor:
+        padded_batch_size = cache.cross_kv.shape[2]
+        cache_len = self.bucket_size
+
+        sequences = torch.full((padded_batch_size, 1), self.decoder_start_token_id, dtype=torch.long, device=self.device)
+        step_input_ids = sequences      # 单独保存，sequences[:, -1: ]的stride每步都变，会导致重新编译
+        unfinished = torch.arange(padded_batch_size, device=self.device) < batch_size
+
+        for position in range(max_new_tokens):
+
+            # 用到的位置超过当前的桶时，注意力扩展到下一个桶，cache已经预先分配，不需要复制
+            if position == cache_len:
+                cache_len += self.bucket_size
+
+            logits = self.step(step_input_ids, torch.tensor(position, dtype=torch.long, device=self.device), cache.self_kv_view(cache_len), cache.cross_kv, encoder_mask_bias)
+
+            next_tokens = logits.argmax(dim=-1)
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, self.pad_token_id))
+            step_input_ids = next_tokens[:, None]
+            sequences = torch.cat([sequences, step_input_ids], dim=-1)
+
+            if streamer is not None and not streamer.put(next_tokens[: batch_size].tolist()):
+                break
+
+            unfinished = unfinished & (next_tokens != self.eos_token_id)
+            if not bool(unfinished.any()):
+                break
+
+            if stopping_criteria is not None and any(criteria(sequences[: batch_size], logits[: batch_size]) for criteria in stopping_criteria):
+                break
+
+        if streamer is not None:
+            streamer.end()
+
+        return sequences[: batch_size]
+
+    @torch.no_grad()
+    def warmup(self, batch_sizes: list[int]=None, encoder_lens: list[int]=None) -> None:
+        '''
+        预先编译常用的形状：每个batch大小、encoder长度的桶，和到max_seq_len的所有KV cache长度的桶
+        '''
+        start_time = time.perf_counter()
+        batch_sizes = [1] if batch_sizes is None else batch_sizes
+        encoder_lens = [self.bucket_size] if encoder_lens is None else encoder_lens
+
+        for batch_size in sorted(set(bucket_batch_size(b) for b in batch_sizes)):
+            for enc_len in sorted(set(bucket_length(n, self.bucket_size) for n in encoder_lens)):
+                input_ids = torch.full((batch_size, enc_len), self.pad_token_id, dtype=torch.long, device=self.device)
+                _, cache, encoder_mask_bias = self.prepare(input_ids, torch.ones_like(input_ids))
+                input_ids = torch.full((batch_size, 1), self.decoder_start_token_id, dtype=torch.long, device=self.device)
+
+                for cache_len in range(self.bucket_size, self.kv_cache_pool.max_seq_len + 1, self.bucket_size):
+                    self.step(input_ids, torch.tensor(0, dtype=torch.long, device=self.device), cache.self_kv_view(cache_len), cache.cross_kv, encoder_mask_bias)
+
+                self.kv_cache_pool.release(cache)
+
+        with self._lock:
+            self.stats['compile_time'] += time.perf_counter() - start_time
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+
+        stats['compiled'] = self.compiled
+        stats['kv_cache_pool'] = self.kv_cache_pool.get_stats()
+        stats['fallback_reason'] = self.fallback_reason
+        stats['tokens_per_second'] = round(stats['generated_tokens'] / stats['time'], 2) if stats['time'] > 0 else 0.0
+        stats['time'] = round(stats['time'], 3)
+        stats['compile_time'] = round(stats['compile_time'], 3)
+
+        return stats
+
+
+if __name__ == '__main__':
+    from dataclasses import replace
+    import pyarrow.parquet as pq
+    from model.infer import ChatBot
+    from config import InferConfig, TrainConfig
+
+    infer_config = InferConfig()
+    train_config = TrainConfig()
+
+    # 对比my_generate和编译后的单步解码的速度，并检查greedy结果是否一致
+    chat_bot = ChatBot(replace(infer_config, response_cache_mb=0.0, encoder_cache_mb=0.0, compile_decode=False))
+    generator = CompiledGenerator(chat_bot.model, max_seq_len=infer_config.max_seq_len, bucket_size=infer_config.compile_bucket_size, compile_mode=infer_config.compile_mode)
+    generator.warmup()
+    print('warmup: {}'.format(generator.get_stats()))
+
+    prompts = ['你好', '感冒了要怎么办？', '请介绍一下北京。']
+    if os.path.exists(train_config.validation_file):
+        prompts = pq.read_table(train_config.validation_file)['prompt'].to_pylist()[0: 64]
+
+    eager_tokens, eager_time, same = 0, 0.0, 0
+    for prompt in prompts:
+        x = torch.LongTensor([chat_bot.encode(f"{prompt}[EOS]").input_ids]).to(chat_bot.device)
+
+        start = time.perf_counter()
+        reference = chat_bot.model.my_generate(x, torch.ones_like(x), max_seq_len=infer_config.max_seq_len, search_type='greedy')
+        eager_time += time.perf_counter() - start
+        eager_tokens += int((reference[:, 1: ] != chat_bot.tokenizer.pad_token_id).sum())
+
+        output = generator.generate(x, torch.ones_like(x), max_new_tokens=infer_config.max_seq_len)
+        same += int(output.tolist() == reference.tolist())
+
+    print('my_generate: {:.2f} tokens/s'.format(eager_tokens / eager_time))
+    print('compiled: {}'.format(generator.get_stats()))
+    print('identical outputs: {} / {}'.format(same, len(prompts)))
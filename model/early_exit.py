@@ -0,0 +1,216 @@
+import os
+import sys
+sys.path.extend(['.','..'])
+
+import time
+
+import torch
+from torch import Tensor, LongTensor
+from transformers import T5ForConditionalGeneration
+from transformers.modeling_outputs import BaseModelOutput
+
+
+def _split_heads(x: Tensor, n_heads: int, d_kv: int) -> Tensor:
+    # (batch, seq_len, n_heads * d_kv) -> (batch, n_heads, seq_len, d_kv)
+    return x.view(x.shape[0], -1, n_heads, d_kv).transpose(1, 2)
+
+
+def _lm_logits(model: T5ForConditionalGeneration, hidden_states: Tensor) -> Tensor:
+    '''
+    decoder最后的layer norm和lm_head，和T5ForConditionalGeneration.forward相同
+    '''
+    hidden_states = model.decoder.final_layer_norm(hidden_states)
+    if model.config.tie_word_embeddings:
+        hidden_states = hidden_states * (model.model_dim ** -0.5)
+
+    return model.lm_head(hidden_states)
+
+
+@torch.no_grad()
+def early_exit_generate(
+                model: T5ForConditionalGeneration,
+                input_ids: LongTensor,
+                attention_mask: LongTensor,
+                max_new_tokens: int=256,
+                threshold: float=0.9,
+                min_layers: int=2,
+                eos_token_id: int=1,
+                pad_token_id: int=0,
+                streamer=None,
+                stats: dict=None,
+                encoder_outputs: BaseModelOutput=None,
+                stopping_criteria: list=None,
+            ) -> LongTensor:
+    '''
+    decoder提前退出的greedy search：每生成一个token，decoder从第min_layers层开始，每层之后用共享的final_layer_norm和lm_head
+    计算预测的最大概率，batch内所有未结束的序列最大概率都不小于threshold时，跳过剩下的层直接输出。
+    threshold=0时每个token固定只计算前min_layers层（截断的浅层decoder），threshold>1时计算全部层，结果和greedy search相同。
+
+    跳过的层没有这个位置的self-attention KV，后面的token在这些层中需要它，这里用退出时的hidden states
+    经过跳过层的layer norm和k、v投影计算得到（CALM的state propagation）。cross-attention KV只和encoder输出有关，开始时为每层计算一次。
+    中间层没有专门训练退出的输出头，浅层的预测质量和threshold的取值需要用benchmark（python model/early_exit.py）评估。
+
+    返回值和generate相同：(batch, 1 + 生成长度)，第一个为decoder_start_token_id，结束的序列用pad_token_id填充。
+    streamer: 只有一个prompt时使用，如model.streamer.TokenStreamer，streamer被取消后停止生成；
+    stats不为None时累加：tokens、layers（实际计算的decoder层数之和）；
+    encoder_outputs: 已经计算好的encoder输出（如从缓存中取出），不为None时跳过encoder；
+    stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria），每个token之后检查，任一条件满足时停止整个batch的生成
+    '''
+    decoder = model.decoder
+    blocks = decoder.block
+    num_layers = len(blocks)
+    min_layers = max(1, min(min_layers, num_layers))
+    batch_size = input_ids.shape[0]
+    device = input_ids.device
+
+    if encoder_outputs is None:
+        encoder_outputs = model.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+    encoder_hidden_states = encoder_outputs.last_hidden_state
+    encoder_extended_mask = decoder.invert_attention_mask(attention_mask)
+
+    # 每层的KV cache：self_k、self_v随生成增长，cross_k、cross_v固定
+    past_key_values = []
+    for block in blocks:
+        self_attention, cross_attention = block.layer[0].SelfAttention, block.layer[1].EncDecAttention
+        n_heads, d_kv = cross_attention.n_heads, cross_attention.key_value_proj_dim
+        empty = encoder_hidden_states.new_zeros((batch_size, self_attention.n_heads, 0, self_attention.key_value_proj_dim))
+        past_key_values.append([
+            empty,
+            empty,
+            _split_heads(cross_attention.k(encoder_hidden_states), n_heads, d_kv),
+            _split_heads(cross_attention.v(encoder_hidden_states), n_heads, d_kv),
+        ])
+
+    sequences = torch.full((batch_size, 1), model.config.decoder_start_token_id, dtype=torch.long, device=device)
+    unfinished = torch.ones(batch_size, dtype=torch.bool, device=device)
+    total_layers = 0
+
+    for _ in range(max_new_tokens):
+        hidden_states = decoder.embed_tokens(sequences[:, -1:])
+        position_bias, encoder_decoder_position_bias = None, None
+        logits, exit_layer = None, num_layers
+
+        for i, block in enumerate(blocks):
+            layer_outputs = block(
+                hidden_states,
+                position_bias=position_bias,
+                encoder_hidden_states=encoder_hidden_states,
+                encoder_attention_mask=encoder_extended_mask,
+                encoder_decoder_position_bias=encoder_decoder_position_bias,
+                past_key_value=past_key_values[i],
+                use_cache=True,
+            )
+            hidden_states = layer_outputs[0]
+            self_k, self_v = layer_outputs[1][0: 2]
+            past_key_values[i][0], past_key_values[i][1] = self_k, self_v
+
+            # 第一层计算的相对位置偏置，后面的层共用
+            position_bias, encoder_decoder_position_bias = layer_outputs[2], layer_outputs[3]
+
+            if i + 1 < min_layers or i + 1 == num_layers:
+                continue
+
+            logits = _lm_logits(model, hidden_states)[:, -1, :]
+            confidence = logits.float().softmax(dim=-1).amax(dim=-1)
+            if bool((confidence[unfinished] >= threshold).all()):
+                exit_layer = i + 1
+                break
+
+        # 跳过的层：用退出时的hidden states计算该位置的self-attention KV
+        for i in range(exit_layer, num_layers):
+            layer = blocks[i].layer[0]
+            attention = layer.SelfAttention
+            normed_hidden_states = layer.layer_norm(hidden_states)
+            past_key_values[i][0] = torch.cat([past_key_values[i][0], _split_heads(attention.k(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)], dim=2)
+            past_key_values[i][1] = torch.cat([past_key_values[i][1], _split_heads(attention.v(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)], dim=2)
+
+        if exit_layer == num_layers:
+            logits = _lm_logits(model, hidden_states)[:, -1, :]
+
+        next_tokens = logits.argmax(dim=-1)
+        next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, pad_token_id))
+        sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+
+        total_layers += exit_layer * int(unfinished.sum())
+
+        if streamer is not None and not streamer.put(next_tokens.tolist()):
+            break
+
+        unfinished = unfinished & (next_tokens != eos_token_id)
+        if not bool(unfinished.any()):
+            break
+
+        if stopping_criteria is not None and any(criteria(sequences, logits) for criteria in stopping_criteria):
+            break
+
+    if streamer is not None:
+        streamer.end()
+
+    if stats is not None:
+        generated = sequences[:, 1: ]
+        stats['tokens'] = stats.get('tokens', 0) + int(((generated != pad_token_id)).sum())
+        stats['layers'] = stats.get('layers', 0) + total_layers
+
+    return sequences
+
+
+if __name__ == '__main__':
+    from dataclasses import replace
+    import pyarrow.parquet as pq
+    from model.infer import ChatBot
+    from utils.functions import get_bleu4_score, my_average
+    from config import InferConfig, TrainConfig
+
+    infer_config = InferConfig()
+    train_config = TrainConfig()
+
+    # 对比完整decoder和提前退出的速度（tokens/s）、bleu4（以验证集的回答为参考）
+    chat_bot = ChatBot(replace(infer_config, response_cache_mb=0.0, encoder_cache_mb=0.0))
+    tokenizer = chat_bot.tokenizer
+    num_layers = len(chat_bot.model.decoder.block)
+
+    prompts, references = ['你好', '感冒了要怎么办？', '请介绍一下北京。'], None
+    if os.path.exists(train_config.validation_file):
+        table = pq.read_table(train_config.validation_file)
+        prompts, references = table['prompt'].to_pylist()[0: 128], table['response'].to_pylist()[0: 128]
+
+    batch_size = 16
+    settings = [('greedy', None, None), ('early_exit', 0.9, 2), ('early_exit', 0.8, 2), ('early_exit', 0.0, num_layers // 2)]
+
+    full_outputs = None
+    for search_type, threshold, min_layers in settings:
+        outputs, tokens, layers, used_time = [], 0, 0, 0.0
+        for start in range(0, len(prompts), batch_size):
+            encoded = tokenizer.batch_encode_plus([f"{prompt}[EOS]" for prompt in prompts[start: start + batch_size]], padding=True)
+            input_ids = torch.LongTensor(encoded.input_ids).to(chat_bot.device)
+            attention_mask = torch.LongTensor(encoded.attention_mask).to(chat_bot.device)
+
+            stats = {}
+            begin = time.perf_counter()
+            output_ids = chat_bot.model.my_generate(
+                input_ids=input_ids,
+                attention_mask=attention_mask,
+                max_seq_len=infer_config.max_seq_len,
+                search_type=search_type,
+                early_exit_threshold=threshold,
+                early_exit_min_layers=min_layers,
+                early_exit_stats=stats,
+            )
+            used_time += time.perf_counter() - begin
+
+            tokens += int((output_ids[:, 1: ] != tokenizer.pad_token_id).sum())
+            layers += stats.get('layers', 0)
+            outputs.extend(tokenizer.batch_decode(output_ids.cpu().numpy(), skip_special_tokens=True, clean_up_tokenization_spaces=False))
+
+        if full_outputs is None:
+            full_outputs = outputs
+
+        bleu4_full = my_average([float(get_bleu4_score(reference=ref, outputs=out)) if len(ref) > 0 and len(out) > 0 else float(ref == out) for ref, out in zip(full_outputs, outputs)])
+        info = '{}(threshold={}, min_layers={}): {:.2f} tokens/s, bleu4 vs full model: {:.4f}'.format(search_type, threshold, min_layers, tokens / used_time, bleu4_full)
+        if references is not None:
+            bleu4 = my_average([float(get_bleu4_score(reference=ref, outputs=out)) if len(out) > 0 else 0.0 for ref, out in zip(references, outputs)])
+            info += ', bleu4 vs reference: {:.4f}'.format(bleu4)
+        if search_type == 'early_exit' and tokens > 0:
+            info += ', average decoder layers: {:.2f} / {}'.format(layers / tokens, num_layers)
+
+        print(info)
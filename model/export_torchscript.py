@@ -0,0 +1,182 @@
+import os
+import sys
+sys.path.extend(['.','..'])
+
+import ujson
+import torch
+from torch import nn, Tensor, LongTensor
+from transformers import PreTrainedTokenizerFast
+
+from model.chat_model import TextToTextModel
+from model.torchscript_runtime import TorchScriptT5
+
+
+class EncoderWrapper(nn.Module):
+    def __init__(self, model: TextToTextModel) -> None:
+        super().__init__()
+        self.encoder = model.encoder
+
+    def forward(self, input_ids: LongTensor, attention_mask: LongTensor) -> Tensor:
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=True).last_hidden_state
+
+
+def stack_past_key_values(past_key_values: tuple) -> tuple[Tensor, Tensor]:
+    '''
+    transformers的past_key_values：每层(self_k, self_v, cross_k, cross_v)，
+    合并为self_kv: (num_layers, 2, batch, n_heads, dec_len, d_kv)和cross_kv: (num_layers, 2, batch, n_heads, enc_len, d_kv)
+    '''
+    self_kv = torch.stack([torch.stack([layer[0], layer[1]]) for layer in past_key_values])
+    cross_kv = torch.stack([torch.stack([layer[2], layer[3]]) for layer in past_key_values])
+    return self_kv, cross_kv
+
+
+class DecoderInitWrapper(nn.Module):
+    def __init__(self, model: TextToTextModel) -> None:
+        super().__init__()
+        self.model = model
+
+    def forward(self, decoder_input_ids: LongTensor, encoder_hidden_states: Tensor, attention_mask: LongTensor) -> tuple[Tensor, Tensor, Tensor]:
+        outputs = self.model(
+            encoder_outputs=(encoder_hidden_states, ),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        self_kv, cross_kv = stack_past_key_values(outputs.past_key_values)
+        return outputs.logits, self_kv, cross_kv
+
+
+class DecoderWithPastWrapper(nn.Module):
+    def __init__(self, model: TextToTextModel) -> None:
+        super().__init__()
+        self.model = model
+        self.num_layers = model.config.num_decoder_layers
+
+    def forward(self, decoder_input_ids: LongTensor, encoder_hidden_states: Tensor, attention_mask: LongTensor, self_kv: Tensor, cross_kv: Tensor) -> tuple[Tensor, Tensor]:
+        past_key_values = tuple(
+            (self_kv[i, 0], self_kv[i, 1], cross_kv[i, 0], cross_kv[i, 1]) for i in range(self.num_layers)
+        )
+        outputs = self.model(
+            encoder_outputs=(encoder_hidden_states, ),
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            past_key_values=past_key_values,
+            use_cache=True,
+            return_dict=True,
+        )
+        self_kv, _ = stack_past_key_values(outputs.past_key_values)
+        return outputs.logits, self_kv
+
+
+@torch.no_grad()
+def export_torchscript(model: TextToTextModel, tokenizer: PreTrainedTokenizerFast, export_dir: str) -> None:
+    '''
+    把模型导出为三个TorchScript图（encoder、decoder第一步、带KV cache的decoder），和tokenizer.json、export_config.json
+    一起保存到export_dir，由model.torchscript_runtime加载，推理时不需要transformers。
+    导出使用CPU float32，torch.jit.trace只记录张量运算，batch、输入长度、KV cache长度不固定。
+    没有导出ONNX：onnxruntime不在项目依赖中，TorchScript只需要torch。
+    '''
+    model = model.float().cpu().eval()
+    config = model.config
+    os.makedirs(export_dir, exist_ok=True)
+
+    # trace的示例输入：batch=2，encoder输入第二行有padding
+    batch_size, enc_len, dec_len = 2, 6, 3
+    input_ids = torch.randint(5, config.vocab_size, (batch_size, enc_len), dtype=torch.long)
+    attention_mask = torch.ones((batch_size, enc_len), dtype=torch.long)
+    attention_mask[1, enc_len // 2: ] = 0
+
+    encoder = EncoderWrapper(model).eval()
+    encoder_hidden_states = encoder(input_ids, attention_mask)
+    traced_encoder = torch.jit.trace(encoder, (input_ids, attention_mask), check_trace=False)
+
+    decoder_input_ids = torch.full((batch_size, 1), config.decoder_start_token_id, dtype=torch.long)
+    decoder_init = DecoderInitWrapper(model).eval()
+    traced_decoder_init = torch.jit.trace(decoder_init, (decoder_input_ids, encoder_hidden_states, attention_mask), check_trace=False)
+
+    self_kv = torch.randn((config.num_decoder_layers, 2, batch_size, config.num_heads, dec_len, config.d_kv))
+    _, _, cross_kv = decoder_init(decoder_input_ids, encoder_hidden_states, attention_mask)
+    decoder_with_past = DecoderWithPastWrapper(model).eval()
+    traced_decoder_with_past = torch.jit.trace(decoder_with_past, (decoder_input_ids, encoder_hidden_states, attention_mask, self_kv, cross_kv), check_trace=False)
+
+    traced_encoder.save(os.path.join(export_dir, 'encoder.pt'))
+    traced_decoder_init.save(os.path.join(export_dir, 'decoder_init.pt'))
+    traced_decoder_with_past.save(os.path.join(export_dir, 'decoder_with_past.pt'))
+
+    tokenizer.backend_tokenizer.save(os.path.join(export_dir, 'tokenizer.json'))
+
+    # eos、pad和my_generate保持一致
+    export_config = {
+        'decoder_start_token_id': config.decoder_start_token_id,
+        'eos_token_id': 1,
+        'pad_token_id': 0,
+        'num_layers': config.num_decoder_layers,
+        'num_heads': config.num_heads,
+        'd_kv': config.d_kv,
+        'vocab_size': config.vocab_size,
+    }
+    with open(os.path.join(export_dir, 'export_config.json'), 'w', encoding='utf-8') as f:
+        ujson.dump(export_config, f, indent=4)
+
+
+@torch.no_grad()
+def validate_export(model: TextToTextModel, tokenizer: PreTrainedTokenizerFast, export_dir: str, prompts: list[str], max_seq_len: int=320, batch_size: int=8) -> dict:
+    '''
+    对比导出模型和my_generate的greedy search结果，逐个token比较，返回相同的序列数和总序列数
+    '''
+    model = model.float().cpu().eval()
+    runtime = TorchScriptT5(export_dir)
+    same, total = 0, 0
+
+    for start in range(0, len(prompts), batch_size):
+        encoded = tokenizer.batch_encode_plus([f"{prompt}[EOS]" for prompt in prompts[start: start + batch_size]], padding=True)
+        input_ids = torch.LongTensor(encoded.input_ids)
+        attention_mask = torch.LongTensor(encoded.attention_mask)
+
+        reference = model.my_generate(input_ids, attention_mask, max_seq_len=max_seq_len, search_type='greedy')
+        outputs = runtime.generate(input_ids, attention_mask, max_new_tokens=max_seq_len, search_type='greedy')
+
+        for ref, out in zip(reference.tolist(), outputs.tolist()):
+            # generate结束时的长度是batch内最长的序列，末尾的padding不比较
+            while len(ref) > 0 and ref[-1] == runtime.pad_token_id: ref.pop()
+            while len(out) > 0 and out[-1] == runtime.pad_token_id: out.pop()
+            same += int(ref == out)
+            total += 1
+
+    return {'same': same, 'total': total}
+
+
+if __name__ == '__main__':
+    import time
+    from dataclasses import replace
+    import pyarrow.parquet as pq
+    from model.infer import ChatBot
+    from config import InferConfig, TrainConfig
+
+    infer_config = InferConfig()
+    train_config = TrainConfig()
+
+    # 在CPU上以float32加载模型并导出，导出后用验证集的问题检查结果是否和my_generate相同
+    chat_bot = ChatBot(replace(infer_config, mixed_precision='no', quantization='no', response_cache_mb=0.0, encoder_cache_mb=0.0, warmup=False))
+    export_torchscript(chat_bot.model, chat_bot.tokenizer, infer_config.torchscript_dir)
+    print('exported to: {}'.format(infer_config.torchscript_dir))
+
+    prompts = ['你好', '感冒了要怎么办？', '请介绍一下北京。']
+    if os.path.exists(train_config.validation_file):
+        prompts = pq.read_table(train_config.validation_file)['prompt'].to_pylist()[0: 64]
+
+    print('identical outputs: {}'.format(validate_export(chat_bot.model, chat_bot.tokenizer, infer_config.torchscript_dir, prompts, max_seq_len=infer_config.max_seq_len)))
+
+    # 对比两种方式的greedy search速度
+    runtime = TorchScriptT5(infer_config.torchscript_dir)
+    for name, generate in [('my_generate', lambda x, mask: chat_bot.model.my_generate(x, mask, max_seq_len=infer_config.max_seq_len, search_type='greedy')),
+                           ('torchscript', lambda x, mask: runtime.generate(x, mask, max_new_tokens=infer_config.max_seq_len))]:
+        tokens, used_time = 0, 0.0
+        for prompt in prompts:
+            x = torch.LongTensor([chat_bot.encode(f"{prompt}[EOS]").input_ids])
+            start = time.perf_counter()
+            outputs = generate(x, torch.ones_like(x))
+            used_time += time.perf_counter() - start
+            tokens += int((outputs[:, 1: ] != runtime.pad_token_id).sum())
+        print('{}: {:.2f} tokens/s'.format(name, tokens / used_time))
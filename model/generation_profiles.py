@@ -0,0 +1,183 @@
+from collections import deque
+from dataclasses import dataclass, fields, replace, field
+from threading import Lock
+
+import ujson
+
+from model.logits_processors import build_logits_processors
+
+
+@dataclass
+class GenerationProfile:
+    '''
+    命名的生成参数（生成方式），my_generate的search_type、api请求的search_type都是profile的名称。
+    GenerationConfig和logits processor在第一次使用时创建并缓存，之后的调用直接复用，
+    generate内部会复制GenerationConfig，max_new_tokens等每次调用不同的参数作为generate的参数传入，不修改缓存的对象。
+    no_repeat_ngram_size、repetition_penalty使用model.logits_processors中张量化的实现。
+    early_exit_threshold不为None时为decoder提前退出的greedy search（见model.early_exit），只使用early_exit_*参数
+    '''
+    name: str
+    num_beams: int = 1
+    do_sample: bool = False
+    top_k: int = 50
+    top_p: float = 1.0
+    temperature: float = 1.0
+    penalty_alpha: float = None                 # contrastive search的惩罚系数，None: 不使用
+    length_penalty: float = 1.0
+    early_stopping: bool = False
+    no_repeat_ngram_size: int = 0
+    repetition_penalty: float = 1.0
+    early_exit_threshold: float = None          # decoder提前退出的置信度阈值，None: 不提前退出，0: 固定只计算前early_exit_min_layers层
+    early_exit_min_layers: int = 2              # 提前退出前最少计算的decoder层数
+
+    _cache: dict = field(default_factory=dict, init=False, repr=False, compare=False)
+
+    @property
+    def deterministic(self) -> bool:
+        '''
+        相同的输入总是得到相同的结果，可以使用回答缓存
+        '''
+        return not self.do_sample
+
+    @property
+    def is_greedy(self) -> bool:
+        '''
+        和greedy search结果相同，可以使用连续批处理引擎、编译的单步解码、投机解码
+        '''
+        return self.num_beams == 1 and not self.do_sample and self.penalty_alpha is None \
+            and self.no_repeat_ngram_size == 0 and self.repetition_penalty == 1.0 and self.early_exit_threshold is None
+
+    def to_dict(self) -> dict:
+        '''
+        生成参数（不包括下划线开头的缓存），不使用asdict：asdict会深拷贝缓存的GenerationConfig和logits processor
+        '''
+        return {f.name: getattr(self, f.name) for f in fields(self) if not f.name.startswith('_')}
+
+    def generation_config(self, decoder_start_token_id: int):
+        '''
+        缓存的GenerationConfig，eos、pad和my_generate保持一致
+        '''
+        key = ('generation_config', decoder_start_token_id)
+        if key not in self._cache:
+            # 只在使用transformers生成时import，torchscript运行时只读取profile的参数
+            from transformers.generation.configuration_utils import GenerationConfig
+
+            generation_config = GenerationConfig()
+            generation_config.remove_invalid_values = True
+            generation_config.eos_token_id = 1
+            generation_config.pad_token_id = 0
+            generation_config.decoder_start_token_id = decoder_start_token_id
+
+            generation_config.num_beams = self.num_beams
+            generation_config.do_sample = self.do_sample
+            generation_config.top_k = self.top_k
+            generation_config.top_p = self.top_p
+            generation_config.temperature = self.temperature
+            generation_config.penalty_alpha = self.penalty_alpha
+            generation_config.length_penalty = self.length_penalty
+            generation_config.early_stopping = self.early_stopping
+
+            self._cache[key] = generation_config
+
+        return self._cache[key]
+
+    def logits_processor(self):
+        '''
+        缓存的LogitsProcessorList，处理器没有状态，可以被多个请求同时使用
+        '''
+        if 'logits_processor' not in self._cache:
+            from transformers import LogitsProcessorList
+            self._cache['logits_processor'] = LogitsProcessorList(build_logits_processors(self.no_repeat_ngram_size, self.repetition_penalty))
+
+        return self._cache['logits_processor']
+
+
+# 生成方式注册表：名称 -> GenerationProfile
+GENERATION_PROFILES: dict[str, GenerationProfile] = {}
+
+
+def register_profile(profile: GenerationProfile, overwrite: bool=False) -> GenerationProfile:
+    '''
+    注册生成方式，名称已存在且overwrite=False时抛出ValueError
+    '''
+    if profile.name in GENERATION_PROFILES and not overwrite:
+        raise ValueError('generation profile {} is already registered.'.format(profile.name))
+    GENERATION_PROFILES[profile.name] = profile
+    return profile
+
+
+def get_profile(name: str) -> GenerationProfile:
+    if name not in GENERATION_PROFILES:
+        raise KeyError('unknown generation profile: {}, available profiles: {}'.format(name, list(GENERATION_PROFILES.keys())))
+    return GENERATION_PROFILES[name]
+
+
+# 内置的生成方式，参数和原来my_generate中的if/elif相同
+register_profile(GenerationProfile(name='greedy'))
+register_profile(GenerationProfile(name='beam', num_beams=5, do_sample=True, top_k=50, top_p=0.95, no_repeat_ngram_size=4, length_penalty=-2.0, early_stopping=True))
+# temperature越低，贫富差距越大，越高(>1)，越趋向于均匀分布
+register_profile(GenerationProfile(name='sampling', do_sample=True, top_k=50, temperature=0.98, top_p=0.80, no_repeat_ngram_size=4))
+register_profile(GenerationProfile(name='contrastive', penalty_alpha=0.5, top_k=50))
+# decoder提前退出，速度和质量的取舍用python model/early_exit.py评估，可以在generation_profiles_file中继承后修改阈值
+register_profile(GenerationProfile(name='early_exit', early_exit_threshold=0.9, early_exit_min_layers=2))
+
+
+def load_profiles(profiles_file: str) -> list[str]:
+    '''
+    从json文件加载自定义的生成方式，格式：{"名称": {参数}}，参数同GenerationProfile，
+    "base"为继承的已有生成方式（默认greedy），如：{"beam3": {"base": "beam", "num_beams": 3}}。
+    同名的生成方式会被覆盖，返回加载的名称
+    '''
+    with open(profiles_file, 'r', encoding='utf-8') as f:
+        profiles = ujson.load(f)
+
+    names = []
+    for name, params in profiles.items():
+        params = dict(params)
+        base = get_profile(params.pop('base', 'greedy'))
+        register_profile(replace(base, name=name, **params), overwrite=True)
+        names.append(name)
+
+    return names
+
+
+class ProfileMetrics:
+    def __init__(self, window: int=1024) -> None:
+        '''
+        按生成方式统计的请求数、生成token数、延迟和吞吐量，延迟分位数按最近window个请求计算
+        '''
+        self.window = window
+        self._lock = Lock()
+        self._metrics: dict[str, dict] = {}
+        self._latencies: dict[str, deque] = {}
+
+    def record(self, name: str, num_requests: int, num_tokens: int, seconds: float) -> None:
+        '''
+        记录一次生成：num_requests个请求一起生成（同一个batch的请求延迟相同），共num_tokens个token，耗时seconds秒
+        '''
+        with self._lock:
+            if name not in self._metrics:
+                self._metrics[name] = {'requests': 0, 'generated_tokens': 0, 'generate_time': 0.0}
+                self._latencies[name] = deque(maxlen=self.window)
+
+            metrics = self._metrics[name]
+            metrics['requests'] += num_requests
+            metrics['generated_tokens'] += num_tokens
+            metrics['generate_time'] += seconds
+            self._latencies[name].extend([seconds] * num_requests)
+
+    def get_stats(self) -> dict:
+        stats = {}
+        with self._lock:
+            for name, metrics in self._metrics.items():
+                latencies = sorted(self._latencies[name])
+                stats[name] = {
+                    'requests': metrics['requests'],
+                    'generated_tokens': metrics['generated_tokens'],
+                    'tokens_per_s': round(metrics['generated_tokens'] / metrics['generate_time'], 2) if metrics['generate_time'] > 0 else 0.0,
+                    'latency_ms_p50': round(latencies[len(latencies) // 2] * 1000, 2) if len(latencies) > 0 else 0.0,
+                    'latency_ms_p95': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000, 2) if len(latencies) > 0 else 0.0,
+                }
+
+        return stats
+
@@ -1,25 +1,83 @@
+import time
+_import_start = time.perf_counter()
+
 import os
-from threading import Thread
 import platform
 from typing import Union
+from concurrent.futures import Future
 import torch
+from torch import nn
 
-from transformers import TextIteratorStreamer,PreTrainedTokenizerFast
-from safetensors.torch import load_model
+from transformers import PreTrainedTokenizerFast, T5Config
+from transformers.modeling_outputs import BaseModelOutput
 
 from accelerate import init_empty_weights, load_checkpoint_and_dispatch
 
 # import 自定义类和函数
 from model.chat_model import TextToTextModel
+from model.batch_engine import ContinuousBatchingEngine
+from model.paged_engine import PagedBatchingEngine
+from model.streamer import TokenStreamer
+from model.session import ChatSession
+from model.speculative import SpeculativeDecoder, load_draft_model
+from model.compiled_decode import CompiledGenerator
+from model.generation_profiles import GenerationProfile, ProfileMetrics, get_profile, load_profiles
+from model.bucketing import bucket_by_length, pad_batch, PaddingStats
+from model.cache import EncoderCache, ResponseCache, checkpoint_hash
+from model.quantize import quantize_model, load_quantized_state_dict
+from model.shared_weights import build_empty_model, load_shared_weights, load_mmap_checkpoint
 from utils.functions import get_T5_config
+from utils.memory import get_memory_report
 
 from config import InferConfig, T5ModelConfig
 
+# import torch、transformers等模块的耗时（本模块第一次被import时），计入ChatBot的启动时间
+IMPORT_TIME = time.perf_counter() - _import_start
+
+
+def get_torch_dtype(mixed_precision: str, device: torch.device) -> torch.dtype:
+    '''
+    InferConfig.mixed_precision转换为加载模型的dtype：
+    'fp16'（'fp8'推理时同fp16）: GPU上为float16，CPU上float16的矩阵乘法很慢，使用float32；'bf16': bfloat16；'no'/'fp32': float32。
+    CPU上不会自动改用bfloat16：bfloat16的精度更低，结果和float32不同，只在明确配置'bf16'时使用。
+    '''
+    if mixed_precision in ('no', 'fp32', ''):
+        return torch.float32
+    if mixed_precision == 'bf16':
+        return torch.bfloat16
+    if mixed_precision in ('fp16', 'fp8'):
+        return torch.float16 if device.type == 'cuda' else torch.float32
+
+    raise ValueError("mixed_precision must be one of 'no', 'fp16', 'bf16', got: {}".format(mixed_precision))
+
+
+def cast_model_dtype(model: TextToTextModel, dtype: torch.dtype) -> TextToTextModel:
+    '''
+    转换模型的dtype，float16时_keep_in_fp32_modules（T5的前馈层输出wo）保持float32，防止溢出，
+    和from_pretrained(torch_dtype=torch.float16)的行为一致。T5LayerNorm内部使用float32计算方差，权重可以是半精度
+    '''
+    model = model.to(dtype)
+
+    keep_in_fp32_modules = getattr(model, '_keep_in_fp32_modules', None) or []
+    if dtype == torch.float16 and len(keep_in_fp32_modules) > 0:
+        for name, module in model.named_modules():
+            if isinstance(module, nn.Linear) and any(keep in name.split('.') for keep in keep_in_fp32_modules):
+                module.float()
+
+    return model
+
+
 class ChatBot:
     def __init__(self, infer_config: InferConfig) -> None:
         '''
+        启动耗时（秒）记录在self.startup_time：import、tokenizer、weights（构建模型并加载权重）、device（转移到GPU）、warmup。
+        safetensors权重文件（shared_weights_file或model_dir）在meta device上构建模型，直接使用内存映射的权重，
+        不做随机初始化，也不复制权重；torch checkpoint同样以内存映射方式读取。
         '''
         self.infer_config = infer_config
+        self.startup_time = {'import': round(IMPORT_TIME, 3)}
+        stage_start = init_start = time.perf_counter()
+
         # 初始化tokenizer
         tokenizer = PreTrainedTokenizerFast.from_pretrained(infer_config.model_dir)
         self.tokenizer = tokenizer
@@ -29,93 +87,408 @@ class ChatBot:
         
         t5_config = get_T5_config(T5ModelConfig(), vocab_size=len(tokenizer), decoder_start_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
 
+        self.startup_time['tokenizer'] = round(time.perf_counter() - stage_start, 3)
+        stage_start = time.perf_counter()
+
+        quantized = infer_config.quantization != 'no' or infer_config.quantize_embedding_bits > 0
+
+        # 量化模型只支持CPU float32推理
+        self.device = torch.device('cuda' if torch.cuda.is_available() and not quantized else 'cpu')
+        self.dtype = torch.float32 if quantized else get_torch_dtype(infer_config.mixed_precision, self.device)
+
+        self.model = self.load_model(t5_config, quantized)
+
+        self.startup_time['weights'] = round(time.perf_counter() - stage_start, 3)
+        stage_start = time.perf_counter()
+
+        self.model.to(self.device)
+        self.model.eval()
+
+        # 投机解码的草稿模型，和主模型使用相同的设备和dtype
+        self.speculative_decoder = None
+        if len(infer_config.draft_model_file) > 0 and os.path.exists(infer_config.draft_model_file):
+            draft_model = load_draft_model(infer_config.draft_model_file, vocab_size=len(tokenizer), decoder_start_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+            draft_model = cast_model_dtype(draft_model, self.model.dtype).to(self.device).eval()
+            self.speculative_decoder = SpeculativeDecoder(self.model, draft_model, num_draft_tokens=infer_config.num_draft_tokens)
+
+        # torch.compile编译的单步解码，用于非流式的批量生成，编译在warmup中进行，失败时退回eager
+        self.compiled_generator = None
+        if infer_config.compile_decode:
+            self.compiled_generator = CompiledGenerator(
+                self.model,
+                max_seq_len=infer_config.max_seq_len,
+                bucket_size=infer_config.compile_bucket_size,
+                compile_mode=infer_config.compile_mode,
+                pad_token_id=tokenizer.pad_token_id,
+                kv_cache_pool_mb=infer_config.kv_cache_pool_mb,
+            )
+
+        # my_generate中greedy生成方式的静态KV cache解码，开启compile_decode时就是编译的单步解码，否则为不编译的同一个单步函数
+        self.static_generator = self.compiled_generator
+        if self.static_generator is None and infer_config.static_kv_cache:
+            self.static_generator = CompiledGenerator(
+                self.model,
+                max_seq_len=infer_config.max_seq_len,
+                bucket_size=infer_config.compile_bucket_size,
+                compile=False,
+                pad_token_id=tokenizer.pad_token_id,
+                kv_cache_pool_mb=infer_config.kv_cache_pool_mb,
+            )
+
+        self.startup_time['device'] = round(time.perf_counter() - stage_start, 3)
+        stage_start = time.perf_counter()
+
+        if infer_config.warmup:
+            self.warmup()
+
+        self.startup_time['warmup'] = round(time.perf_counter() - stage_start, 3)
+        self.startup_time['total'] = round(time.perf_counter() - init_start + IMPORT_TIME, 3)
+
+        print('model loaded, device: {}, dtype: {}, startup time (s): {}, memory: {}'.format(self.device, self.dtype, self.startup_time, get_memory_report()))
+
+        # 连续批处理引擎，第一次调用submit时才创建
+        self.engine = None
+
+        # 自定义的生成方式，和按生成方式统计的延迟、吞吐量
+        if len(infer_config.generation_profiles_file) > 0:
+            print('generation profiles loaded: {}'.format(load_profiles(infer_config.generation_profiles_file)))
+        self.get_profile(infer_config.generation_profile)
+        self.profile_metrics = ProfileMetrics()
+
+        # 批量生成的填充浪费统计
+        self.padding_stats = PaddingStats()
+
+        # encoder输出缓存，重复的prompt跳过encoder
+        self.encoder_cache = None
+        if infer_config.encoder_cache_mb > 0:
+            self.encoder_cache = EncoderCache(max_memory_mb=infer_config.encoder_cache_mb, ttl=infer_config.encoder_cache_ttl)
+
+        # greedy search的回答缓存，相同的问题直接返回
+        self.response_cache = None
+        if infer_config.response_cache_mb > 0:
+            self.response_cache = ResponseCache(
+                model_hash=checkpoint_hash(self.weights_file),
+                max_memory_mb=infer_config.response_cache_mb,
+                sqlite_file=infer_config.response_cache_file if len(infer_config.response_cache_file) > 0 else None,
+                sqlite_max_mb=infer_config.response_cache_file_mb,
+            )
+
+    def load_model(self, t5_config: T5Config, quantized: bool) -> TextToTextModel:
+        '''
+        按优先级加载模型权重：量化模型文件、共享权重文件、model_dir（文件夹、safetensors或torch checkpoint），
+        都失败时使用accelerate加载。需要量化但没有量化模型文件（或文件的量化参数和配置不一致）时，加载后再量化。
+        实际加载的权重文件（或文件夹）记录在self.weights_file，用于回答缓存的模型指纹
+        '''
+        infer_config = self.infer_config
+        quantized_model_loaded = False
+        self.weights_file = infer_config.model_dir
+
+        # 量化模型文件的量化参数和配置不一致时不使用，加载原模型后再量化
+        quantized_state_dict = None
+        if quantized and os.path.exists(infer_config.quantized_model_file):
+            quantized_state_dict = load_quantized_state_dict(
+                infer_config.quantized_model_file,
+                quantization=infer_config.quantization,
+                embedding_bits=infer_config.quantize_embedding_bits,
+            )
+
         try:
-            model = TextToTextModel(t5_config)
+            if quantized_state_dict is not None:
+
+                # 直接加载保存好的量化模型，量化前的模型结构需要真实的权重
+                model = quantize_model(TextToTextModel(t5_config), quantization=infer_config.quantization, embedding_bits=infer_config.quantize_embedding_bits)
+                model.load_state_dict(quantized_state_dict)
+                quantized_model_loaded = True
+                self.weights_file = infer_config.quantized_model_file
+
+            elif not quantized and os.path.exists(infer_config.shared_weights_file):
 
-            if os.path.isdir(infer_config.model_dir):
+                # 内存映射加载，多个worker共享同一份权重的物理内存
+                model = load_shared_weights(build_empty_model(t5_config), infer_config.shared_weights_file)
+                self.weights_file = infer_config.shared_weights_file
+                if model.dtype != self.dtype:
+                    print('dtype of shared weights file is {}, expected {}, weights will be copied and not shared.'.format(model.dtype, self.dtype))
+                    model = cast_model_dtype(model, self.dtype)
 
-                # from_pretrained
-                model = model.from_pretrained(infer_config.model_dir)
+            elif os.path.isdir(infer_config.model_dir):
+
+                # from_pretrained，直接以目标dtype加载，low_cpu_mem_usage不做随机初始化
+                model = TextToTextModel.from_pretrained(infer_config.model_dir, torch_dtype=self.dtype, low_cpu_mem_usage=True)
 
             elif infer_config.model_dir.endswith('.safetensors'):
 
                 # load safetensors
-                load_model(model, infer_config.model_dir) 
+                model = load_shared_weights(build_empty_model(t5_config), infer_config.model_dir)
+                model = cast_model_dtype(model, self.dtype)
 
             else:
 
                 # load torch checkpoint
-                model.load_state_dict(torch.load(infer_config.model_dir))  
-
-            self.model = model
+                model = load_mmap_checkpoint(build_empty_model(t5_config), infer_config.model_dir)
+                model = cast_model_dtype(model, self.dtype)
 
         except Exception as e:
             print(str(e), 'transformers and pytorch load fail, try accelerate load function.')
+            self.weights_file = infer_config.model_dir
 
             empty_model = None
             with init_empty_weights():
                 empty_model = TextToTextModel(t5_config)
                 
-            self.model = load_checkpoint_and_dispatch(
+            model = load_checkpoint_and_dispatch(
                     model=empty_model,
                     checkpoint=infer_config.model_dir,
                     device_map='auto',
-                    dtype=torch.float16,
+                    dtype=self.dtype,
                 )
-       
 
-        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
-        self.model.to(self.device)
+        if quantized and not quantized_model_loaded:
+            model = quantize_model(model, quantization=infer_config.quantization, embedding_bits=infer_config.quantize_embedding_bits)
 
-        self.streamer = TextIteratorStreamer(tokenizer=tokenizer, clean_up_tokenization_spaces=True, skip_special_tokens=True)
+        return model
 
-    def stream_chat(self, input_txt: str) -> TextIteratorStreamer:
+    @torch.no_grad()
+    def warmup(self) -> None:
         '''
-        流式对话，线程启动后可返回，通过迭代streamer获取生成的文字，仅支持greedy search
+        用一个很短的生成预热（CUDA kernel、内存分配、torch.compile编译等），第一个请求不再承担这部分耗时，不经过缓存，不计入统计
         '''
-        encoded = self.encode(input_txt + '[EOS]')
-        
-        input_ids = torch.LongTensor([encoded.input_ids]).to(self.device)
-        attention_mask = torch.LongTensor([encoded.attention_mask]).to(self.device)
-
-        generation_kwargs = {
-            'input_ids': input_ids,
-            'attention_mask': attention_mask,
-            'max_seq_len': self.infer_config.max_seq_len,
-            'streamer': self.streamer,
-            'search_type': 'greedy',
-        }
-
-        thread = Thread(target=self.model.my_generate, kwargs=generation_kwargs)
-        thread.start()
+        input_ids = torch.LongTensor([self.encode('你好[EOS]').input_ids]).to(self.device)
+        self.model.my_generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_seq_len=4,
+            search_type='greedy',
+        )
+
+        # 编译batch=1、最短encoder输入的所有KV cache长度的桶，其他形状在第一次出现时编译
+        if self.compiled_generator is not None:
+            self.compiled_generator.warmup()
+
+    def stream_chat(self, input_txt: str, max_new_tokens: int=None) -> TokenStreamer:
+        '''
+        流式对话，请求提交到连续批处理引擎后立即返回，通过迭代streamer获取生成的文字，仅支持greedy search。
+        每个请求使用独立的streamer，多个用户同时流式对话不会相互干扰，
+        不再需要后续输出时（如客户端断开）调用streamer.cancel()停止生成。
+        max_new_tokens: 最多生成的token数，None或超过InferConfig.max_seq_len时为max_seq_len
+        '''
+        streamer = TokenStreamer(
+            tokenizer=self.tokenizer,
+            max_buffer_size=self.infer_config.stream_buffer_size,
+            stall_timeout=self.infer_config.stream_stall_timeout,
+        )
+
+        input_ids = self.encode(input_txt + '[EOS]').input_ids
+        self.get_engine().submit(input_ids, max_new_tokens=max_new_tokens, streamer=streamer)
         
-        return self.streamer
+        return streamer
     
-    def chat(self, input_txt: Union[str, list[str]] ) -> Union[str, list[str]]:
+    def create_session(self, max_history_tokens: int=None, encode_mode: str=None) -> ChatSession:
+        '''
+        创建一个多轮对话会话，参数默认使用InferConfig.session_max_history_tokens、session_encode_mode
+        '''
+        return ChatSession(
+            chat_bot=self,
+            max_history_tokens=self.infer_config.session_max_history_tokens if max_history_tokens is None else max_history_tokens,
+            encode_mode=self.infer_config.session_encode_mode if encode_mode is None else encode_mode,
+        )
+    
+    def get_profile(self, search_type: str=None) -> GenerationProfile:
+        '''
+        search_type为None时使用InferConfig.generation_profile，不存在时抛出KeyError
+        '''
+        return get_profile(self.infer_config.generation_profile if search_type is None else search_type)
+
+    def get_max_new_tokens(self, max_new_tokens: int=None) -> int:
+        '''
+        请求的最大生成token数，None时为InferConfig.max_seq_len，不超过max_seq_len
+        '''
+        return self.infer_config.max_seq_len if max_new_tokens is None else min(max_new_tokens, self.infer_config.max_seq_len)
+
+    def chat(self, input_txt: Union[str, list[str]], search_type: str=None, max_new_tokens: int=None, stopping_criteria: list=None) -> Union[str, list[str]]:
         '''
         非流式生成，可以使用beam search、beam sample等方法生成文本。
+        search_type: 生成方式的名称（见model.generation_profiles），None时使用InferConfig.generation_profile，
+        只有结果确定（不随机采样）的生成方式使用回答缓存；
+        max_new_tokens: 最多生成的token数，None时为InferConfig.max_seq_len；
+        stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria），提前停止的不完整结果不写入回答缓存
         '''
         if isinstance(input_txt, str):
             input_txt = [input_txt]
         elif not isinstance(input_txt, list):
             raise Exception('input_txt mast be a str or list[str]')
         
-        # add EOS token
-        input_txts = [f"{txt}[EOS]" for txt in input_txt]
-        encoded = self.batch_encode_plus(input_txts,  padding=True)
-        input_ids = torch.LongTensor(encoded.input_ids).to(self.device)
-        attention_mask = torch.LongTensor(encoded.attention_mask).to(self.device)
+        outputs = [None] * len(input_txt)
+        profile = self.get_profile(search_type)
+        generation_config = self.generation_config_dict(profile, max_new_tokens)
+        response_cache = self.response_cache if profile.deterministic else None
 
-        outputs = self.model.my_generate(
-                            input_ids=input_ids,
-                            attention_mask=attention_mask,
-                            max_seq_len=self.infer_config.max_seq_len,
-                            search_type='greedy',
-                        )
+        if response_cache is not None:
+            outputs = [response_cache.get(txt, generation_config) for txt in input_txt]
 
-        outputs = self.batch_decode(outputs.cpu().numpy(),  clean_up_tokenization_spaces=True, skip_special_tokens=True)
+        miss_index = [i for i, output in enumerate(outputs) if output is None]
+        if len(miss_index) > 0:
+            miss_outputs = self.generate_batch([input_txt[i] for i in miss_index], search_type=profile.name, max_new_tokens=max_new_tokens, stopping_criteria=stopping_criteria)
+            stopped = stopping_criteria is not None and any(getattr(criteria, 'triggered', False) for criteria in stopping_criteria)
+            for i, output in zip(miss_index, miss_outputs):
+                outputs[i] = output
+                if response_cache is not None and not stopped:
+                    response_cache.put(input_txt[i], generation_config, output)
 
         note = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
         outputs = [item if len(item) != 0 else note for item in outputs]
 
         return outputs[0] if len(outputs) == 1 else outputs
+
+    def generation_config_dict(self, profile: GenerationProfile=None, max_new_tokens: int=None) -> dict:
+        '''
+        影响生成结果的参数，作为回答缓存key的一部分，greedy以外的生成方式加上所有参数，修改自定义生成方式的参数后不会命中旧的缓存
+        '''
+        profile = get_profile('greedy') if profile is None else profile
+        config = {'search_type': profile.name, 'max_seq_len': self.get_max_new_tokens(max_new_tokens), 'dtype': str(self.dtype), 'quantization': self.infer_config.quantization,
+                  'quantize_embedding_bits': self.infer_config.quantize_embedding_bits}
+        if profile.name != 'greedy':
+            config['profile'] = profile.to_dict()
+
+        return config
+
+    def generate_batch(self,
+                input_txts: list[str],
+                max_batch_size: int=None,
+                max_batch_tokens: int=None,
+                expected_output_lens: list[int]=None,
+                search_type: str=None,
+                max_new_tokens: int=None,
+                stopping_criteria: list=None,
+                profile_metrics: ProfileMetrics=None,
+            ) -> list[str]:
+        '''
+        批量生成，先按token长度分桶（长度相近的prompt放到同一个batch，减少填充），
+        每个桶调用一次my_generate，结果按输入顺序返回，空回答不做替换。配置了草稿模型时改为逐条投机解码，
+        和greedy结果相同的生成方式使用静态KV cache解码（self.static_generator，开启compile_decode时为编译的单步解码）。
+        expected_output_lens: 预计的输出长度，prompt长度相同时按输出长度排序
+        search_type: 生成方式的名称，None时使用InferConfig.generation_profile，每个桶的耗时和生成的token数计入该生成方式的统计
+        max_new_tokens: 最多生成的token数，None时为InferConfig.max_seq_len
+        stopping_criteria: 额外的停止条件，满足时当前桶停止生成，之后的桶生成一步后也会停止
+        profile_metrics: 除了self.profile_metrics，每个桶的耗时和生成的token数额外计入该统计（如批量任务单独的吞吐量）
+        '''
+        profile = self.get_profile(search_type)
+        max_new_tokens = self.get_max_new_tokens(max_new_tokens)
+        metrics_list = [self.profile_metrics] if profile_metrics is None else [self.profile_metrics, profile_metrics]
+
+        def record(num_requests: int, num_tokens: int, seconds: float) -> None:
+            for metrics in metrics_list:
+                metrics.record(profile.name, num_requests, num_tokens, seconds)
+
+        max_batch_size = self.infer_config.max_batch_size if max_batch_size is None else max_batch_size
+        max_batch_tokens = self.infer_config.max_batch_tokens if max_batch_tokens is None else max_batch_tokens
+
+        # add EOS token
+        encoded = [self.encode(f"{txt}[EOS]").input_ids for txt in input_txts]
+
+        # 有草稿模型时逐条投机解码，降低单个请求的延迟，输出和greedy search相同
+        if self.speculative_decoder is not None and profile.is_greedy:
+            outputs = []
+            for ids in encoded:
+                start = time.perf_counter()
+                outputs.append(self.speculative_decoder.generate(ids, max_new_tokens=max_new_tokens, stopping_criteria=stopping_criteria))
+                record(1, len(outputs[-1]), time.perf_counter() - start)
+            return self.batch_decode(outputs, clean_up_tokenization_spaces=True, skip_special_tokens=True)
+
+        buckets = bucket_by_length([len(ids) for ids in encoded], max_batch_size, max_batch_tokens, expected_output_lens)
+
+        outputs = [None] * len(input_txts)
+        for bucket in buckets:
+            batch_ids = [encoded[i] for i in bucket]
+            self.padding_stats.update([len(ids) for ids in batch_ids])
+
+            input_ids, attention_mask = pad_batch(batch_ids, pad_token_id=self.tokenizer.pad_token_id)
+            start = time.perf_counter()
+
+            encoder_outputs = None
+            if self.encoder_cache is not None:
+                encoder_hidden_states, attention_mask = self.encoder_cache.encode(self.model, batch_ids, pad_token_id=self.tokenizer.pad_token_id)
+                encoder_outputs = BaseModelOutput(last_hidden_state=encoder_hidden_states)
+
+            batch_outputs = self.model.my_generate(
+                                input_ids=input_ids.to(self.device),
+                                attention_mask=attention_mask.to(self.device),
+                                max_seq_len=max_new_tokens,
+                                search_type=profile.name,
+                                encoder_outputs=encoder_outputs,
+                                stopping_criteria=stopping_criteria,
+                                static_generator=self.static_generator,
+                            )
+            record(len(bucket), int((batch_outputs[:, 1: ] != self.tokenizer.pad_token_id).sum()), time.perf_counter() - start)
+            batch_outputs = self.batch_decode(batch_outputs.cpu().numpy(),  clean_up_tokenization_spaces=True, skip_special_tokens=True)
+
+            for i, output in zip(bucket, batch_outputs):
+                outputs[i] = output
+
+        return outputs
+
+    def get_engine(self) -> ContinuousBatchingEngine:
+        '''
+        获取（不存在则创建并启动）连续批处理引擎
+        '''
+        if self.engine is None:
+            if self.infer_config.kv_cache_mode == 'paged':
+                self.engine = PagedBatchingEngine(
+                    model=self.model,
+                    max_batch_size=self.infer_config.max_batch_size,
+                    max_new_tokens=self.infer_config.max_seq_len,
+                    encoder_cache=self.encoder_cache,
+                    kv_cache_mb=self.infer_config.kv_cache_paged_mb,
+                    block_size=self.infer_config.kv_block_size,
+                )
+            else:
+                self.engine = ContinuousBatchingEngine(
+                    model=self.model,
+                    max_batch_size=self.infer_config.max_batch_size,
+                    max_new_tokens=self.infer_config.max_seq_len,
+                    encoder_cache=self.encoder_cache,
+                )
+            self.engine.start()
+        
+        return self.engine
+
+    def submit(self, input_txt: str, max_new_tokens: int=None) -> Future:
+        '''
+        通过连续批处理引擎提交一个请求（greedy search，计入greedy的统计），并发请求会在解码的每一步合并为一个batch，
+        返回concurrent.futures.Future，结果为回答文本，asyncio中可以用asyncio.wrap_future等待，
+        取消Future后请求在引擎的下一个解码步退出
+        '''
+        note = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
+        result = Future()
+        generation_config = self.generation_config_dict(max_new_tokens=max_new_tokens)
+
+        if self.response_cache is not None:
+            output = self.response_cache.get(input_txt, generation_config)
+            if output is not None:
+                result.set_result(output if len(output) != 0 else note)
+                return result
+
+        engine = self.get_engine()
+        input_ids = self.encode(f"{input_txt}[EOS]").input_ids
+        start = time.perf_counter()
+
+        def decode_callback(engine_future: Future) -> None:
+            if engine_future.cancelled() or result.done():
+                return
+            if engine_future.exception() is not None:
+                result.set_exception(engine_future.exception())
+                return
+
+            self.profile_metrics.record('greedy', 1, len(engine_future.result()), time.perf_counter() - start)
+            output = self.batch_decode([engine_future.result()], clean_up_tokenization_spaces=True, skip_special_tokens=True)[0]
+            if self.response_cache is not None:
+                self.response_cache.put(input_txt, generation_config, output)
+
+            result.set_result(output if len(output) != 0 else note)
+
+        engine_future = engine.submit(input_ids, max_new_tokens=max_new_tokens)
+        engine_future.add_done_callback(decode_callback)
+
+        # 取消result时同时取消引擎中的请求
+        result.add_done_callback(lambda future: engine_future.cancel() if future.cancelled() else None)
+
+        return result
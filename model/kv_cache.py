@@ -0,0 +1,323 @@
+import heapq
+from threading import Lock
+from collections import OrderedDict
+
+import torch
+from torch import Tensor
+
+
+class StaticKVCache:
+    def __init__(self, key: tuple, self_kv: Tensor, cross_kv: Tensor) -> None:
+        '''
+        预先分配的KV cache，整个生成过程中不再分配或拼接：
+        self_kv: (num_layers, 2, batch, n_heads, max_len, d_kv)，decoder self-attention，按位置原地写入，
+            max_len由InferConfig.max_seq_len决定，使用时取前cache_len个位置的视图；
+        cross_kv: (num_layers, 2, batch, n_heads, enc_len, d_kv)，cross-attention，每个请求开始时计算一次写入
+        '''
+        self.key = key
+        self.self_kv = self_kv
+        self.cross_kv = cross_kv
+
+    @property
+    def nbytes(self) -> int:
+        return self.self_kv.numel() * self.self_kv.element_size() + self.cross_kv.numel() * self.cross_kv.element_size()
+
+    def self_kv_view(self, cache_len: int) -> Tensor:
+        '''
+        前cache_len个位置的视图，不复制，同一个cache_len的视图stride相同，编译后的图可以复用
+        '''
+        return self.self_kv[:, :, :, :, : cache_len, :]
+
+
+class KVCachePool:
+    def __init__(self,
+                num_layers: int,
+                n_heads: int,
+                d_kv: int,
+                max_seq_len: int,
+                dtype: torch.dtype=torch.float32,
+                device: torch.device=torch.device('cpu'),
+                max_memory_mb: float=512.0,
+            ) -> None:
+        '''
+        StaticKVCache的缓冲池，按(batch, encoder长度)分组，请求结束后归还，下一个相同形状的请求直接复用，
+        长时间运行的API worker不会因为每个请求反复分配、释放大块内存产生内存碎片。
+        调用方应先对batch和encoder长度分桶，形状种类少，复用率才高。
+        空闲缓冲的总大小超过max_memory_mb时，释放最久没有使用的；正在使用的缓冲不计入限制。
+        统计信息：allocations（新分配次数）、reuses（复用次数）、evictions（释放次数）、in_use、free、free_mb、peak_mb
+        '''
+        self.num_layers = num_layers
+        self.n_heads = n_heads
+        self.d_kv = d_kv
+        self.max_seq_len = max_seq_len
+        self.dtype = dtype
+        self.device = device
+        self.max_memory_bytes = int(max_memory_mb * 1024 * 1024)
+
+        self._lock = Lock()
+        self._free: OrderedDict[tuple, list[StaticKVCache]] = OrderedDict()
+        self._free_bytes = 0
+        self._in_use_bytes = 0
+        self._in_use = 0
+
+        self.stats = {'allocations': 0, 'reuses': 0, 'evictions': 0, 'peak_mb': 0.0}
+
+    def _allocate(self, key: tuple) -> StaticKVCache:
+        batch_size, enc_len = key
+        self_kv = torch.zeros((self.num_layers, 2, batch_size, self.n_heads, self.max_seq_len, self.d_kv), dtype=self.dtype, device=self.device)
+        cross_kv = torch.zeros((self.num_layers, 2, batch_size, self.n_heads, enc_len, self.d_kv), dtype=self.dtype, device=self.device)
+        return StaticKVCache(key, self_kv, cross_kv)
+
+    def acquire(self, batch_size: int, enc_len: int) -> StaticKVCache:
+        '''
+        取出一个(batch_size, enc_len)的缓冲，没有空闲的则新分配。缓冲中可能有上一个请求的数据，
+        self-attention只读取已经写入的位置，cross-attention由调用方整体覆盖，不需要清零
+        '''
+        key = (batch_size, enc_len)
+        cache = None
+
+        with self._lock:
+            if key in self._free and len(self._free[key]) > 0:
+                cache = self._free[key].pop()
+                self._free.move_to_end(key)
+                self._free_bytes -= cache.nbytes
+                self.stats['reuses'] += 1
+
+        if cache is None:
+            cache = self._allocate(key)
+            with self._lock:
+                self.stats['allocations'] += 1
+
+        with self._lock:
+            self._in_use += 1
+            self._in_use_bytes += cache.nbytes
+            self.stats['peak_mb'] = max(self.stats['peak_mb'], (self._in_use_bytes + self._free_bytes) / 1024 / 1024)
+
+        return cache
+
+    def release(self, cache: StaticKVCache) -> None:
+        '''
+        归还缓冲，空闲缓冲超过内存限制时从最久没有使用的形状开始释放
+        '''
+        with self._lock:
+            self._in_use -= 1
+            self._in_use_bytes -= cache.nbytes
+
+            self._free.setdefault(cache.key, []).append(cache)
+            self._free.move_to_end(cache.key)
+            self._free_bytes += cache.nbytes
+
+            while self._free_bytes > self.max_memory_bytes and len(self._free) > 0:
+                key, caches = next(iter(self._free.items()))
+                evicted = caches.pop(0)
+                self._free_bytes -= evicted.nbytes
+                self.stats['evictions'] += 1
+                if len(caches) == 0:
+                    del self._free[key]
+
+    def clear(self) -> None:
+        with self._lock:
+            self._free.clear()
+            self._free_bytes = 0
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['in_use'] = self._in_use
+            stats['free'] = sum(len(caches) for caches in self._free.values())
+            stats['in_use_mb'] = round(self._in_use_bytes / 1024 / 1024, 2)
+            stats['free_mb'] = round(self._free_bytes / 1024 / 1024, 2)
+
+        stats['peak_mb'] = round(stats['peak_mb'], 2)
+        requests = stats['allocations'] + stats['reuses']
+        stats['reuse_rate'] = round(stats['reuses'] / requests, 4) if requests > 0 else 0.0
+
+        return stats
+
+
+class OutOfBlocksError(Exception):
+    pass
+
+
+class KVBlockManager:
+    def __init__(self,
+                num_blocks: int,
+                block_size: int,
+                num_layers: int,
+                n_heads: int,
+                d_kv: int,
+                dtype: torch.dtype=torch.float32,
+                device: torch.device=torch.device('cpu'),
+                grow_blocks: int=64,
+            ) -> None:
+        '''
+        分页（block）KV cache：最多num_blocks个固定大小的块，每块存block_size个位置的k、v，
+        每层一个存储：layers[i]: (2, n_heads, capacity, block_size, d_kv)。
+        每个序列（key，如decoder self-attention和cross-attention分别一个）有自己的块表，写入时按需分配新块，
+        序列结束后整块归还，不同长度的序列不需要填充到batch中最长的长度，只有每个序列最后一块有未用完的位置。
+        存储不预先分配num_blocks块：开始时grow_blocks块，使用的块编号超出容量时逐层扩容grow_blocks块（不超过num_blocks），
+        总是分配编号最小的空闲块，容量只随同时使用的块数增长，最多比使用的块多grow_blocks块。
+        统计信息：occupancy（已分配块的比例）、fragmentation（已分配块中未使用位置的比例，即块内碎片）、
+        memory_mb（当前容量占用的内存）、max_memory_mb（num_blocks块的内存上限）
+        '''
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.num_layers = num_layers
+        self.n_heads = n_heads
+        self.d_kv = d_kv
+        self.dtype = dtype
+        self.device = device
+
+        self.grow_blocks = max(1, grow_blocks)
+        self.capacity = 0
+        self.layers: list[Tensor] = [self._empty(0) for _ in range(num_layers)]
+        self._grow(min(num_blocks, self.grow_blocks))
+
+        self._free_blocks = list(range(num_blocks))     # 最小堆，分配编号最小的空闲块
+        self._tables: dict = {}
+        self._lengths: dict = {}
+
+        self.stats = {'allocated_blocks': 0, 'freed_blocks': 0, 'peak_used_blocks': 0, 'grows': 0}
+
+    def _empty(self, capacity: int) -> Tensor:
+        return torch.zeros((2, self.n_heads, capacity, self.block_size, self.d_kv), dtype=self.dtype, device=self.device)
+
+    def _grow(self, capacity: int) -> None:
+        '''
+        扩容到capacity块，逐层复制，临时多占用的内存不超过一层的旧存储
+        '''
+        for i, old in enumerate(self.layers):
+            layer = self._empty(capacity)
+            layer[:, :, : self.capacity] = old
+            self.layers[i] = layer
+        self.capacity = capacity
+
+    def blocks_needed_to_grow(self, num_blocks: int) -> int:
+        return (num_blocks + self.grow_blocks - 1) // self.grow_blocks * self.grow_blocks
+
+    @property
+    def block_bytes(self) -> int:
+        '''
+        一块（所有层）占用的字节数
+        '''
+        return self.num_layers * 2 * self.n_heads * self.block_size * self.d_kv * torch.finfo(self.dtype).bits // 8
+
+    @property
+    def num_free_blocks(self) -> int:
+        return len(self._free_blocks)
+
+    def blocks_needed(self, num_tokens: int) -> int:
+        return (num_tokens + self.block_size - 1) // self.block_size
+
+    def length(self, key) -> int:
+        return self._lengths.get(key, 0)
+
+    def block_table(self, key) -> list[int]:
+        return self._tables.get(key, [])
+
+    def reserve(self, key, num_tokens: int) -> None:
+        '''
+        为key增加num_tokens个位置，需要时分配新块，空闲块不够时抛出OutOfBlocksError（不会分配一部分）
+        '''
+        table = self._tables.get(key, [])
+        length = self._lengths.get(key, 0)
+        num_new_blocks = self.blocks_needed(length + num_tokens) - len(table)
+
+        if num_new_blocks > len(self._free_blocks):
+            raise OutOfBlocksError('need {} kv blocks, only {} free.'.format(num_new_blocks, len(self._free_blocks)))
+
+        self._tables[key] = table
+        for _ in range(num_new_blocks):
+            table.append(heapq.heappop(self._free_blocks))
+
+        if num_new_blocks > 0 and table[-1] >= self.capacity:
+            needed = table[-1] + 1 - self.capacity
+            self._grow(min(self.num_blocks, self.capacity + self.blocks_needed_to_grow(needed)))
+            self.stats['grows'] += 1
+
+        self._lengths[key] = length + num_tokens
+        self.stats['allocated_blocks'] += num_new_blocks
+        self.stats['peak_used_blocks'] = max(self.stats['peak_used_blocks'], self.num_blocks - len(self._free_blocks))
+
+    def free(self, key) -> None:
+        '''
+        归还key的所有块
+        '''
+        table = self._tables.pop(key, [])
+        self._lengths.pop(key, None)
+        for block in table:
+            heapq.heappush(self._free_blocks, block)
+        self.stats['freed_blocks'] += len(table)
+
+    def write(self, key, kv: Tensor, start: int=0) -> None:
+        '''
+        写入连续的位置：kv: (num_layers, 2, n_heads, num_tokens, d_kv)，写到key的start开始的位置，位置需要已经reserve
+        '''
+        table = self._tables[key]
+        num_tokens = kv.shape[3]
+        position = start
+
+        while position < start + num_tokens:
+            block, offset = table[position // self.block_size], position % self.block_size
+            n = min(self.block_size - offset, start + num_tokens - position)
+            for i, layer in enumerate(self.layers):
+                layer[:, :, block, offset: offset + n, :] = kv[i, :, :, position - start: position - start + n, :]
+            position += n
+
+    def write_slots(self, layer: int, kv: Tensor, block_index: Tensor, block_offset: Tensor) -> None:
+        '''
+        每个解码步批量写入一个位置：kv: (2, batch, n_heads, d_kv)，block_index、block_offset见slot_index
+        '''
+        self.layers[layer][:, :, block_index, block_offset, :] = kv.transpose(1, 2)
+
+    def slot_index(self, keys: list, positions: list[int]) -> tuple[Tensor, Tensor]:
+        '''
+        每个key在positions位置的(块编号, 块内偏移)，用于每个解码步批量写入一个位置
+        '''
+        blocks = [self._tables[key][position // self.block_size] for key, position in zip(keys, positions)]
+        offsets = [position % self.block_size for position in positions]
+        return torch.tensor(blocks, dtype=torch.long, device=self.device), torch.tensor(offsets, dtype=torch.long, device=self.device)
+
+    def block_index(self, keys: list) -> tuple[Tensor, Tensor]:
+        '''
+        多个序列的块表：(batch, max_blocks)，块数不足的序列用块0补齐，和每个序列的有效长度(batch, )，
+        有效长度之后的位置是其他块或空块的数据，需要用mask屏蔽
+        '''
+        tables = [self._tables.get(key, []) for key in keys]
+        max_blocks = max(1, max(len(table) for table in tables))
+
+        index = torch.tensor([table + [0] * (max_blocks - len(table)) for table in tables], dtype=torch.long, device=self.device)
+        lengths = torch.tensor([self._lengths.get(key, 0) for key in keys], dtype=torch.long, device=self.device)
+
+        return index, lengths
+
+    def gather_layer(self, layer: int, index: Tensor) -> tuple[Tensor, Tensor]:
+        '''
+        按块表取出一层的k、v：(batch, n_heads, max_blocks * block_size, d_kv)，只复制这一层用到的块，用完即释放
+        '''
+        batch_size, max_blocks = index.shape
+        kv = self.layers[layer].index_select(2, index.view(-1))
+        kv = kv.view(2, self.n_heads, batch_size, max_blocks * self.block_size, self.d_kv).transpose(1, 2)
+
+        return kv[0], kv[1]
+
+    def get_stats(self) -> dict:
+        used_blocks = self.num_blocks - len(self._free_blocks)
+        used_tokens = sum(self._lengths.values())
+
+        stats = dict(self.stats)
+        stats.update({
+            'num_blocks': self.num_blocks,
+            'capacity_blocks': self.capacity,
+            'block_size': self.block_size,
+            'used_blocks': used_blocks,
+            'free_blocks': len(self._free_blocks),
+            'sequences': len(self._tables),
+            'used_tokens': used_tokens,
+            'occupancy': round(used_blocks / self.num_blocks, 4),
+            'fragmentation': round(1.0 - used_tokens / (used_blocks * self.block_size), 4) if used_blocks > 0 else 0.0,
+            'memory_mb': round(self.capacity * self.block_bytes / 1024 / 1024, 2),
+            'max_memory_mb': round(self.num_blocks * self.block_bytes / 1024 / 1024, 2),
+        })
+
+        return stats
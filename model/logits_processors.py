@@ -0,0 +1,113 @@
+import sys
+sys.path.extend(['.','..'])
+
+import torch
+from torch import Tensor, LongTensor
+
+# TensorNoRepeatNGramLogitsProcessor只依赖torch，接口和transformers的LogitsProcessor相同：processor(input_ids, scores) -> scores，
+# 可以直接放入LogitsProcessorList传给generate，也可以在torchscript_runtime中使用（不import transformers）。
+# input_ids: (batch * num_beams, cur_len)，scores: (batch * num_beams, vocab_size)，每一步都在device上批量计算，
+# 不按序列逐个循环，也不把input_ids复制到CPU。
+# 重复词惩罚transformers的实现已经是张量化的，直接使用RepetitionPenaltyLogitsProcessor。
+
+
+class TensorNoRepeatNGramLogitsProcessor:
+    def __init__(self, ngram_size: int) -> None:
+        '''
+        禁止生成重复的n-gram，结果和transformers的NoRepeatNGramLogitsProcessor相同。
+        transformers的实现每一步把每个序列（beam search时每个beam）转为python list，用dict统计所有n-gram，
+        batch和beam越多越慢；这里用unfold取出所有n-gram，把前n-1个token编码为一个int64的key，
+        和最后n-1个token的key比较，匹配的n-gram的最后一个token就是要禁止的token。
+        vocab_size ** (n - 1)超过int64时key会溢出，改为逐个token比较。
+        '''
+        if ngram_size <= 0:
+            raise ValueError('ngram_size must be a positive integer, got: {}'.format(ngram_size))
+        self.ngram_size = ngram_size
+
+    @staticmethod
+    def ngram_keys(ngrams: LongTensor, vocab_size: int) -> LongTensor:
+        '''
+        ngrams: (..., n - 1) -> (..., )，按vocab_size进制编码，vocab_size ** (n - 1) < 2 ** 63时没有冲突
+        '''
+        base = torch.tensor([vocab_size ** i for i in range(ngrams.shape[-1])], dtype=torch.long, device=ngrams.device)
+        return (ngrams * base).sum(dim=-1)
+
+    def __call__(self, input_ids: LongTensor, scores: Tensor) -> Tensor:
+        n = self.ngram_size
+        cur_len = input_ids.shape[1]
+
+        if n == 1:
+            return scores.scatter_(1, input_ids, -float('inf'))
+
+        # 至少有一个完整的n-gram才需要处理
+        if cur_len < n:
+            return scores
+
+        # (batch, cur_len - n + 1, n)，最后一个n-gram的前n-1个token和当前的前缀部分重叠，和transformers一致也参与比较
+        ngrams = input_ids.unfold(1, n, 1)
+        prefixes, next_tokens = ngrams[:, :, : -1], ngrams[:, :, -1]
+        current = input_ids[:, cur_len - n + 1: ]
+
+        vocab_size = scores.shape[-1]
+        if (n - 1) * (vocab_size - 1).bit_length() < 63:
+            matched = self.ngram_keys(prefixes, vocab_size) == self.ngram_keys(current, vocab_size)[:, None]
+        else:
+            matched = (prefixes == current[:, None, :]).all(dim=-1)
+
+        # 同一个token可能既有匹配又有不匹配的n-gram，直接scatter结果不确定，
+        # 取最小值：匹配的位置为-inf，不匹配的为inf（不改变原来的score），不需要(batch, vocab_size)的临时张量，也不需要同步到CPU
+        banned = torch.full(matched.shape, float('inf'), dtype=scores.dtype, device=scores.device)
+        banned.masked_fill_(matched, -float('inf'))
+
+        return scores.scatter_reduce_(1, next_tokens, banned, reduce='amin')
+
+
+def build_logits_processors(no_repeat_ngram_size: int=0, repetition_penalty: float=1.0) -> list:
+    '''
+    按参数创建处理器，顺序和transformers的generate相同：先repetition_penalty，再no_repeat_ngram。
+    参数为默认值（不处理）时不创建对应的处理器，repetition_penalty使用transformers的RepetitionPenaltyLogitsProcessor（用到时才import）
+    '''
+    processors = []
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        from transformers import RepetitionPenaltyLogitsProcessor
+        processors.append(RepetitionPenaltyLogitsProcessor(repetition_penalty))
+    if no_repeat_ngram_size is not None and no_repeat_ngram_size > 0:
+        processors.append(TensorNoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+    return processors
+
+
+if __name__ == '__main__':
+    import time
+    from transformers import NoRepeatNGramLogitsProcessor
+
+    # 对比transformers和张量化实现每一步的耗时，batch_size * num_beams个序列，已生成cur_len个token
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    vocab_size, cur_len, ngram_size, repeat = 29298, 128, 4, 20
+
+    def time_step(processor, input_ids: LongTensor, scores: Tensor) -> float:
+        processor(input_ids, scores.clone())
+        if device.type == 'cuda': torch.cuda.synchronize()
+        start = time.perf_counter()
+        for _ in range(repeat):
+            processor(input_ids, scores.clone())
+        if device.type == 'cuda': torch.cuda.synchronize()
+        return (time.perf_counter() - start) / repeat * 1000
+
+    print('device: {}, vocab_size: {}, cur_len: {}, ngram_size: {}'.format(device, vocab_size, cur_len, ngram_size))
+    print('{:>6} {:>6} | {:>17} {:>17}'.format('batch', 'beams', 'hf ngram ms', 'tensor ngram ms'))
+
+    for batch_size in [1, 4, 16, 32]:
+        for num_beams in [1, 5]:
+            rows = batch_size * num_beams
+            # 从较小的词表中取token，模拟回答中的重复
+            input_ids = torch.randint(5, 200, (rows, cur_len), dtype=torch.long, device=device)
+            scores = torch.randn((rows, vocab_size), device=device)
+
+            hf_ngram, tensor_ngram = NoRepeatNGramLogitsProcessor(ngram_size), TensorNoRepeatNGramLogitsProcessor(ngram_size)
+
+            assert torch.equal(hf_ngram(input_ids, scores.clone()), tensor_ngram(input_ids, scores.clone()))
+
+            print('{:>6} {:>6} | {:>17.3f} {:>17.3f}'.format(
+                batch_size, num_beams,
+                time_step(hf_ngram, input_ids, scores), time_step(tensor_ngram, input_ids, scores),
+            ))
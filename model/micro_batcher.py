@@ -0,0 +1,132 @@
+import time
+from queue import Queue, Empty
+from threading import Thread, Event, Lock
+from concurrent.futures import Future, InvalidStateError
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from model.infer import ChatBot
+
+
+class MicroBatcher:
+    def __init__(self,
+                chat_bot: 'ChatBot',
+                max_wait_ms: float=10.0,
+                max_batch_size: int=16,
+                max_batch_tokens: int=4096,
+            ) -> None:
+        '''
+        动态批处理（micro-batching）：收集max_wait_ms毫秒内到达的请求，
+        或者达到max_batch_size条、填充后token数（batch大小 * 最长prompt长度）达到max_batch_tokens时，
+        调用一次chat_bot.chat(list[str])批量生成（greedy search），再把结果分发给各个请求的future。
+        '''
+        self.chat_bot = chat_bot
+        self.max_wait = max_wait_ms / 1000.0
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+
+        self._waiting = Queue()
+        self._carry = None
+        self._stop_event = Event()
+        self._lock = Lock()
+        self._thread = None
+
+        self.stats = {'batches': 0, 'requests': 0, 'max_batch': 0, 'wait_time': 0.0}
+
+    def start(self) -> None:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stop_event.clear()
+            self._thread = Thread(target=self._loop, name='micro-batcher', daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float=None) -> None:
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+
+    def submit(self, input_txt: str) -> Future:
+        '''
+        提交一个请求，返回concurrent.futures.Future，结果为回答文本
+        '''
+        future = Future()
+        n_tokens = len(self.chat_bot.encode(f"{input_txt}[EOS]").input_ids)
+        self._waiting.put((input_txt, n_tokens, future, time.time()))
+        self.start()
+
+        return future
+
+    def _collect(self) -> list[tuple]:
+        '''
+        阻塞等待第一个请求，然后在时间窗口内继续收集，直到batch大小或token预算达到上限
+        '''
+        if self._carry is not None:
+            first, self._carry = self._carry, None
+        else:
+            try:
+                first = self._waiting.get(timeout=0.1)
+            except Empty:
+                return []
+
+        batch = [first]
+        max_len = first[1]
+        deadline = time.time() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self._waiting.get(timeout=remaining)
+            except Empty:
+                break
+
+            # 加入后超出token预算，作为下一个batch的第一个请求
+            if max(max_len, item[1]) * (len(batch) + 1) > self.max_batch_tokens:
+                self._carry = item
+                break
+
+            batch.append(item)
+            max_len = max(max_len, item[1])
+
+        return batch
+
+    def _loop(self) -> None:
+        while not self._stop_event.is_set():
+            batch = self._collect()
+
+            # 已经取消（如客户端超时）的请求不再生成
+            batch = [item for item in batch if not item[2].cancelled()]
+            if len(batch) == 0:
+                continue
+
+            now = time.time()
+            self.stats['batches'] += 1
+            self.stats['requests'] += len(batch)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+            self.stats['wait_time'] += sum(now - item[3] for item in batch)
+
+            try:
+                outputs = self.chat_bot.chat([item[0] for item in batch], search_type='greedy')
+                if isinstance(outputs, str):
+                    outputs = [outputs]
+
+                for item, output in zip(batch, outputs):
+                    self._set_future(item[2], result=output)
+            except Exception as e:
+                for item in batch:
+                    self._set_future(item[2], exception=e)
+
+    @staticmethod
+    def _set_future(future: Future, result: str=None, exception: Exception=None) -> None:
+        try:
+            if future.done():
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+        except InvalidStateError:
+            pass
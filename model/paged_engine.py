@@ -0,0 +1,362 @@
+from collections import deque
+from queue import Empty
+
+import torch
+from torch import Tensor
+from transformers.modeling_outputs import BaseModelOutput
+
+from model.chat_model import TextToTextModel
+from model.batch_engine import ContinuousBatchingEngine, GenerationRequest
+from model.compiled_decode import StaticDecoderStep
+from model.early_exit import _split_heads, _lm_logits
+from model.kv_cache import KVBlockManager
+from model.cache import EncoderCache
+
+
+class PagedBatchingEngine(ContinuousBatchingEngine):
+    def __init__(self,
+                model: TextToTextModel,
+                max_batch_size: int=16,
+                max_new_tokens: int=320,
+                eos_token_id: int=1,
+                pad_token_id: int=0,
+                encoder_cache: EncoderCache=None,
+                kv_cache_mb: float=1024.0,
+                block_size: int=16,
+            ) -> None:
+        '''
+        使用分页KV cache（KVBlockManager）的连续批处理引擎，接口、调度和ContinuousBatchingEngine相同，仅支持greedy search。
+        每个请求的decoder self-attention KV和cross-attention KV按块存放，生成时按需分配新块，结束（[EOS]、达到长度、取消）
+        后立即归还，batch中的序列不需要填充到最长的长度，相同内存可以同时运行更多的请求。
+        kv_cache_mb: KV块总内存的上限，块的存储按需扩容，不预先分配；block_size: 每块的位置数。
+        新请求只在空闲块足够时加入batch（为每个运行中的请求预留一块增长空间）；解码时空闲块不够，
+        最后加入的请求被抢占：归还所有块，放回等待队列最前面，重新加入时用已生成的token重新计算KV，
+        已经生成的token不会重复输出。
+        注意力逐层按块表从块中取出这一层用到的k、v计算（KVBlockManager.gather_layer），不保留填充的batch KV，
+        临时内存只有一层的大小，和按最长序列填充的连续批处理引擎的对比见get_kv_stats
+        '''
+        super().__init__(
+            model=model,
+            max_batch_size=max_batch_size,
+            max_new_tokens=max_new_tokens,
+            eos_token_id=eos_token_id,
+            pad_token_id=pad_token_id,
+            encoder_cache=encoder_cache,
+        )
+
+        self.decoder_blocks = model.decoder.block
+        attention = self.decoder_blocks[0].layer[0].SelfAttention
+        self.relative_attention_bias = attention.relative_attention_bias
+        self.relative_attention_num_buckets = attention.relative_attention_num_buckets
+        self.relative_attention_max_distance = attention.relative_attention_max_distance
+        self.relative_position_bucket = attention._relative_position_bucket
+
+        block_bytes = len(self.decoder_blocks) * 2 * attention.n_heads * block_size * attention.key_value_proj_dim * torch.finfo(model.dtype).bits // 8
+        self.token_bytes = block_bytes // block_size
+        self.block_manager = KVBlockManager(
+            num_blocks=max(1, int(kv_cache_mb * 1024 * 1024) // block_bytes),
+            block_size=block_size,
+            num_layers=len(self.decoder_blocks),
+            n_heads=attention.n_heads,
+            d_kv=attention.key_value_proj_dim,
+            dtype=model.dtype,
+            device=model.device,
+        )
+
+        # 被抢占或暂时没有空闲块的请求，优先于新请求加入batch
+        self._preempted: deque[GenerationRequest] = deque()
+
+        # batch中所有请求的cross-attention块表和encoder mask，batch的请求变化时重新计算
+        self._cross_index: Tensor = None
+        self._encoder_mask_bias: Tensor = None
+
+        self.stats['preempted'] = 0
+        self.stats['rejected'] = 0
+        self.stats['peak_layer_kv_mb'] = 0.0
+        self.stats['peak_padded_kv_mb'] = 0.0
+
+    @property
+    def num_waiting(self) -> int:
+        return self._waiting.qsize() + len(self._preempted)
+
+    @staticmethod
+    def self_key(req: GenerationRequest) -> tuple:
+        return ('self', req.request_id)
+
+    @staticmethod
+    def cross_key(req: GenerationRequest) -> tuple:
+        return ('cross', req.request_id)
+
+    def _free_request(self, req: GenerationRequest) -> None:
+        self.block_manager.free(self.self_key(req))
+        self.block_manager.free(self.cross_key(req))
+
+    def _take_waiting(self) -> list[GenerationRequest]:
+        '''
+        先取被抢占的请求，再取等待队列中的新请求，没有任何请求时阻塞等待
+        '''
+        new_requests = []
+        capacity = self.max_batch_size - len(self._requests)
+
+        while len(self._preempted) > 0 and len(new_requests) < capacity:
+            new_requests.append(self._preempted.popleft())
+
+        if len(self._requests) == 0 and len(new_requests) == 0:
+            try:
+                new_requests.append(self._waiting.get(timeout=0.1))
+            except Empty:
+                return new_requests
+
+        while len(new_requests) < capacity:
+            try:
+                new_requests.append(self._waiting.get_nowait())
+            except Empty:
+                break
+
+        running_requests = []
+        for req in new_requests:
+            if req.is_cancelled():
+                req.finish()
+                self.stats['cancelled'] += 1
+                continue
+
+            running_requests.append(req)
+
+        return running_requests
+
+    def _blocks_needed(self, req: GenerationRequest) -> int:
+        enc_len = len(req.input_ids) if req.encoder_hidden_states is None else req.encoder_hidden_states.shape[0]
+        return self.block_manager.blocks_needed(enc_len) + self.block_manager.blocks_needed(len(req.output_ids) + 1)
+
+    @torch.no_grad()
+    def _admit(self, new_requests: list[GenerationRequest]) -> None:
+        '''
+        空闲块足够的请求计算encoder输出和cross-attention KV写入块中，被抢占过的请求重新计算已生成token的self-attention KV，
+        第一个token在下一个解码步和batch中的其他请求一起生成
+        '''
+        admitted, free_blocks = [], self.block_manager.num_free_blocks
+        for i, req in enumerate(new_requests):
+            needed = self._blocks_needed(req)
+            batch_empty = len(self._requests) == 0 and len(admitted) == 0
+
+            # 为batch中每个请求预留一块增长空间，batch为空时只要求放得下
+            if needed + len(self._requests) + len(admitted) > free_blocks and not (batch_empty and needed <= free_blocks):
+                if batch_empty:
+                    req.fail(ValueError('request needs {} kv blocks, kv cache only has {}.'.format(needed, self.block_manager.num_blocks)))
+                    self.stats['rejected'] += 1
+                    continue
+
+                # 按原来的顺序放回
+                self._preempted.extendleft(reversed(new_requests[i: ]))
+                break
+
+            admitted.append(req)
+            free_blocks -= needed
+
+        if len(admitted) == 0:
+            return
+
+        encoder_hidden_states, attention_mask = self._encode(admitted)
+        enc_lengths = attention_mask.sum(dim=1).tolist()
+
+        cross_kv = []
+        for block in self.decoder_blocks:
+            attention = block.layer[1].EncDecAttention
+            cross_kv.append(torch.stack([
+                _split_heads(attention.k(encoder_hidden_states), attention.n_heads, attention.key_value_proj_dim),
+                _split_heads(attention.v(encoder_hidden_states), attention.n_heads, attention.key_value_proj_dim),
+            ]))
+        cross_kv = torch.stack(cross_kv)    # (num_layers, 2, batch, n_heads, enc_len, d_kv)
+
+        for j, (req, enc_len) in enumerate(zip(admitted, enc_lengths)):
+            self.block_manager.reserve(self.cross_key(req), enc_len)
+            self.block_manager.write(self.cross_key(req), cross_kv[:, :, j, :, : enc_len, :])
+
+            if len(req.output_ids) > 0:
+                self._prefill(req, encoder_hidden_states[j: j + 1, : enc_len])
+
+        self.stats['admitted'] += len(admitted)
+        self._requests = self._requests + admitted
+        self._cross_index = None
+
+    def _prefill(self, req: GenerationRequest, encoder_hidden_states: Tensor) -> None:
+        '''
+        被抢占的请求重新加入时，一次前向计算已生成token（最后一个除外，它是下一步的输入）的self-attention KV
+        '''
+        decoder_input_ids = torch.LongTensor([[self.decoder_start_token_id] + req.output_ids[: -1]]).to(self.device)
+        outputs = self.model(
+            encoder_outputs=BaseModelOutput(last_hidden_state=encoder_hidden_states),
+            decoder_input_ids=decoder_input_ids,
+            use_cache=True,
+            return_dict=True,
+        )
+        self_kv = torch.stack([torch.stack([layer[0][0], layer[1][0]]) for layer in outputs.past_key_values])
+
+        self.block_manager.reserve(self.self_key(req), self_kv.shape[3])
+        self.block_manager.write(self.self_key(req), self_kv)
+
+    def _preempt_for_step(self) -> None:
+        '''
+        这一步需要新块的请求数超过空闲块数时，从最后加入的请求开始抢占
+        '''
+        block_size = self.block_manager.block_size
+        while len(self._requests) > 0:
+            needed = sum(1 for req in self._requests if self.block_manager.length(self.self_key(req)) % block_size == 0)
+            if needed <= self.block_manager.num_free_blocks:
+                return
+
+            req = self._requests.pop()
+            self._free_request(req)
+            self._preempted.appendleft(req)
+            self._cross_index = None
+            self.stats['preempted'] += 1
+
+    @torch.no_grad()
+    def _step(self) -> None:
+        '''
+        运行中的batch解码一步：每个请求的self-attention分配一个位置，新位置的k、v写入块后，
+        逐层按块表取出这一层的KV计算注意力
+        '''
+        self._preempt_for_step()
+        if len(self._requests) == 0:
+            return
+
+        requests = self._requests
+        batch_size = len(requests)
+        self_keys = [self.self_key(req) for req in requests]
+        positions = [self.block_manager.length(key) for key in self_keys]
+        for key in self_keys:
+            self.block_manager.reserve(key, 1)
+
+        if self._cross_index is None:
+            self._cross_index, enc_lengths = self.block_manager.block_index([self.cross_key(req) for req in requests])
+            enc_position = torch.arange(self._cross_index.shape[1] * self.block_manager.block_size, device=self.device)
+            enc_mask = (enc_position[None, :] < enc_lengths[:, None]).long()
+            self._encoder_mask_bias = self.model.decoder.invert_attention_mask(enc_mask)
+
+        self_index, _ = self.block_manager.block_index(self_keys)
+        block_index, block_offset = self.block_manager.slot_index(self_keys, positions)
+        self._record_memory(self_index, self._cross_index)
+
+        input_ids = torch.LongTensor([[req.output_ids[-1] if len(req.output_ids) > 0 else self.decoder_start_token_id] for req in requests]).to(self.device)
+        hidden_states = self.model.decoder.embed_tokens(input_ids)
+
+        # 每个请求的位置不同：相对位置偏置和mask按行计算
+        position = torch.LongTensor(positions).to(self.device)
+        memory_position = torch.arange(self_index.shape[1] * self.block_manager.block_size, device=self.device)
+        relative_position_bucket = self.relative_position_bucket(
+            memory_position[None, :] - position[:, None],
+            bidirectional=False,
+            num_buckets=self.relative_attention_num_buckets,
+            max_distance=self.relative_attention_max_distance,
+        )
+        position_bias = self.relative_attention_bias(relative_position_bucket).permute(0, 2, 1)[:, :, None, :]
+        causal_mask = torch.where(memory_position[None, :] > position[:, None], torch.finfo(hidden_states.dtype).min, 0.0).to(hidden_states.dtype)
+        self_bias = position_bias + causal_mask[:, None, None, :]
+
+        for i, block in enumerate(self.decoder_blocks):
+            self_attention_layer, cross_attention_layer, ff_layer = block.layer[0], block.layer[1], block.layer[-1]
+
+            # 当前位置的k、v先写入块，再和之前的位置一起取出
+            attention = self_attention_layer.SelfAttention
+            normed_hidden_states = self_attention_layer.layer_norm(hidden_states)
+            query = _split_heads(attention.q(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)
+            kv = torch.stack([
+                _split_heads(proj(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)[:, :, 0, :]
+                for proj in (attention.k, attention.v)
+            ])
+            self.block_manager.write_slots(i, kv, block_index, block_offset)
+            key, value = self.block_manager.gather_layer(i, self_index)
+            hidden_states = hidden_states + attention.o(StaticDecoderStep.attention(query, key, value, self_bias))
+            hidden_states = StaticDecoderStep.clamp_fp16(hidden_states)
+
+            attention = cross_attention_layer.EncDecAttention
+            normed_hidden_states = cross_attention_layer.layer_norm(hidden_states)
+            query = _split_heads(attention.q(normed_hidden_states), attention.n_heads, attention.key_value_proj_dim)
+            key, value = self.block_manager.gather_layer(i, self._cross_index)
+            hidden_states = hidden_states + attention.o(StaticDecoderStep.attention(query, key, value, self._encoder_mask_bias))
+            hidden_states = StaticDecoderStep.clamp_fp16(hidden_states)
+
+            hidden_states = StaticDecoderStep.clamp_fp16(ff_layer(hidden_states))
+
+        next_tokens = _lm_logits(self.model, hidden_states)[:, -1, :].argmax(dim=-1, keepdim=True)
+
+        self.stats['steps'] += 1
+        self.stats['max_running'] = max(self.stats['max_running'], batch_size)
+
+        self._update_and_retire(next_tokens, offset=0)
+
+    def _record_memory(self, self_index: Tensor, cross_index: Tensor) -> None:
+        '''
+        统计一层临时取出的KV的最大内存，使用的块加上临时取出的一层KV的最大内存（peak_kv_mb，和ContinuousBatchingEngine的同名统计对比），
+        和同样的batch按最长序列填充（ContinuousBatchingEngine）时所有层KV的最大内存
+        '''
+        batch_size = self_index.shape[0]
+        block_size = self.block_manager.block_size
+        layer_tokens = batch_size * (self_index.shape[1] + cross_index.shape[1]) * block_size
+        layer_mb = layer_tokens * self.token_bytes / len(self.decoder_blocks) / 1024 / 1024
+        self.stats['peak_layer_kv_mb'] = max(self.stats['peak_layer_kv_mb'], round(layer_mb, 2))
+
+        used_mb = (self.block_manager.num_blocks - self.block_manager.num_free_blocks) * self.block_manager.block_bytes / 1024 / 1024
+        self.stats['peak_kv_mb'] = max(self.stats['peak_kv_mb'], round(used_mb + layer_mb, 2))
+
+        padded_tokens = self._padded_tokens()
+        self.stats['peak_padded_kv_mb'] = max(self.stats['peak_padded_kv_mb'], round(padded_tokens * self.token_bytes / 1024 / 1024, 2))
+
+    def _padded_tokens(self) -> int:
+        '''
+        运行中的batch按最长序列填充需要的位置数（self-attention + cross-attention）
+        '''
+        requests = list(self._requests)
+        if len(requests) == 0:
+            return 0
+        self_lengths = [self.block_manager.length(self.self_key(req)) for req in requests]
+        cross_lengths = [self.block_manager.length(self.cross_key(req)) for req in requests]
+        return len(requests) * (max(self_lengths) + max(cross_lengths))
+
+    def _select(self, keep: list[int]) -> None:
+        '''
+        结束的请求归还所有块
+        '''
+        keep_set = set(keep)
+        for i, req in enumerate(self._requests):
+            if i not in keep_set:
+                self._free_request(req)
+
+        self._requests = [self._requests[i] for i in keep]
+        self._cross_index = None
+
+    def _reset_batch(self) -> None:
+        for req in self._requests:
+            self._free_request(req)
+
+        super()._reset_batch()
+        self._cross_index = None
+        self._encoder_mask_bias = None
+
+    def _fail_all(self, exception: Exception) -> None:
+        requests = list(self._preempted)
+        self._preempted.clear()
+        for req in requests:
+            self._free_request(req)
+            req.fail(exception)
+
+        super()._fail_all(exception)
+
+    def get_kv_stats(self) -> dict:
+        '''
+        分页KV cache的占用和碎片统计，memory_mb为块存储当前占用的内存（按需扩容）。
+        和ContinuousBatchingEngine对比：padded_tokens、padded_kv_mb为同样的batch按最长序列填充需要的位置数和KV内存，
+        peak_padded_kv_mb为其最大值；peak_used_kv_mb为同时使用的块的最大内存，
+        peak_layer_kv_mb为解码时临时取出的一层KV的最大内存，peak_kv_mb为使用的块加上临时的一层KV的最大内存
+        '''
+        stats = self.block_manager.get_stats()
+        padded_tokens = self._padded_tokens()
+        stats['padded_tokens'] = padded_tokens
+        stats['padded_kv_mb'] = round(padded_tokens * self.token_bytes / 1024 / 1024, 2)
+        stats['peak_padded_kv_mb'] = self.stats['peak_padded_kv_mb']
+        stats['peak_used_kv_mb'] = round(stats['peak_used_blocks'] * self.block_manager.block_bytes / 1024 / 1024, 2)
+        stats['peak_layer_kv_mb'] = self.stats['peak_layer_kv_mb']
+        stats['peak_kv_mb'] = self.stats['peak_kv_mb']
+        stats['preempted'] = self.stats['preempted']
+        return stats
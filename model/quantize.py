@@ -0,0 +1,280 @@
+import os
+import sys
+from typing import Union
+sys.path.extend(['.','..'])
+
+import torch
+from torch import nn, Tensor
+import torch.nn.functional as F
+from transformers import PreTrainedTokenizerFast
+
+from model.chat_model import TextToTextModel
+from utils.functions import get_bleu4_score, my_average
+
+
+class WeightOnlyQuantEmbedding(nn.Module):
+    def __init__(self, weight: Tensor, bits: int=8, padding_idx: int=None) -> None:
+        '''
+        仅权重量化的embedding，每一行一个缩放系数（对称量化），查表后再反量化。
+        bits=8: int8存储；bits=4: 两个int4打包为一个uint8存储，内存为fp32的1/8
+        '''
+        super().__init__()
+        if bits not in (8, 4):
+            raise ValueError('bits must be 8 or 4, got: {}'.format(bits))
+
+        self.bits = bits
+        self.num_embeddings, self.embedding_dim = weight.shape
+        self.padding_idx = padding_idx
+
+        qweight, scale = quantize_weight(weight.detach().float(), bits)
+        self.register_buffer('qweight', qweight)
+        self.register_buffer('scale', scale)
+
+    def dequantize(self, rows: Tensor=None) -> Tensor:
+        qweight = self.qweight if rows is None else self.qweight[rows]
+        scale = self.scale if rows is None else self.scale[rows]
+        return dequantize_weight(qweight, scale, self.bits, self.embedding_dim)
+
+    def forward(self, input_ids: Tensor) -> Tensor:
+        return self.dequantize(input_ids)
+
+    @property
+    def weight(self) -> Tensor:
+        # T5的lm_head与embedding共享权重时会访问weight
+        return self.dequantize()
+
+    def extra_repr(self) -> str:
+        return 'num_embeddings={}, embedding_dim={}, bits={}'.format(self.num_embeddings, self.embedding_dim, self.bits)
+
+
+class WeightOnlyQuantLinear(nn.Module):
+    def __init__(self, weight: Tensor, bias: Tensor=None, bits: int=8, chunk_size: int=4096) -> None:
+        '''
+        仅权重量化的线性层（用于lm_head），按输出维度分块反量化后计算，
+        避免一次反量化整个(vocab_size, d_model)的权重
+        '''
+        super().__init__()
+        self.bits = bits
+        self.out_features, self.in_features = weight.shape
+        self.chunk_size = chunk_size
+
+        qweight, scale = quantize_weight(weight.detach().float(), bits)
+        self.register_buffer('qweight', qweight)
+        self.register_buffer('scale', scale)
+        self.bias = None if bias is None else nn.Parameter(bias.detach().clone(), requires_grad=False)
+
+    def forward(self, hidden_states: Tensor) -> Tensor:
+        outputs = []
+        for start in range(0, self.out_features, self.chunk_size):
+            end = min(start + self.chunk_size, self.out_features)
+            weight = dequantize_weight(self.qweight[start: end], self.scale[start: end], self.bits, self.in_features)
+            outputs.append(F.linear(hidden_states, weight.to(hidden_states.dtype)))
+
+        outputs = torch.cat(outputs, dim=-1)
+        if self.bias is not None:
+            outputs = outputs + self.bias
+
+        return outputs
+
+    def extra_repr(self) -> str:
+        return 'in_features={}, out_features={}, bits={}'.format(self.in_features, self.out_features, self.bits)
+
+
+def quantize_weight(weight: Tensor, bits: int) -> tuple[Tensor, Tensor]:
+    '''
+    按行对称量化，返回量化后的权重和每行的缩放系数
+    '''
+    q_max = 2 ** (bits - 1) - 1
+    scale = weight.abs().amax(dim=-1, keepdim=True).clamp(min=1e-8) / q_max
+    qweight = torch.round(weight / scale).clamp(-q_max - 1, q_max).to(torch.int8)
+
+    if bits == 4:
+        # [-8, 7] 平移到 [0, 15]，两个相邻的值打包到一个uint8
+        qweight = (qweight + 8).to(torch.uint8)
+        if qweight.shape[-1] % 2 == 1:
+            qweight = F.pad(qweight, (0, 1), value=8)
+        qweight = qweight[..., 0::2] | (qweight[..., 1::2] << 4)
+
+    return qweight, scale.squeeze(-1)
+
+
+def dequantize_weight(qweight: Tensor, scale: Tensor, bits: int, dim: int) -> Tensor:
+    if bits == 4:
+        low = (qweight & 0x0F).to(torch.int8) - 8
+        high = (qweight >> 4).to(torch.int8) - 8
+        qweight = torch.stack([low, high], dim=-1).flatten(start_dim=-2)[..., 0: dim]
+
+    return qweight.float() * scale.unsqueeze(-1)
+
+
+def quantize_model(model: TextToTextModel, quantization: str='dynamic_int8', embedding_bits: int=0) -> TextToTextModel:
+    '''
+    CPU推理的量化模型：
+    quantization: 'dynamic_int8': 所有nn.Linear（包括lm_head）动态int8量化，激活值在推理时动态量化；
+                  'no': 不量化线性层。
+    embedding_bits: 0: 不量化embedding；8/4: 共享的embedding仅权重int8/int4量化，
+                  quantization='no'时lm_head同样仅权重量化。
+    量化只支持CPU，原模型会被原地修改。
+    '''
+    if quantization not in ('no', 'dynamic_int8'):
+        raise ValueError("quantization must be 'no' or 'dynamic_int8', got: {}".format(quantization))
+
+    model = model.cpu().float().eval()
+
+    if embedding_bits > 0:
+        lm_head_weight = model.lm_head.weight
+
+        # encoder、decoder的embed_tokens和shared是同一个embedding
+        embedding = WeightOnlyQuantEmbedding(model.shared.weight, bits=embedding_bits, padding_idx=model.shared.padding_idx)
+        model.shared = embedding
+        model.encoder.embed_tokens = embedding
+        model.decoder.embed_tokens = embedding
+
+        if quantization == 'no':
+            model.lm_head = WeightOnlyQuantLinear(lm_head_weight, bits=embedding_bits)
+        else:
+            # lm_head不再和embedding共享参数，保留一份fp32的权重给下面的动态量化
+            model.lm_head = nn.Linear(lm_head_weight.shape[1], lm_head_weight.shape[0], bias=False)
+            model.lm_head.weight = nn.Parameter(lm_head_weight.detach().clone(), requires_grad=False)
+
+    if quantization == 'dynamic_int8':
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    return model
+
+
+def save_quantized_model(model: TextToTextModel, save_file: str, quantization: str, embedding_bits: int) -> None:
+    '''
+    保存量化后的state_dict和量化参数，加载时先用相同的参数调用quantize_model得到相同的结构，再load_state_dict
+    '''
+    torch.save({'quantization': quantization, 'embedding_bits': embedding_bits, 'state_dict': model.state_dict()}, save_file)
+
+
+def load_quantized_state_dict(save_file: str, quantization: str, embedding_bits: int) -> Union[dict, None]:
+    '''
+    读取save_quantized_model保存的state_dict，文件的量化参数和quantization、embedding_bits不一致
+    （或者是没有记录量化参数的旧文件）时返回None
+    '''
+    checkpoint = torch.load(save_file, map_location='cpu')
+    saved = (checkpoint.get('quantization'), checkpoint.get('embedding_bits')) if 'state_dict' in checkpoint else (None, None)
+
+    if saved != (quantization, embedding_bits):
+        print('quantized model file {} is quantization={}, embedding_bits={}, expected quantization={}, embedding_bits={}.'.format(
+            save_file, saved[0], saved[1], quantization, embedding_bits))
+        return None
+
+    return checkpoint['state_dict']
+
+
+def load_quantized_model(model: TextToTextModel, save_file: str, quantization: str='dynamic_int8', embedding_bits: int=0) -> TextToTextModel:
+    '''
+    model为未量化的模型（可以是随机初始化的），量化结构后加载save_quantized_model保存的权重，量化参数不一致时抛出ValueError
+    '''
+    state_dict = load_quantized_state_dict(save_file, quantization=quantization, embedding_bits=embedding_bits)
+    if state_dict is None:
+        raise ValueError('quantization of {} mismatch, regenerate it by: python model/quantize.py'.format(save_file))
+
+    model = quantize_model(model, quantization=quantization, embedding_bits=embedding_bits)
+    model.load_state_dict(state_dict)
+
+    return model
+
+
+@torch.no_grad()
+def check_quantized_accuracy(
+                fp32_model: TextToTextModel,
+                quantized_model: TextToTextModel,
+                tokenizer: PreTrainedTokenizerFast,
+                prompts: list[str],
+                max_seq_len: int=320,
+                batch_size: int=16,
+            ) -> float:
+    '''
+    以fp32模型的greedy输出为参考，计算量化模型输出的平均bleu4分数，1.0表示输出完全一致
+    '''
+    bleu4_scores = []
+    for start in range(0, len(prompts), batch_size):
+        batch = [f"{prompt}[EOS]" for prompt in prompts[start: start + batch_size]]
+        encoded = tokenizer.batch_encode_plus(batch, padding=True)
+        input_ids = torch.LongTensor(encoded.input_ids)
+        attention_mask = torch.LongTensor(encoded.attention_mask)
+
+        outputs = []
+        for model in (fp32_model, quantized_model):
+            output_ids = model.my_generate(
+                input_ids=input_ids.to(model.device),
+                attention_mask=attention_mask.to(model.device),
+                max_seq_len=max_seq_len,
+                search_type='greedy',
+            )
+            outputs.append(tokenizer.batch_decode(output_ids.cpu().numpy(), skip_special_tokens=True, clean_up_tokenization_spaces=False))
+
+        for reference, output in zip(*outputs):
+            if len(reference) == 0 or len(output) == 0:
+                bleu4_scores.append(1.0 if reference == output else 0.0)
+                continue
+            bleu4_scores.append(float(get_bleu4_score(reference=reference, outputs=output)))
+
+    return my_average(bleu4_scores)
+
+
+def get_model_size_mb(model: nn.Module) -> float:
+    '''
+    模型参数和buffer（包括量化后的打包权重）占用的内存，共享的参数只计算一次
+    '''
+    state_dict = model.state_dict()
+    seen, total = set(), 0
+    for value in state_dict.values():
+        # 动态量化线性层的_packed_params为(weight, bias)，另外还有dtype等非tensor的值
+        value = value if isinstance(value, tuple) else [value]
+        for v in value:
+            if not isinstance(v, Tensor):
+                continue
+            if v.data_ptr() in seen:
+                continue
+            seen.add(v.data_ptr())
+            total += v.numel() * v.element_size()
+
+    return total / 1024 / 1024
+
+
+def quantize_and_save(quantization: str='dynamic_int8', embedding_bits: int=0, save_file: str=None) -> None:
+    '''
+    加载fp32模型，量化后保存到save_file（默认InferConfig.quantized_model_file），并和fp32模型对比输出。
+    推理时InferConfig的quantization、quantize_embedding_bits需要和这里一致，否则不加载该文件
+    '''
+    if quantization == 'no' and embedding_bits == 0:
+        raise ValueError("nothing to quantize, set quantization='dynamic_int8' or embedding_bits=8/4.")
+
+    import copy
+    from dataclasses import replace
+    import pyarrow.parquet as pq
+    from model.infer import ChatBot
+    from config import InferConfig, TrainConfig
+
+    infer_config = InferConfig()
+    train_config = TrainConfig()
+    save_file = infer_config.quantized_model_file if save_file is None else save_file
+
+    chat_bot = ChatBot(replace(infer_config, quantization='no', quantize_embedding_bits=0, mixed_precision='no'))
+    fp32_model = chat_bot.model.cpu().float()
+
+    quantized_model = quantize_model(copy.deepcopy(fp32_model), quantization=quantization, embedding_bits=embedding_bits)
+    save_quantized_model(quantized_model, save_file, quantization=quantization, embedding_bits=embedding_bits)
+
+    print('fp32 model size: {:.2f} MB, quantized model size: {:.2f} MB'.format(get_model_size_mb(fp32_model), get_model_size_mb(quantized_model)))
+    print('quantized model (quantization={}, embedding_bits={}) saved to: {}'.format(quantization, embedding_bits, save_file))
+
+    prompts = ['你好', '感冒了要怎么办？', '请介绍一下北京。']
+    if os.path.exists(train_config.validation_file):
+        prompts = pq.read_table(train_config.validation_file)['prompt'].to_pylist()[0: 256]
+
+    score = check_quantized_accuracy(fp32_model, quantized_model, chat_bot.tokenizer, prompts, max_seq_len=infer_config.max_seq_len)
+    print('bleu4 score of quantized model (reference: fp32 model): {:.4f}'.format(score))
+
+
+if __name__ == '__main__':
+    import fire
+
+    # 量化并保存模型，e.g: python model/quantize.py --quantization=dynamic_int8 --embedding_bits=8
+    fire.Fire(component=quantize_and_save)
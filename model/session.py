@@ -0,0 +1,137 @@
+from threading import Lock
+
+import torch
+from torch import Tensor
+
+from model.streamer import TokenStreamer
+from model.bucketing import pad_batch
+
+
+class ChatSession:
+    def __init__(self, chat_bot, max_history_tokens: int=256, encode_mode: str='full') -> None:
+        '''
+        多轮对话会话，历史轮次拼接到encoder输入：第1轮问题[SEP]第1轮回答[SEP]...本轮问题[EOS]，
+        历史和本轮问题的总token数超过max_history_tokens时，从最早的轮次开始丢弃（本轮问题始终保留）。
+        每轮的token id只编码一次并缓存。
+
+        encode_mode:
+            'full': 拼接后的输入完整过encoder。T5的encoder是双向注意力，历史的encoder输出会受到新问题的影响，
+                    不能像decoder的KV cache一样增量计算，该模式结果准确，但每轮的encoder计算量随历史长度增长；
+            'segment': 每轮单独过encoder并缓存该轮的encoder输出，新一轮只计算上一轮回答和本轮问题的token，
+                    各轮的encoder输出拼接后交给decoder（decoder的cross-attention可以看到所有轮次）。
+                    轮次之间在encoder中没有注意力，是一种近似，encoder耗时不随对话轮数增长。
+        不是线程安全的，每个用户（如cli_demo的一次对话）使用一个会话
+        '''
+        if encode_mode not in ('full', 'segment'):
+            raise ValueError("encode_mode must be 'full' or 'segment', got: {}".format(encode_mode))
+
+        self.chat_bot = chat_bot
+        self.max_history_tokens = max_history_tokens
+        self.encode_mode = encode_mode
+
+        self.history: list[list[str]] = []
+        self._turn_ids: list[list[int]] = []            # 每个历史轮次的token id：问题[SEP]回答[SEP]
+        self._turn_hidden: list[Tensor] = []            # segment模式下每个历史轮次的encoder输出
+        self._lock = Lock()
+
+        self.stats = {'turns': 0, 'encoded_tokens': 0, 'input_tokens': 0, 'dropped_turns': 0}
+
+    def clear(self) -> None:
+        with self._lock:
+            self.history = []
+            self._turn_ids = []
+            self._turn_hidden = []
+
+    def add_turn(self, query: str, response: str) -> None:
+        '''
+        记录一轮对话，stream_chat结束后需要调用方用完整的回答调用，chat会自动调用
+        '''
+        with self._lock:
+            self.history.append([query, response])
+            self._turn_ids.append(self.chat_bot.encode(f"{query}[SEP]{response}[SEP]").input_ids)
+
+    def _select_turns(self, query_ids: list[int]) -> int:
+        '''
+        在token预算内，从最近的轮次往前选择，返回保留的第一个轮次的下标
+        '''
+        budget = self.max_history_tokens - len(query_ids)
+        start = len(self._turn_ids)
+        while start > 0 and len(self._turn_ids[start - 1]) <= budget:
+            budget -= len(self._turn_ids[start - 1])
+            start -= 1
+
+        return start
+
+    @torch.no_grad()
+    def _encode_segments(self, segments: list[list[int]]) -> list[Tensor]:
+        '''
+        多个轮次批量过encoder，返回每个轮次未填充的encoder输出
+        '''
+        model = self.chat_bot.model
+        input_ids, attention_mask = pad_batch(segments, pad_token_id=self.chat_bot.tokenizer.pad_token_id)
+        hidden_states = model.encoder(
+            input_ids=input_ids.to(model.device),
+            attention_mask=attention_mask.to(model.device),
+            return_dict=True,
+        ).last_hidden_state
+
+        self.stats['encoded_tokens'] += sum(len(ids) for ids in segments)
+
+        return [hidden_states[i, : len(ids)].clone() for i, ids in enumerate(segments)]
+
+    def build_inputs(self, query: str) -> tuple[list[int], Tensor]:
+        '''
+        返回本轮的encoder输入input_ids，segment模式下同时返回拼接好的encoder输出(seq_len, d_model)，full模式下为None
+        '''
+        with self._lock:
+            query_ids = self.chat_bot.encode(f"{query}[EOS]").input_ids
+            start = self._select_turns(query_ids)
+
+            self.stats['turns'] += 1
+            self.stats['dropped_turns'] = start
+
+            input_ids = [token for ids in self._turn_ids[start: ] for token in ids] + query_ids
+            self.stats['input_tokens'] += len(input_ids)
+
+            if self.encode_mode == 'full':
+                self.stats['encoded_tokens'] += len(input_ids)
+                return input_ids, None
+
+            # 只计算还没有缓存的轮次（上一轮）和本轮问题
+            cached = len(self._turn_hidden)
+            new_hidden = self._encode_segments(self._turn_ids[cached: ] + [query_ids])
+            self._turn_hidden.extend(new_hidden[0: -1])
+
+            encoder_hidden_states = torch.cat(self._turn_hidden[start: ] + new_hidden[-1: ], dim=0)
+
+            return input_ids, encoder_hidden_states
+
+    def stream_chat(self, query: str) -> TokenStreamer:
+        '''
+        流式对话，返回的streamer用法同ChatBot.stream_chat，生成结束后需要调用add_turn(query, response)记录本轮对话
+        '''
+        streamer = TokenStreamer(
+            tokenizer=self.chat_bot.tokenizer,
+            max_buffer_size=self.chat_bot.infer_config.stream_buffer_size,
+            stall_timeout=self.chat_bot.infer_config.stream_stall_timeout,
+        )
+
+        input_ids, encoder_hidden_states = self.build_inputs(query)
+        self.chat_bot.get_engine().submit(input_ids, streamer=streamer, encoder_hidden_states=encoder_hidden_states)
+
+        return streamer
+
+    def chat(self, query: str) -> str:
+        '''
+        非流式对话（greedy search），回答和历史有关，不使用回答缓存
+        '''
+        input_ids, encoder_hidden_states = self.build_inputs(query)
+        output_ids = self.chat_bot.get_engine().submit(input_ids, encoder_hidden_states=encoder_hidden_states).result()
+        response = self.chat_bot.batch_decode([output_ids], clean_up_tokenization_spaces=True, skip_special_tokens=True)[0]
+
+        self.add_turn(query, response)
+
+        if len(response) == 0:
+            response = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
+
+        return response
@@ -0,0 +1,127 @@
+import sys
+sys.path.extend(['.','..'])
+
+import struct
+import warnings
+
+import ujson
+import numpy as np
+import torch
+from torch import Tensor
+from safetensors.torch import save_model
+from transformers import T5Config
+
+from model.chat_model import TextToTextModel
+
+
+# safetensors头中的dtype字符串
+SAFETENSORS_DTYPES = {
+    'F64': torch.float64,
+    'F32': torch.float32,
+    'F16': torch.float16,
+    'BF16': torch.bfloat16,
+    'I64': torch.int64,
+    'I32': torch.int32,
+    'I16': torch.int16,
+    'I8': torch.int8,
+    'U8': torch.uint8,
+    'BOOL': torch.bool,
+}
+
+
+def load_mmap_state_dict(safetensors_file: str) -> dict[str, Tensor]:
+    '''
+    内存映射一个safetensors文件，返回的tensor直接引用映射的内存，不复制数据。
+    以copy-on-write（MAP_PRIVATE）方式映射，只读时所有进程共享操作系统page cache中的同一份物理内存，
+    多个uvicorn worker加载同一个文件只占用一份模型权重的内存；意外写入时只复制被写的页，不会修改文件。
+    '''
+    with open(safetensors_file, 'rb') as f:
+        header_len = struct.unpack('<Q', f.read(8))[0]
+        header = ujson.loads(f.read(header_len))
+
+    header.pop('__metadata__', None)
+    data_start = 8 + header_len
+    buffer = np.memmap(safetensors_file, dtype=np.uint8, mode='c')
+
+    state_dict = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for name, info in header.items():
+            start, end = info['data_offsets']
+            dtype = SAFETENSORS_DTYPES[info['dtype']]
+            tensor = torch.from_numpy(buffer[data_start + start: data_start + end])
+            state_dict[name] = tensor.view(dtype).reshape(info['shape'])
+
+    return state_dict
+
+
+def build_empty_model(t5_config: T5Config) -> TextToTextModel:
+    '''
+    在meta device上构建模型，只有结构没有数据，不做随机初始化，加载权重时用assign直接替换参数
+    '''
+    with torch.device('meta'):
+        model = TextToTextModel(t5_config)
+
+    return model
+
+
+def assign_state_dict(model: TextToTextModel, state_dict: dict[str, Tensor], checkpoint_file: str) -> TextToTextModel:
+    '''
+    用state_dict中的tensor替换model的参数（load_state_dict(assign=True)，不复制）。
+    共享的参数（embedding、lm_head）可能只保存了一个，加载后重新tie_weights
+    '''
+    missing_keys, unexpected_keys = model.load_state_dict(state_dict, strict=False, assign=True)
+    model.tie_weights()
+
+    # 共享的参数只保存了其中一个，其他缺失的key必须和已加载的参数是同一个tensor
+    params = dict(model.named_parameters(remove_duplicate=False))
+    loaded_ptrs = {params[name].data_ptr() for name in state_dict.keys() if name in params}
+    missing_keys = [key for key in missing_keys if key in params and (params[key].is_meta or params[key].data_ptr() not in loaded_ptrs)]
+
+    if len(missing_keys) > 0 or len(unexpected_keys) > 0:
+        raise RuntimeError('checkpoint {} does not match the model, missing keys: {}, unexpected keys: {}'.format(checkpoint_file, missing_keys, unexpected_keys))
+
+    return model
+
+
+def load_shared_weights(model: TextToTextModel, safetensors_file: str) -> TextToTextModel:
+    '''
+    用内存映射的权重替换model的参数，model可以是build_empty_model构建的，也可以是随机初始化的（随机权重会被释放）
+    '''
+    return assign_state_dict(model, load_mmap_state_dict(safetensors_file), safetensors_file)
+
+
+def load_mmap_checkpoint(model: TextToTextModel, checkpoint_file: str) -> TextToTextModel:
+    '''
+    以内存映射方式读取torch.save保存的checkpoint（不需要把整个文件读入内存），用assign替换model的参数。
+    旧格式（非zip）的checkpoint不支持内存映射，直接读取
+    '''
+    try:
+        state_dict = torch.load(checkpoint_file, map_location='cpu', mmap=True)
+    except RuntimeError:
+        state_dict = torch.load(checkpoint_file, map_location='cpu')
+
+    return assign_state_dict(model, state_dict, checkpoint_file)
+
+
+def save_shared_weights(model: TextToTextModel, safetensors_file: str) -> None:
+    '''
+    保存为单个safetensors文件，保存前先把模型转换为推理使用的dtype，加载时不需要再转换（转换会复制权重，不再共享内存）
+    '''
+    save_model(model, safetensors_file)
+
+
+if __name__ == '__main__':
+    from dataclasses import replace
+    from model.infer import ChatBot, cast_model_dtype, get_torch_dtype
+    from config import InferConfig
+
+    infer_config = InferConfig()
+
+    # 导出为CPU推理使用的dtype，多个worker通过InferConfig.shared_weights_file共享
+    chat_bot = ChatBot(replace(infer_config, shared_weights_file='', quantization='no', quantize_embedding_bits=0))
+    dtype = get_torch_dtype(infer_config.mixed_precision, torch.device('cpu'))
+    model = cast_model_dtype(chat_bot.model.cpu(), dtype)
+
+    save_shared_weights(model, infer_config.shared_weights_file)
+    print('shared weights ({}) saved to: {}'.format(dtype, infer_config.shared_weights_file))
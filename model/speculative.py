@@ -0,0 +1,218 @@
+import os
+import sys
+sys.path.extend(['.','..'])
+
+import time
+from threading import Lock
+
+import torch
+from transformers.modeling_outputs import BaseModelOutput
+
+from model.chat_model import TextToTextModel
+from model.streamer import TokenStreamer
+from model.shared_weights import build_empty_model, load_shared_weights, load_mmap_checkpoint
+from utils.functions import get_T5_config
+from config import DraftT5ModelConfig
+
+
+def crop_self_attention_cache(past_key_values: tuple, length: int) -> tuple:
+    '''
+    只保留decoder self-attention KV cache的前length个位置，cross-attention KV cache只和encoder有关，不需要裁剪
+    '''
+    return tuple(
+        (self_k[:, :, : length, :], self_v[:, :, : length, :], cross_k, cross_v)
+        for self_k, self_v, cross_k, cross_v in past_key_values
+    )
+
+
+def load_draft_model(draft_model_file: str, vocab_size: int, decoder_start_token_id: int=0, eos_token_id: int=1) -> TextToTextModel:
+    '''
+    加载草稿模型：文件夹使用from_pretrained，.safetensors文件和torch checkpoint按DraftT5ModelConfig的结构内存映射加载
+    '''
+    if os.path.isdir(draft_model_file):
+        return TextToTextModel.from_pretrained(draft_model_file, low_cpu_mem_usage=True)
+
+    t5_config = get_T5_config(DraftT5ModelConfig(), vocab_size=vocab_size, decoder_start_token_id=decoder_start_token_id, eos_token_id=eos_token_id)
+    if draft_model_file.endswith('.safetensors'):
+        return load_shared_weights(build_empty_model(t5_config), draft_model_file)
+
+    return load_mmap_checkpoint(build_empty_model(t5_config), draft_model_file)
+
+
+class SpeculativeDecoder:
+    def __init__(self,
+                model: TextToTextModel,
+                draft_model: TextToTextModel,
+                num_draft_tokens: int=4,
+                eos_token_id: int=1,
+            ) -> None:
+        '''
+        投机解码（greedy search）：层数很少的草稿模型（和主模型共用tokenizer）先自回归地生成num_draft_tokens个token，
+        主模型一次前向同时验证这些token，接受和主模型greedy结果一致的最长前缀，再加上主模型在第一个不一致位置的token。
+        每轮至少生成1个token，最多num_draft_tokens + 1个，输出和主模型逐个token的greedy search相同
+        （两者计算顺序不同，只在logits几乎相等、浮点误差改变了argmax时可能不同）。
+        被拒绝的token对应的decoder self-attention KV cache会被裁剪掉，encoder只计算一次。
+        eos_token_id和my_generate保持一致。
+        '''
+        self.model = model
+        self.draft_model = draft_model
+        self.num_draft_tokens = num_draft_tokens
+        self.eos_token_id = eos_token_id
+        self.decoder_start_token_id = model.config.decoder_start_token_id
+
+        self._lock = Lock()
+        self.stats = {'requests': 0, 'rounds': 0, 'drafted_tokens': 0, 'accepted_tokens': 0, 'generated_tokens': 0, 'time': 0.0}
+
+    @property
+    def device(self) -> torch.device:
+        return self.model.device
+
+    @torch.no_grad()
+    def generate(self, input_ids: list[int], max_new_tokens: int=320, streamer: TokenStreamer=None, stopping_criteria: list=None) -> list[int]:
+        '''
+        单个prompt的投机解码，input_ids需已包含[EOS]，返回生成的token id列表（不含decoder_start_token）。
+        streamer被取消后停止生成；stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria），每轮验证之后检查
+        '''
+        start_time = time.perf_counter()
+
+        encoder_input_ids = torch.LongTensor([input_ids]).to(self.device)
+        encoder_outputs = BaseModelOutput(last_hidden_state=self.model.encoder(input_ids=encoder_input_ids, return_dict=True).last_hidden_state)
+        draft_encoder_outputs = BaseModelOutput(last_hidden_state=self.draft_model.encoder(input_ids=encoder_input_ids.to(self.draft_model.device), return_dict=True).last_hidden_state)
+
+        # sequence为已确定的decoder输入，主模型的KV cache始终覆盖sequence[: -1]，草稿模型覆盖sequence[: draft_cached]
+        sequence = [self.decoder_start_token_id]
+        past_key_values, draft_past_key_values = None, None
+        draft_cached = 0
+        rounds, drafted, accepted = 0, 0, 0
+
+        while len(sequence) - 1 < max_new_tokens:
+            num_draft = min(self.num_draft_tokens, max_new_tokens - len(sequence))
+
+            # 1. 草稿模型先补上没有缓存的token，再自回归生成num_draft个token
+            draft_tokens = []
+            draft_input = sequence[draft_cached: ]
+            for _ in range(num_draft):
+                outputs = self.draft_model(
+                    encoder_outputs=draft_encoder_outputs,
+                    decoder_input_ids=torch.LongTensor([draft_input]).to(self.draft_model.device),
+                    past_key_values=draft_past_key_values,
+                    use_cache=True,
+                    return_dict=True,
+                )
+                draft_past_key_values = outputs.past_key_values
+                draft_input = [int(outputs.logits[0, -1].argmax())]
+                draft_tokens.append(draft_input[0])
+
+                if draft_input[0] == self.eos_token_id:
+                    break
+
+            # 2. 主模型一次前向验证：输入最后一个确定的token和所有草稿token
+            verify_input = [sequence[-1]] + draft_tokens
+            outputs = self.model(
+                encoder_outputs=encoder_outputs,
+                decoder_input_ids=torch.LongTensor([verify_input]).to(self.device),
+                past_key_values=past_key_values,
+                use_cache=True,
+                return_dict=True,
+            )
+            predictions = outputs.logits[0].argmax(dim=-1).tolist()
+
+            num_accepted = 0
+            while num_accepted < len(draft_tokens) and draft_tokens[num_accepted] == predictions[num_accepted]:
+                num_accepted += 1
+
+            # 接受的草稿token，加上主模型在第一个不一致位置（全部接受时为最后一个位置）的token
+            new_tokens = draft_tokens[0: num_accepted] + [predictions[num_accepted]]
+
+            rounds += 1
+            drafted += len(draft_tokens)
+            accepted += num_accepted
+
+            # 3. 裁剪被拒绝的token的KV cache
+            prev_len = len(sequence)
+            past_key_values = crop_self_attention_cache(outputs.past_key_values, prev_len + num_accepted)
+
+            # 草稿模型最后一个草稿token没有输入过，缓存的有效部分为sequence和已经输入过的被接受的草稿token
+            if draft_past_key_values is not None:
+                draft_cached = min(prev_len + num_accepted, draft_past_key_values[0][0].shape[2])
+                draft_past_key_values = crop_self_attention_cache(draft_past_key_values, draft_cached)
+
+            if self.eos_token_id in new_tokens:
+                new_tokens = new_tokens[0: new_tokens.index(self.eos_token_id) + 1]
+            new_tokens = new_tokens[0: max_new_tokens - prev_len + 1]
+
+            sequence.extend(new_tokens)
+            if streamer is not None and not streamer.put(new_tokens):
+                break
+
+            if new_tokens[-1] == self.eos_token_id:
+                break
+
+            if stopping_criteria is not None and any(criteria(torch.LongTensor([sequence]), outputs.logits[:, -1, :]) for criteria in stopping_criteria):
+                break
+
+        if streamer is not None:
+            streamer.end()
+
+        with self._lock:
+            self.stats['requests'] += 1
+            self.stats['rounds'] += rounds
+            self.stats['drafted_tokens'] += drafted
+            self.stats['accepted_tokens'] += accepted
+            self.stats['generated_tokens'] += len(sequence) - 1
+            self.stats['time'] += time.perf_counter() - start_time
+
+        return sequence[1: ]
+
+    def get_stats(self) -> dict:
+        '''
+        acceptance_rate: 草稿token被接受的比例；tokens_per_round: 平均每次主模型前向生成的token数
+        '''
+        with self._lock:
+            stats = dict(self.stats)
+
+        stats['acceptance_rate'] = round(stats['accepted_tokens'] / stats['drafted_tokens'], 4) if stats['drafted_tokens'] > 0 else 0.0
+        stats['tokens_per_round'] = round(stats['generated_tokens'] / stats['rounds'], 4) if stats['rounds'] > 0 else 0.0
+        stats['tokens_per_second'] = round(stats['generated_tokens'] / stats['time'], 2) if stats['time'] > 0 else 0.0
+        stats['time'] = round(stats['time'], 3)
+
+        return stats
+
+
+if __name__ == '__main__':
+    from dataclasses import replace
+    import pyarrow.parquet as pq
+    from model.infer import ChatBot
+    from config import InferConfig, TrainConfig
+
+    infer_config = InferConfig()
+    train_config = TrainConfig()
+
+    # 对比普通greedy search和投机解码的速度，并检查输出是否一致
+    chat_bot = ChatBot(replace(infer_config, response_cache_mb=0.0, encoder_cache_mb=0.0))
+    if chat_bot.speculative_decoder is None:
+        raise ValueError('draft model not found: {}, train it with: python train.py train --draft'.format(infer_config.draft_model_file))
+
+    prompts = ['你好', '感冒了要怎么办？', '请介绍一下北京。']
+    if os.path.exists(train_config.validation_file):
+        prompts = pq.read_table(train_config.validation_file)['prompt'].to_pylist()[0: 64]
+
+    greedy_tokens, greedy_time, same = 0, 0.0, 0
+    for prompt in prompts:
+        input_ids = chat_bot.encode(f"{prompt}[EOS]").input_ids
+
+        start = time.perf_counter()
+        x = torch.LongTensor([input_ids]).to(chat_bot.device)
+        reference = chat_bot.model.my_generate(x, torch.ones_like(x), max_seq_len=infer_config.max_seq_len, search_type='greedy')[0, 1: ].tolist()
+        greedy_time += time.perf_counter() - start
+
+        while len(reference) > 0 and reference[-1] == chat_bot.tokenizer.pad_token_id:
+            reference.pop()
+        greedy_tokens += len(reference)
+
+        output = chat_bot.speculative_decoder.generate(input_ids, max_new_tokens=infer_config.max_seq_len)
+        same += int(output == reference)
+
+    print('greedy: {:.2f} tokens/s'.format(greedy_tokens / greedy_time))
+    print('speculative: {}'.format(chat_bot.speculative_decoder.get_stats()))
+    print('identical outputs: {} / {}'.format(same, len(prompts)))
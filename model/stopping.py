@@ -0,0 +1,31 @@
+import time
+from threading import Event
+
+from torch import Tensor, LongTensor
+
+
+class DeadlineStoppingCriteria:
+    def __init__(self, deadline: float=None, cancel_event: Event=None) -> None:
+        '''
+        生成的停止条件，接口和transformers的StoppingCriteria相同：criteria(input_ids, scores) -> bool，
+        可以放入StoppingCriteriaList传给generate，也可以在torchscript运行时的解码循环中调用。
+        deadline: 截止时间（unix时间戳，秒），超过后在下一个解码步停止；
+        cancel_event: 调用方不再需要结果时（超时、客户端断开）set，在下一个解码步停止。
+        停止后triggered为True，生成的结果不完整，不应写入回答缓存
+        '''
+        self.deadline = deadline
+        self.cancel_event = Event() if cancel_event is None else cancel_event
+        self.triggered = False
+
+    def cancel(self) -> None:
+        self.cancel_event.set()
+
+    def __call__(self, input_ids: LongTensor, scores: Tensor, **kwargs) -> bool:
+        if self.cancel_event.is_set() or (self.deadline is not None and time.time() > self.deadline):
+            self.triggered = True
+
+        return self.triggered
+
+    def __deepcopy__(self, memo: dict) -> 'DeadlineStoppingCriteria':
+        # transformers的validate_stopping_criteria会复制停止条件，复制后需要和调用方共享同一个cancel_event
+        return self
@@ -0,0 +1,181 @@
+import time
+from typing import Callable
+from queue import Queue, Empty, Full
+from threading import Event, Lock
+
+
+class TokenStreamer:
+    def __init__(self,
+                tokenizer,
+                max_buffer_size: int=64,
+                stall_timeout: float=10.0,
+                skip_special_tokens: bool=True,
+            ) -> None:
+        '''
+        每个请求独立的流式输出队列，生产者（推理引擎）调用put写入token id，消费者迭代得到文本片段。
+        max_buffer_size: 队列中最多缓存的token块数，消费者跟不上时剩余token暂存在pending中，
+        stall_timeout: 队列持续满的时间超过stall_timeout秒，认为消费者已断开，自动取消请求。
+        消费者断开连接时调用cancel()，引擎会在下一个解码步把该请求移出batch。
+        tokenizer: PreTrainedTokenizerFast或其他有相同decode方法的tokenizer（如导出模型运行时的RuntimeTokenizer），
+        这里不import transformers，轻量的运行时也可以使用。
+        '''
+        self.tokenizer = tokenizer
+        self.skip_special_tokens = skip_special_tokens
+        self.stall_timeout = stall_timeout
+
+        self._queue = Queue(maxsize=max_buffer_size)
+        # pending由生产者写入，生成结束后由消费者取走，两边都要加锁
+        self._lock = Lock()
+        self._pending = []
+        self._full_since = None
+        self._cancel_event = Event()
+        self._stop_signal = None
+        self._notify = None
+
+        # 消费者侧的增量解码状态
+        self._token_cache = []
+        self._print_len = 0
+        self._finished = False
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancel_event.is_set()
+
+    def set_notify(self, callback: Callable[[], None]) -> None:
+        '''
+        有新的token块或生成结束时，在生产者线程中调用callback（不能阻塞），
+        异步的消费者用它唤醒事件循环（loop.call_soon_threadsafe），不需要占用线程阻塞地等待队列
+        '''
+        self._notify = callback
+
+    def _wake(self) -> None:
+        if self._notify is not None:
+            self._notify()
+
+    def cancel(self) -> None:
+        '''
+        消费者不再需要后续输出（如客户端断开），通知引擎停止生成
+        '''
+        self._cancel_event.set()
+
+    def put(self, token_ids: list[int]) -> bool:
+        '''
+        生产者写入新生成的token，不会阻塞引擎线程。返回False表示请求已被取消，应该停止生成
+        '''
+        if self.cancelled:
+            return False
+
+        with self._lock:
+            self._pending.extend(token_ids)
+        if self._flush_pending():
+            self._full_since = None
+            self._wake()
+            return True
+
+        if self._full_since is None:
+            self._full_since = time.time()
+        elif time.time() - self._full_since > self.stall_timeout:
+            self.cancel()
+            return False
+
+        return True
+
+    def end(self, exception: Exception=None) -> None:
+        '''
+        生产者结束生成，exception不为None时消费者迭代会抛出该异常
+        '''
+        # 先设置结束信号再写入剩余token：消费者看到结束信号后不会再无超时地等待队列，
+        # 队列满时不能阻塞引擎线程，剩余token留在pending中，消费者取完队列后再取pending
+        self._stop_signal = exception if exception is not None else StopIteration()
+        flushed = self._flush_pending()
+
+        if flushed:
+            try:
+                self._queue.put_nowait(None)
+            except Full:
+                pass
+
+        self._wake()
+
+    def _flush_pending(self) -> bool:
+        with self._lock:
+            if len(self._pending) == 0:
+                return True
+            try:
+                self._queue.put_nowait(self._pending)
+            except Full:
+                return False
+
+            self._pending = []
+            return True
+
+    def get(self, timeout: float=None) -> list[int]:
+        '''
+        取出下一块token id，生成结束返回None，超时抛出queue.Empty
+        '''
+        if self._finished:
+            return None
+
+        try:
+            tokens = self._queue.get(timeout=timeout if self._stop_signal is None else 0.0)
+        except Empty:
+            # 结束信号因队列满没有放入队列时，剩余token在pending里
+            if self._stop_signal is None:
+                raise
+            with self._lock:
+                # end()可能刚把pending写入队列，加锁后再取一次队列，保证token的顺序
+                try:
+                    tokens = self._queue.get_nowait()
+                except Empty:
+                    tokens, self._pending = self._pending, []
+                    if len(tokens) == 0:
+                        tokens = None
+
+        if tokens is None:
+            self._finished = True
+            if not isinstance(self._stop_signal, StopIteration):
+                raise self._stop_signal
+
+        return tokens
+
+    def next_text(self, timeout: float=None) -> str:
+        '''
+        取出下一段可以输出的文本，生成结束返回None
+        '''
+        while True:
+            tokens = self.get(timeout=timeout)
+
+            if tokens is None:
+                # 输出缓存中剩余的文本
+                if len(self._token_cache) == 0:
+                    return None
+                text = self._decode()[self._print_len: ]
+                self._token_cache, self._print_len = [], 0
+                if len(text) == 0:
+                    return None
+                return text
+
+            self._token_cache.extend(tokens)
+            text = self._decode()
+
+            # 以�结尾说明多字节字符还不完整，等待下一个token
+            if text.endswith('�'):
+                continue
+
+            new_text = text[self._print_len: ]
+            self._print_len = len(text)
+
+            if len(new_text) > 0:
+                return new_text
+
+    def _decode(self) -> str:
+        return self.tokenizer.decode(self._token_cache, skip_special_tokens=self.skip_special_tokens, clean_up_tokenization_spaces=True)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> str:
+        text = self.next_text()
+        if text is None:
+            raise StopIteration()
+        return text
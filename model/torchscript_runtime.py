@@ -0,0 +1,399 @@
+import os
+import time
+from types import SimpleNamespace
+from typing import Union
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import ujson
+import torch
+from torch import Tensor, LongTensor
+from tokenizers import Tokenizer
+
+# 只依赖torch和tokenizers，不import transformers、accelerate
+from model.streamer import TokenStreamer
+from model.stopping import DeadlineStoppingCriteria
+from model.session import ChatSession
+from model.logits_processors import TensorNoRepeatNGramLogitsProcessor
+from model.bucketing import bucket_by_length, pad_batch
+from model.generation_profiles import GenerationProfile, ProfileMetrics, get_profile, load_profiles
+from config import InferConfig
+
+
+class RuntimeTokenizer:
+    def __init__(self, tokenizer_file: str, pad_token: str='[PAD]', eos_token: str='[EOS]') -> None:
+        '''
+        tokenizers.Tokenizer的简单封装，encode、decode的结果和PreTrainedTokenizerFast相同
+        '''
+        self._tokenizer = Tokenizer.from_file(tokenizer_file)
+        self.pad_token_id = self._tokenizer.token_to_id(pad_token)
+        self.eos_token_id = self._tokenizer.token_to_id(eos_token)
+
+    def __len__(self) -> int:
+        return self._tokenizer.get_vocab_size(with_added_tokens=True)
+
+    def encode_plus(self, text: str) -> SimpleNamespace:
+        return SimpleNamespace(input_ids=self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    @staticmethod
+    def clean_up_tokenization(text: str) -> str:
+        # 同transformers的PreTrainedTokenizerBase.clean_up_tokenization
+        return (
+            text.replace(" .", ".")
+            .replace(" ?", "?")
+            .replace(" !", "!")
+            .replace(" ,", ",")
+            .replace(" ' ", "'")
+            .replace(" n't", "n't")
+            .replace(" 'm", "'m")
+            .replace(" 's", "'s")
+            .replace(" 've", "'ve")
+            .replace(" 're", "'re")
+        )
+
+    def decode(self, token_ids: list[int], skip_special_tokens: bool=True, clean_up_tokenization_spaces: bool=True) -> str:
+        text = self._tokenizer.decode(list(token_ids), skip_special_tokens=skip_special_tokens)
+        return self.clean_up_tokenization(text) if clean_up_tokenization_spaces else text
+
+    def batch_decode(self, sequences: list[list[int]], skip_special_tokens: bool=True, clean_up_tokenization_spaces: bool=True) -> list[str]:
+        return [self.decode(ids, skip_special_tokens, clean_up_tokenization_spaces) for ids in sequences]
+
+
+class TorchScriptT5:
+    def __init__(self, export_dir: str, device: str='cpu') -> None:
+        '''
+        加载model/export_torchscript.py导出的三个TorchScript图：
+        encoder: (input_ids, attention_mask) -> encoder_hidden_states
+        decoder_init: (decoder_input_ids, encoder_hidden_states, attention_mask) -> (logits, self_kv, cross_kv)
+        decoder_with_past: (decoder_input_ids, encoder_hidden_states, attention_mask, self_kv, cross_kv) -> (logits, self_kv)
+        self_kv: (num_layers, 2, batch, n_heads, dec_len, d_kv)，cross_kv: (num_layers, 2, batch, n_heads, enc_len, d_kv)
+        '''
+        with open(os.path.join(export_dir, 'export_config.json'), 'r', encoding='utf-8') as f:
+            self.config = ujson.load(f)
+
+        self.device = torch.device(device)
+        self.decoder_start_token_id = self.config['decoder_start_token_id']
+        self.eos_token_id = self.config['eos_token_id']
+        self.pad_token_id = self.config['pad_token_id']
+
+        self.encoder = torch.jit.load(os.path.join(export_dir, 'encoder.pt'), map_location=self.device).eval()
+        self.decoder_init = torch.jit.load(os.path.join(export_dir, 'decoder_init.pt'), map_location=self.device).eval()
+        self.decoder_with_past = torch.jit.load(os.path.join(export_dir, 'decoder_with_past.pt'), map_location=self.device).eval()
+
+    @staticmethod
+    def sample_next_tokens(logits: Tensor, sequences: LongTensor, temperature: float, top_k: int, top_p: float, no_repeat_ngram_size: int, repetition_penalty: float=1.0) -> LongTensor:
+        '''
+        随机采样，处理顺序和my_generate的sampling相同：repetition_penalty、no_repeat_ngram、temperature、top_k、top_p
+        '''
+        logits = logits.float()
+        if repetition_penalty != 1.0:
+            # 同transformers的RepetitionPenaltyLogitsProcessor，这里不import transformers
+            score = torch.gather(logits, 1, sequences)
+            logits = logits.scatter(1, sequences, torch.where(score < 0, score * repetition_penalty, score / repetition_penalty))
+        if no_repeat_ngram_size > 0:
+            logits = TensorNoRepeatNGramLogitsProcessor(no_repeat_ngram_size)(sequences, logits)
+
+        logits = logits / temperature
+
+        if top_k > 0:
+            kth = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1, None]
+            logits = logits.masked_fill(logits < kth, -float('inf'))
+
+        if top_p < 1.0:
+            sorted_logits, sorted_index = torch.sort(logits, descending=False)
+            cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+            sorted_remove = cumulative_probs <= (1 - top_p)
+            sorted_remove[:, -1] = False
+            logits = logits.masked_fill(sorted_remove.scatter(1, sorted_index, sorted_remove), -float('inf'))
+
+        return torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(1)
+
+    @torch.no_grad()
+    def generate(self,
+                input_ids: LongTensor,
+                attention_mask: LongTensor,
+                max_new_tokens: int=320,
+                search_type: str='greedy',
+                encoder_hidden_states: Tensor=None,
+                streamer: TokenStreamer=None,
+                temperature: float=0.98,
+                top_k: int=50,
+                top_p: float=0.80,
+                no_repeat_ngram_size: int=4,
+                repetition_penalty: float=1.0,
+                stopping_criteria: list=None,
+            ) -> LongTensor:
+        '''
+        greedy或sampling（参数默认和my_generate的sampling相同），返回值和my_generate相同：
+        (batch, 1 + 生成长度)，第一个为decoder_start_token_id，结束的序列用pad_token_id填充。
+        stopping_criteria: 额外的停止条件，每个解码步之后检查，任一条件满足时停止整个batch的生成
+        '''
+        if search_type not in ('greedy', 'sampling'):
+            raise ValueError("search_type must be 'greedy' or 'sampling' for the torchscript runtime, got: {}".format(search_type))
+
+        input_ids, attention_mask = input_ids.to(self.device), attention_mask.to(self.device)
+        if encoder_hidden_states is None:
+            encoder_hidden_states = self.encoder(input_ids, attention_mask)
+
+        batch_size = input_ids.shape[0]
+        sequences = torch.full((batch_size, 1), self.decoder_start_token_id, dtype=torch.long, device=self.device)
+        unfinished = torch.ones(batch_size, dtype=torch.bool, device=self.device)
+
+        logits, self_kv, cross_kv = self.decoder_init(sequences, encoder_hidden_states, attention_mask)
+
+        for step in range(max_new_tokens):
+            next_logits = logits[:, -1, :]
+            if search_type == 'greedy':
+                next_tokens = next_logits.argmax(dim=-1)
+            else:
+                next_tokens = self.sample_next_tokens(next_logits, sequences, temperature, top_k, top_p, no_repeat_ngram_size, repetition_penalty)
+
+            next_tokens = torch.where(unfinished, next_tokens, torch.full_like(next_tokens, self.pad_token_id))
+            sequences = torch.cat([sequences, next_tokens[:, None]], dim=-1)
+
+            # streamer被取消（消费者断开或缓存持续满）时停止生成
+            if streamer is not None and not streamer.put(next_tokens.tolist()):
+                break
+
+            unfinished = unfinished & (next_tokens != self.eos_token_id)
+            if not bool(unfinished.any()) or step + 1 == max_new_tokens:
+                break
+
+            if stopping_criteria is not None and any(criteria(sequences, next_logits) for criteria in stopping_criteria):
+                break
+
+            logits, self_kv = self.decoder_with_past(next_tokens[:, None], encoder_hidden_states, attention_mask, self_kv, cross_kv)
+
+        if streamer is not None:
+            streamer.end()
+
+        return sequences
+
+
+class RuntimeEngine:
+    def __init__(self, model: TorchScriptT5, max_new_tokens: int=320, pad_token_id: int=0) -> None:
+        '''
+        导出模型运行时的请求队列，和ContinuousBatchingEngine的submit接口相同，单线程逐个生成（不做连续批处理）。
+        streamer被取消或stopping_criteria满足（如调用方取消了结果）的请求在下一个解码步停止，
+        排队期间已经取消的请求直接跳过，不占用唯一的生成线程
+        '''
+        self.model = model
+        self.max_new_tokens = max_new_tokens
+        self.pad_token_id = pad_token_id
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='torchscript-runtime')
+        self.stats = {'finished': 0, 'cancelled': 0, 'generated_tokens': 0}
+
+    @property
+    def num_running(self) -> int:
+        return 0
+
+    @property
+    def num_waiting(self) -> int:
+        return self._executor._work_queue.qsize()
+
+    def _generate(self, input_ids: list[int], max_new_tokens: int, streamer: TokenStreamer, encoder_hidden_states: Tensor, stopping_criteria: list) -> list[int]:
+        # 排队期间已经被取消
+        if streamer is not None and streamer.cancelled:
+            streamer.end()
+            self.stats['cancelled'] += 1
+            return []
+
+        x = torch.LongTensor([input_ids])
+        hidden = None if encoder_hidden_states is None else encoder_hidden_states[None].to(self.model.device)
+        try:
+            outputs = self.model.generate(
+                x,
+                torch.ones_like(x),
+                max_new_tokens=max_new_tokens,
+                encoder_hidden_states=hidden,
+                streamer=streamer,
+                stopping_criteria=stopping_criteria,
+            )
+        except Exception as e:
+            if streamer is not None:
+                streamer.end(e)
+            raise
+
+        output_ids = [token for token in outputs[0, 1: ].tolist() if token != self.pad_token_id]
+        cancelled = (streamer is not None and streamer.cancelled) or any(getattr(criteria, 'triggered', False) for criteria in stopping_criteria or [])
+        self.stats['cancelled' if cancelled else 'finished'] += 1
+        self.stats['generated_tokens'] += len(output_ids)
+
+        return output_ids
+
+    def submit(self,
+                input_ids: list[int],
+                max_new_tokens: int=None,
+                streamer: TokenStreamer=None,
+                encoder_hidden_states: Tensor=None,
+                stopping_criteria: list=None,
+            ) -> Future:
+        '''
+        stopping_criteria: 额外的停止条件（如model.stopping.DeadlineStoppingCriteria），每个解码步检查
+        '''
+        max_new_tokens = self.max_new_tokens if max_new_tokens is None else min(max_new_tokens, self.max_new_tokens)
+        return self._executor.submit(self._generate, list(input_ids), max_new_tokens, streamer, encoder_hidden_states, stopping_criteria)
+
+    def stop(self, timeout: float=None) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class TorchScriptChatBot:
+    def __init__(self, infer_config: InferConfig) -> None:
+        '''
+        使用导出的TorchScript模型推理，接口和ChatBot相同（chat、stream_chat、submit、create_session），
+        不依赖transformers和accelerate，worker启动更快、占用内存更少，仅支持CPU float32，
+        生成方式只支持greedy和不使用beam search的随机采样（如sampling），
+        多轮对话只支持session_encode_mode='full'。导出：python model/export_torchscript.py
+        '''
+        start = time.perf_counter()
+        self.infer_config = infer_config
+
+        self.tokenizer = RuntimeTokenizer(os.path.join(infer_config.torchscript_dir, 'tokenizer.json'))
+        self.encode = self.tokenizer.encode_plus
+        self.batch_decode = self.tokenizer.batch_decode
+
+        self.model = TorchScriptT5(infer_config.torchscript_dir)
+        self.device = self.model.device
+        self.engine = RuntimeEngine(self.model, max_new_tokens=infer_config.max_seq_len, pad_token_id=self.tokenizer.pad_token_id)
+
+        self.encoder_cache = None
+        self.response_cache = None
+        self.speculative_decoder = None
+        self.compiled_generator = None
+        self.static_generator = None
+
+        if len(infer_config.generation_profiles_file) > 0:
+            load_profiles(infer_config.generation_profiles_file)
+        self.get_profile(infer_config.generation_profile)
+        self.profile_metrics = ProfileMetrics()
+
+        self.startup_time = {'total': round(time.perf_counter() - start, 3)}
+
+    def get_engine(self) -> RuntimeEngine:
+        return self.engine
+
+    def get_profile(self, search_type: str=None) -> GenerationProfile:
+        '''
+        search_type为None时使用InferConfig.generation_profile，导出模型不支持的生成方式抛出ValueError
+        '''
+        profile = get_profile(self.infer_config.generation_profile if search_type is None else search_type)
+        if not profile.is_greedy and not (profile.do_sample and profile.num_beams == 1 and profile.penalty_alpha is None):
+            raise ValueError('generation profile {} is not supported by the torchscript runtime, only greedy and sampling without beams.'.format(profile.name))
+
+        return profile
+
+    def create_session(self, max_history_tokens: int=None, encode_mode: str=None) -> ChatSession:
+        encode_mode = self.infer_config.session_encode_mode if encode_mode is None else encode_mode
+        if encode_mode != 'full':
+            raise ValueError("the torchscript runtime only supports session encode_mode='full'.")
+
+        return ChatSession(
+            chat_bot=self,
+            max_history_tokens=self.infer_config.session_max_history_tokens if max_history_tokens is None else max_history_tokens,
+            encode_mode=encode_mode,
+        )
+
+    def stream_chat(self, input_txt: str, max_new_tokens: int=None) -> TokenStreamer:
+        streamer = TokenStreamer(
+            tokenizer=self.tokenizer,
+            max_buffer_size=self.infer_config.stream_buffer_size,
+            stall_timeout=self.infer_config.stream_stall_timeout,
+        )
+
+        input_ids = self.encode(input_txt + '[EOS]').input_ids
+        self.engine.submit(input_ids, max_new_tokens=max_new_tokens, streamer=streamer)
+
+        return streamer
+
+    def generate_batch(self,
+                input_txts: list[str],
+                max_batch_size: int=None,
+                max_batch_tokens: int=None,
+                expected_output_lens: list[int]=None,
+                search_type: str=None,
+                max_new_tokens: int=None,
+                stopping_criteria: list=None,
+                profile_metrics: ProfileMetrics=None,
+            ) -> list[str]:
+        '''
+        批量生成，和ChatBot.generate_batch相同，按token长度分桶后每个桶生成一次，结果按输入顺序返回，空回答不做替换
+        '''
+        profile = self.get_profile(search_type)
+        metrics_list = [self.profile_metrics] if profile_metrics is None else [self.profile_metrics, profile_metrics]
+
+        def record(num_requests: int, num_tokens: int, seconds: float) -> None:
+            for metrics in metrics_list:
+                metrics.record(profile.name, num_requests, num_tokens, seconds)
+
+        max_new_tokens = self.infer_config.max_seq_len if max_new_tokens is None else min(max_new_tokens, self.infer_config.max_seq_len)
+        max_batch_size = self.infer_config.max_batch_size if max_batch_size is None else max_batch_size
+        max_batch_tokens = self.infer_config.max_batch_tokens if max_batch_tokens is None else max_batch_tokens
+
+        encoded = [self.encode(f"{txt}[EOS]").input_ids for txt in input_txts]
+        buckets = bucket_by_length([len(ids) for ids in encoded], max_batch_size, max_batch_tokens, expected_output_lens)
+
+        outputs = [None] * len(input_txts)
+        for bucket in buckets:
+            input_ids, attention_mask = pad_batch([encoded[i] for i in bucket], pad_token_id=self.tokenizer.pad_token_id)
+
+            start = time.perf_counter()
+            batch_outputs = self.model.generate(
+                input_ids,
+                attention_mask,
+                max_new_tokens=max_new_tokens,
+                search_type='greedy' if profile.is_greedy else 'sampling',
+                temperature=profile.temperature,
+                top_k=profile.top_k,
+                top_p=profile.top_p,
+                no_repeat_ngram_size=profile.no_repeat_ngram_size,
+                repetition_penalty=profile.repetition_penalty,
+                stopping_criteria=stopping_criteria,
+            )
+            record(len(bucket), int((batch_outputs[:, 1: ] != self.tokenizer.pad_token_id).sum()), time.perf_counter() - start)
+
+            for i, output in zip(bucket, self.batch_decode(batch_outputs.tolist(), clean_up_tokenization_spaces=True, skip_special_tokens=True)):
+                outputs[i] = output
+
+        return outputs
+
+    def chat(self, input_txt: Union[str, list[str]], search_type: str=None, max_new_tokens: int=None, stopping_criteria: list=None) -> Union[str, list[str]]:
+        if isinstance(input_txt, str):
+            input_txt = [input_txt]
+        elif not isinstance(input_txt, list):
+            raise Exception('input_txt mast be a str or list[str]')
+
+        outputs = self.generate_batch(input_txt, search_type=search_type, max_new_tokens=max_new_tokens, stopping_criteria=stopping_criteria)
+
+        note = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
+        outputs = [item if len(item) != 0 else note for item in outputs]
+
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def submit(self, input_txt: str, max_new_tokens: int=None) -> Future:
+        note = "我是一个参数很少的AI模型🥺，知识库较少，无法直接回答您的问题，换个问题试试吧👋"
+        result = Future()
+        start = time.perf_counter()
+
+        def decode_callback(engine_future: Future) -> None:
+            if engine_future.cancelled() or result.done():
+                return
+            if engine_future.exception() is not None:
+                result.set_exception(engine_future.exception())
+                return
+
+            self.profile_metrics.record('greedy', 1, len(engine_future.result()), time.perf_counter() - start)
+            output = self.tokenizer.decode(engine_future.result(), skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            result.set_result(output if len(output) != 0 else note)
+
+        def cancel_callback(future: Future) -> None:
+            # 排队中的请求直接取消，已经开始生成的请求在下一个解码步停止
+            if future.cancelled():
+                engine_future.cancel()
+                criteria.cancel()
+
+        criteria = DeadlineStoppingCriteria()
+        engine_future = self.engine.submit(self.encode(f"{input_txt}[EOS]").input_ids, max_new_tokens=max_new_tokens, stopping_criteria=[criteria])
+        engine_future.add_done_callback(decode_callback)
+        result.add_done_callback(cancel_callback)
+
+        return result
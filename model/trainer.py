@@ -209,7 +209,7 @@ class ChatTrainer:
         decoder_start_token_id = tokenizer.pad_token_id
 
         # for t5, set decoder_start_token_id = pad_token_id
-        t5_config = get_T5_config(T5ModelConfig(), vocab_size=len(tokenizer), decoder_start_token_id=decoder_start_token_id, eos_token_id=tokenizer.eos_token_id)
+        t5_config = get_T5_config(self.model_config, vocab_size=len(tokenizer), decoder_start_token_id=decoder_start_token_id, eos_token_id=tokenizer.eos_token_id)
 
         model = TextToTextModel(t5_config)
 
@@ -508,7 +508,7 @@ class ChatTrainer:
             model = TextToTextModel.from_pretrained(model_file)
         else:
             # load_state_dict
-            t5_config = get_T5_config(T5ModelConfig(), vocab_size=len(tokenizer), decoder_start_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
+            t5_config = get_T5_config(self.model_config, vocab_size=len(tokenizer), decoder_start_token_id=tokenizer.pad_token_id, eos_token_id=tokenizer.eos_token_id)
             model = TextToTextModel(t5_config)
             model.load_state_dict(torch.load(model_file, map_location='cpu')) # set cpu for no exception
        
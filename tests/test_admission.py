@@ -0,0 +1,64 @@
+import pytest
+
+import model.admission
+from model.admission import TokenBucket
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(model.admission.time, 'monotonic', clock)
+    return clock
+
+
+def test_starts_full_and_consumes(clock):
+    bucket = TokenBucket(tokens_per_minute=600)
+
+    assert bucket.consume(400) == 0.0
+    assert bucket.consume(200) == 0.0
+    assert bucket.tokens == pytest.approx(0.0)
+
+
+def test_insufficient_tokens_returns_wait_without_deducting(clock):
+    bucket = TokenBucket(tokens_per_minute=600)     # 每秒10个
+    bucket.consume(550)
+
+    assert bucket.consume(100) == pytest.approx(5.0)
+    assert bucket.tokens == pytest.approx(50.0)
+
+
+def test_refill_over_time(clock):
+    bucket = TokenBucket(tokens_per_minute=600)
+    bucket.consume(600)
+
+    clock.now += 3.0
+    assert bucket.consume(30) == 0.0
+    assert bucket.consume(1) == pytest.approx(0.1)
+
+
+def test_refill_is_capped_at_one_minute(clock):
+    bucket = TokenBucket(tokens_per_minute=600)
+    bucket.consume(100)
+
+    clock.now += 3600.0
+    assert bucket.consume(0) == 0.0
+    assert bucket.tokens == pytest.approx(600.0)
+    assert bucket.consume(601) > 0.0
+
+
+def test_refund_is_capped(clock):
+    bucket = TokenBucket(tokens_per_minute=600)
+    bucket.consume(300)
+
+    bucket.refund(200)
+    assert bucket.tokens == pytest.approx(500.0)
+    bucket.refund(1000)
+    assert bucket.tokens == pytest.approx(600.0)
@@ -0,0 +1,47 @@
+import os
+
+from model.batch_inference import count_finished
+
+
+def write_bytes(path, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_missing_file(tmp_path):
+    assert count_finished(str(tmp_path / 'missing.jsonl')) == 0
+
+
+def test_complete_records(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    write_bytes(path, b'{"id": 1}\n{"id": 2}\n\n{"id": 3}\n')
+
+    assert count_finished(str(path)) == 3
+    assert os.path.getsize(path) == len(b'{"id": 1}\n{"id": 2}\n\n{"id": 3}\n')
+
+
+def test_truncates_partial_last_line(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    write_bytes(path, b'{"id": 1}\n{"id": 2}\n{"id": 3, "respo')
+
+    assert count_finished(str(path)) == 2
+    assert path.read_bytes() == b'{"id": 1}\n{"id": 2}\n'
+
+    # 截掉之后再次调用结果不变，追加写入从完整的行之后开始
+    assert count_finished(str(path)) == 2
+
+
+def test_stops_at_invalid_json_line(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    write_bytes(path, b'{"id": 1}\n{"id": \n{"id": 3}\n')
+
+    assert count_finished(str(path)) == 1
+    assert path.read_bytes() == b'{"id": 1}\n'
+
+
+def test_non_ascii_records(tmp_path):
+    path = tmp_path / 'out.jsonl'
+    write_bytes(path, '{"response": "你好"}\n{"response": "北京'.encode('utf-8'))
+
+    assert count_finished(str(path)) == 1
+    assert path.read_bytes() == '{"response": "你好"}\n'.encode('utf-8')
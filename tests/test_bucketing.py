@@ -0,0 +1,41 @@
+import random
+
+from model.bucketing import bucket_by_length
+
+
+def test_docstring_example():
+    assert bucket_by_length([3, 50, 4, 48], max_batch_size=2) == [[0, 2], [3, 1]]
+
+
+def test_empty_input():
+    assert bucket_by_length([], max_batch_size=4) == []
+
+
+def test_every_index_once_and_sorted_by_length():
+    random.seed(0)
+    lengths = [random.randint(1, 200) for _ in range(257)]
+    buckets = bucket_by_length(lengths, max_batch_size=16)
+
+    flat = [i for bucket in buckets for i in bucket]
+    assert sorted(flat) == list(range(len(lengths)))
+    assert [lengths[i] for i in flat] == sorted(lengths)
+    assert all(0 < len(bucket) <= 16 for bucket in buckets)
+
+
+def test_max_batch_tokens():
+    random.seed(1)
+    lengths = [random.randint(1, 100) for _ in range(100)]
+    buckets = bucket_by_length(lengths, max_batch_size=32, max_batch_tokens=256)
+
+    for bucket in buckets:
+        # 填充后的token数不超过预算，只有一条超长的prompt时单独成一个batch
+        assert len(bucket) == 1 or len(bucket) * max(lengths[i] for i in bucket) <= 256
+
+
+def test_prompt_longer_than_budget_gets_its_own_batch():
+    assert bucket_by_length([10, 500, 12], max_batch_size=8, max_batch_tokens=64) == [[0, 2], [1]]
+
+
+def test_output_lengths_break_ties():
+    buckets = bucket_by_length([5, 5, 5, 5], max_batch_size=2, output_lengths=[40, 10, 30, 20])
+    assert buckets == [[1, 3], [2, 0]]
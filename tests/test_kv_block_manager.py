@@ -0,0 +1,113 @@
+import pytest
+import torch
+
+from model.kv_cache import KVBlockManager, OutOfBlocksError
+
+
+def make_manager(num_blocks: int=8, block_size: int=4, grow_blocks: int=2) -> KVBlockManager:
+    return KVBlockManager(num_blocks=num_blocks, block_size=block_size, num_layers=2, n_heads=2, d_kv=3, grow_blocks=grow_blocks)
+
+
+def test_reserve_allocates_blocks_on_demand():
+    manager = make_manager()
+
+    manager.reserve('a', 3)
+    assert manager.block_table('a') == [0]
+    manager.reserve('a', 1)
+    assert manager.block_table('a') == [0]
+    manager.reserve('a', 1)
+    assert manager.block_table('a') == [0, 1]
+    assert manager.length('a') == 5
+    assert manager.num_free_blocks == 6
+
+
+def test_free_returns_blocks_and_reuses_lowest_ids():
+    manager = make_manager()
+    manager.reserve('a', 8)
+    manager.reserve('b', 4)
+    manager.reserve('c', 4)
+    assert manager.block_table('b') == [2]
+
+    manager.free('a')
+    assert manager.num_free_blocks == 8 - 2
+    assert manager.block_table('a') == [] and manager.length('a') == 0
+
+    # 归还的块按编号从小到大重新分配
+    manager.reserve('d', 5)
+    assert manager.block_table('d') == [0, 1]
+
+    stats = manager.get_stats()
+    assert stats['allocated_blocks'] == 6 and stats['freed_blocks'] == 2
+    assert stats['peak_used_blocks'] == 4
+
+
+def test_out_of_blocks_does_not_allocate_partially():
+    manager = make_manager(num_blocks=3)
+    manager.reserve('a', 8)
+
+    with pytest.raises(OutOfBlocksError):
+        manager.reserve('b', 5)
+
+    assert manager.block_table('b') == []
+    assert manager.num_free_blocks == 1
+    manager.reserve('b', 4)
+    assert manager.block_table('b') == [2]
+
+
+def test_storage_grows_with_used_blocks():
+    manager = make_manager(num_blocks=8, grow_blocks=2)
+    assert manager.capacity == 2
+
+    manager.reserve('a', 4 * 3)
+    assert manager.capacity == 4
+    assert manager.get_stats()['grows'] == 1
+
+    manager.reserve('b', 4 * 5)
+    assert manager.capacity == 8
+
+
+def test_occupancy_and_fragmentation():
+    manager = make_manager(num_blocks=8, block_size=4)
+    manager.reserve('a', 5)      # 2块，3个空位
+    manager.reserve('b', 4)      # 1块，没有空位
+
+    stats = manager.get_stats()
+    assert stats['used_blocks'] == 3
+    assert stats['used_tokens'] == 9
+    assert stats['occupancy'] == round(3 / 8, 4)
+    assert stats['fragmentation'] == round(1 - 9 / 12, 4)
+
+    manager.free('a')
+    manager.free('b')
+    assert manager.get_stats()['fragmentation'] == 0.0
+
+
+def test_write_and_gather_roundtrip():
+    manager = make_manager(num_blocks=8, block_size=4)
+    lengths = {'a': 6, 'b': 3}
+    values = {}
+    for key, length in lengths.items():
+        manager.reserve(key, length)
+        values[key] = torch.randn(2, 2, 2, length, 3)      # (num_layers, 2, n_heads, length, d_kv)
+        manager.write(key, values[key])
+
+    # 每个解码步写入一个位置
+    for key in lengths:
+        manager.reserve(key, 1)
+    step = torch.randn(2, 2, 2, 2, 3)       # (num_layers, 2, batch, n_heads, d_kv)
+    block_index, block_offset = manager.slot_index(list(lengths), [lengths['a'], lengths['b']])
+    for layer in range(2):
+        manager.write_slots(layer, step[layer], block_index, block_offset)
+
+    index, valid_lengths = manager.block_index(['a', 'b'])
+    assert valid_lengths.tolist() == [7, 4]
+
+    for layer in range(2):
+        key, value = manager.gather_layer(layer, index)
+        assert key.shape == (2, 2, index.shape[1] * 4, 3)
+        for row, name in enumerate(['a', 'b']):
+            length = lengths[name]
+            assert torch.equal(key[row, :, : length], values[name][layer, 0])
+            assert torch.equal(value[row, :, : length], values[name][layer, 1])
+            assert torch.equal(key[row, :, length], step[layer, 0, row])
+            assert torch.equal(value[row, :, length], step[layer, 1, row])
@@ -0,0 +1,48 @@
+import pytest
+import torch
+from transformers import NoRepeatNGramLogitsProcessor, RepetitionPenaltyLogitsProcessor
+
+from model.logits_processors import TensorNoRepeatNGramLogitsProcessor, build_logits_processors
+
+
+@pytest.mark.parametrize('ngram_size', [1, 2, 3, 4])
+@pytest.mark.parametrize('vocab_size', [7, 50, 29298])
+def test_no_repeat_ngram_matches_transformers(ngram_size, vocab_size):
+    generator = torch.Generator().manual_seed(ngram_size * 1000 + vocab_size)
+
+    for cur_len in [1, ngram_size - 1, ngram_size, 17, 64]:
+        if cur_len < 1:
+            continue
+        # 从较小的范围取token，产生重复的n-gram
+        input_ids = torch.randint(0, min(vocab_size, 6), (8, cur_len), generator=generator)
+        scores = torch.randn((8, vocab_size), generator=generator)
+
+        expected = NoRepeatNGramLogitsProcessor(ngram_size)(input_ids, scores.clone())
+        actual = TensorNoRepeatNGramLogitsProcessor(ngram_size)(input_ids, scores.clone())
+
+        assert torch.equal(actual, expected)
+
+
+def test_no_repeat_ngram_without_key_encoding():
+    # vocab_size ** (n - 1)超过int64时逐个token比较
+    generator = torch.Generator().manual_seed(0)
+    input_ids = torch.randint(0, 5, (4, 40), generator=generator)
+    scores = torch.randn((4, 29298), generator=generator)
+
+    expected = NoRepeatNGramLogitsProcessor(6)(input_ids, scores.clone())
+    actual = TensorNoRepeatNGramLogitsProcessor(6)(input_ids, scores.clone())
+
+    assert torch.equal(actual, expected)
+
+
+def test_invalid_ngram_size():
+    with pytest.raises(ValueError):
+        TensorNoRepeatNGramLogitsProcessor(0)
+
+
+def test_build_logits_processors():
+    assert build_logits_processors() == []
+
+    processors = build_logits_processors(no_repeat_ngram_size=3, repetition_penalty=1.2)
+    assert isinstance(processors[0], RepetitionPenaltyLogitsProcessor)
+    assert isinstance(processors[1], TensorNoRepeatNGramLogitsProcessor)
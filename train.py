@@ -1,6 +1,9 @@
+import sys
+from dataclasses import replace
+
 import fire
 
-from config import  TrainConfig, T5ModelConfig
+from config import  TrainConfig, T5ModelConfig, DraftT5ModelConfig, PROJECT_ROOT
 from model.trainer import ChatTrainer
 
 
@@ -8,6 +11,19 @@ if __name__ == '__main__':
     train_config = TrainConfig()
     model_config = T5ModelConfig()
 
+    # 训练投机解码的草稿模型，数据、tokenizer和主模型相同，模型文件单独保存
+    # e.g: python train.py train --draft
+    if '--draft' in sys.argv:
+        sys.argv.remove('--draft')
+        model_config = DraftT5ModelConfig()
+        train_config = replace(
+            train_config,
+            model_file=PROJECT_ROOT + '/model_save/draft_t5.{}.bin',
+            model_config_file=PROJECT_ROOT + '/model_save/draft_model_config.json',
+            train_state_dir=PROJECT_ROOT + '/model_save/draft_train_latest_state',
+            output_dir=PROJECT_ROOT + '/model_save/draft_pretrain',
+        )
+
     chat_trainer = ChatTrainer(train_config=train_config, model_config=model_config)
 
     # 解析命令行参数，执行指定函数
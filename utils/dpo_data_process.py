@@ -3,7 +3,6 @@ sys.path.extend(['.','..'])
 import os
 import re
 
-import torch
 import pandas as pd
 import numpy as np
 import ujson
@@ -11,6 +10,7 @@ from rich import progress
 import pyarrow.parquet as pq
 
 from model.infer import ChatBot
+from model.batch_inference import BatchGenerator
 from logger import Logger
 from config import PROJECT_ROOT, InferConfig
 
@@ -61,8 +61,11 @@ def process_alpaca_gpt4_data(max_len: int=512) -> None:
     with open(save_file, 'w', encoding='utf-8') as f:
         ujson.dump(my_data, f, indent=4, ensure_ascii=False)
 
-def generate_alpaca_gpt4_reject_response(groups_cnt: int=50000, max_len: int=320, batch_size: int=32) -> None:
+def generate_alpaca_gpt4_reject_response(groups_cnt: int=50000, max_len: int=320, batch_size: int=32, pool_size: int=2000, resume: bool=False) -> None:
     '''生成不是很满意的回答回答
+    使用model.batch_inference.BatchGenerator：每次取pool_size条prompt，按长度分桶后批量生成，
+    每个pool保存一次进度到outs.ckp.jsonl，中断后用resume=True重新运行从断点继续（输入文件或生成参数变化时不会续跑），
+    resume=False时重新生成，覆盖outs.ckp.jsonl
     '''
     print('load model...')
 
@@ -70,67 +73,34 @@ def generate_alpaca_gpt4_reject_response(groups_cnt: int=50000, max_len: int=320
     infer_config = InferConfig()
     chatbot = ChatBot(infer_config)
 
-    model = chatbot.model
-    tokenizer = chatbot.tokenizer
-    device = 'cuda' if torch.cuda.is_available() else 'cpu'
-
     finetune_file = PROJECT_ROOT + '/data/alpaca_gpt4_data_zh.json'
     save_rw_json_file = PROJECT_ROOT + '/data/my_dpo_alpaca_gpt4_data_zh.json'
+    ckp_file = PROJECT_ROOT + '/data/outs.ckp.jsonl'
     # save_rw_parquet_file = PROJECT_ROOT + '/data/my_rlhf_dataset.parquet'
 
+    # 模型生成的答案为拒绝答案，chosen的长度作为预计的输出长度
+    generator = BatchGenerator(chatbot, max_batch_size=batch_size)
+    stats = generator.run_file(
+                finetune_file,
+                ckp_file,
+                prompt_key='prompt',
+                output_key='reject',
+                expected_length_key='chosen',
+                chunk_size=pool_size,
+                resume=resume,
+            )
+
+    log.info('generate stats: {}, padding stats: {}'.format(stats, chatbot.padding_stats.to_dict()), save_to_file=True)
+
     data = []
-    with open(finetune_file, 'r', encoding='utf-8') as f:
-        data = ujson.load(f)
-    
-    log.info('length of {} is {}'.format(save_rw_json_file, len(data)), save_to_file=True)
+    with open(ckp_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            data.append(ujson.loads(line))
 
-    model_outs = []
-    batch_prompt = []
-    process_item = []
-    for i, item in progress.track(enumerate(data), total=len(data)):
-        # 模型生成的答案为拒绝答案
-        batch_prompt.append(f"{item['prompt']}[EOS]")
-        process_item.append(item)
-        
-        if i % 500 == 0: 
-            print('process {} items.'.format(i))
-
-        if len(batch_prompt) >= batch_size or i == len(data) - 1:
-            
-            encoded = tokenizer.batch_encode_plus(batch_prompt, truncation=False, padding=True)
-
-            with torch.no_grad():
-                input_ids = torch.LongTensor(encoded.input_ids).to(device)
-                attention_mask = torch.LongTensor(encoded.attention_mask).to(device)
-
-                outputs = model.my_generate(
-                                    input_ids=input_ids,
-                                    attention_mask=attention_mask,
-                                    max_seq_len=infer_config.max_seq_len,
-                                    search_type='greedy',
-                                )
-
-                outputs = tokenizer.batch_decode(outputs.cpu().numpy(),  clean_up_tokenization_spaces=True, skip_special_tokens=True)
-
-            model_outs.extend(outputs)
-                
-      
-            batch_prompt = []
-          
-        if len(model_outs) % 2000 == 0:
-            for i in range(len(model_outs)):
-                process_item[i]['reject'] = model_outs[i]
-            try:
-                with open(PROJECT_ROOT + '/data/outs.ckp.json', 'w', encoding='utf-8') as f:
-                    ujson.dump(process_item, f, indent=4, ensure_ascii=False)
-            except Exception as e:
-                print(e)
-    
-    for i in range(len(model_outs)):
-        process_item[i]['reject'] = model_outs[i]
+    log.info('length of {} is {}'.format(save_rw_json_file, len(data)), save_to_file=True)
 
     with open(save_rw_json_file, 'w', encoding='utf-8') as f:
-        ujson.dump(process_item, f, indent=4, ensure_ascii=False)
+        ujson.dump(data, f, indent=4, ensure_ascii=False)
     
     # df = pd.DataFrame(data)
     # write_single_parquet_file(save_rw_parquet_file, df)
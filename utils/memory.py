@@ -0,0 +1,17 @@
+import os
+
+from psutil import Process
+
+
+def get_memory_report() -> dict:
+    '''
+    当前进程的内存占用（MB）：
+    rss: 常驻内存，包括和其他进程共享的页；uss: 进程独占的内存，即结束该进程能释放的内存；
+    pss: uss加上按共享进程数平摊的共享内存，所有worker的pss之和约等于服务总的内存占用。
+    '''
+    memory = Process().memory_full_info()
+    report = {'pid': os.getpid(), 'rss_mb': memory.rss, 'uss_mb': memory.uss}
+    if hasattr(memory, 'pss'):
+        report['pss_mb'] = memory.pss
+
+    return {key: (round(value / 1024 / 1024, 1) if key.endswith('_mb') else value) for key, value in report.items()}